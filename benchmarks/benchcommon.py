@@ -0,0 +1,124 @@
+"""
+Setup and synthetic data shared by the benchmarks
+
+    collectorEnvironment(**defaults) --> dummy values for the settings
+        the collector reads at import and its function directory on
+        sys.path, so index can be imported without AWS
+    syntheticChain(rows, columns, call, seed) --> pandas.DataFrame of
+        an option chain shaped like the tables pandas reads off the
+        options pages
+
+The benchmarks are run as scripts from the repository, python puts
+this directory on sys.path so they import it as benchcommon.
+"""
+
+import math
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Settings the collector needs at import, none of them reach AWS
+ENVIRONMENT = {
+    'LOGLEVEL': 'ERROR',
+    'TICKERQUEUESIZE': '5',
+    'MAXCONNECTIONS': '12',
+    'NOTREACHABLESQS': 'benchmark',
+    'AWS_DEFAULT_REGION': 'us-east-2'
+    }
+
+COLUMNSETS = {
+    # Columns of the options pages
+    'full': [
+        'Contract Name', 'Last Trade Date', 'Strike', 'Last Price', 'Bid',
+        'Ask', 'Change', '% Change', 'Volume', 'Open Interest',
+        'Implied Volatility'
+        ],
+    # Pages that come back without the change columns
+    'basic': [
+        'Contract Name', 'Last Trade Date', 'Strike', 'Last Price', 'Bid',
+        'Ask', 'Volume', 'Open Interest', 'Implied Volatility'
+        ]
+    }
+
+
+def collectorEnvironment(**defaults):
+    """
+    Give the collector settings ENVIRONMENT and defaults (name=value)
+    where the environment doesn't already set them, then put
+    collectdatafunc/function on sys.path. Call before importing index
+    """
+
+    for name, value in dict(ENVIRONMENT, **defaults).items():
+        os.environ.setdefault(name, value)
+    path = os.path.join(ROOT, 'collectdatafunc', 'function')
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def syntheticChain(rows, columns='full', call=True, seed=0):
+    """
+    Option chain of rows strikes around a spot price of 150, priced
+    with Black-Scholes so prices, spreads, volume and open interest fall
+    off away from the money like they do on the pages. Cells are strings
+    the way pandas.read_html() leaves them, with commas, '-'
+    placeholders and '%' suffixes
+    """
+
+    rng = np.random.RandomState(seed)
+    spot, years = 150., 30 / 365.
+    step = 2.5 if rows * 2.5 < 1.6 * spot else .5
+    strikes = np.round(
+        max(.5, spot - step * rows / 2) + step * np.arange(rows), 2
+        )
+    moneyness = np.log(spot / strikes)
+    iv = np.abs(.25 + 1.5 * moneyness ** 2 + .01 * rng.randn(rows))
+    d1 = (moneyness + .5 * iv ** 2 * years) / (iv * math.sqrt(years))
+    d2 = d1 - iv * math.sqrt(years)
+    cdf = np.vectorize(lambda x: .5 * (1 + math.erf(x / math.sqrt(2))))
+    if call:
+        price = spot * cdf(d1) - strikes * cdf(d2)
+    else:
+        price = strikes * cdf(-d2) - spot * cdf(-d1)
+    price = np.maximum(price, .01)
+    spread = np.maximum(.01, np.round(.03 * price, 2))
+    bid = np.round(np.maximum(price - spread / 2, 0), 2)
+    ask = np.round(price + spread / 2, 2)
+    last = np.maximum(np.round(price * (1 + .02 * rng.randn(rows)), 2), .01)
+    change = np.round(last * .05 * rng.randn(rows), 2)
+    volume = rng.geometric(1 / (1 + 2000 * np.exp(-8 * moneyness ** 2))) - 1
+    interest = rng.geometric(
+        1 / (1 + 20000 * np.exp(-6 * moneyness ** 2))) - 1
+    # Contracts away from the money last traded days ago
+    days = np.minimum((np.abs(moneyness) * 20).astype(int), 5)
+    trades = np.array([
+        '2020-10-{:02d} {}:{:02d}PM EDT'.format(9 - day, 3 - day % 3, minute)
+        for day, minute in zip(days, rng.randint(0, 60, rows))
+        ])
+
+    def _fmt(pattern, values, dash=None):
+        return np.array([
+            '-' if dash is not None and blank else pattern.format(value)
+            for value, blank in zip(
+                values, dash if dash is not None else values)
+            ], dtype=object)
+
+    table = {
+        'Contract Name': _fmt(
+            'SYN201016' + ('C' if call else 'P') + '{:08d}',
+            (strikes * 1000).astype(int)),
+        'Last Trade Date': trades.astype(object),
+        'Strike': _fmt('{:,.2f}', strikes),
+        'Last Price': _fmt('{:.2f}', last),
+        'Bid': _fmt('{:.2f}', bid, bid == 0),
+        'Ask': _fmt('{:.2f}', ask),
+        'Change': _fmt('{:+.2f}', change),
+        '% Change': _fmt('{:+.2f}%', 100 * change / last),
+        'Volume': _fmt('{:,}', volume, volume == 0),
+        'Open Interest': _fmt('{:,}', interest),
+        'Implied Volatility': _fmt('{:.2f}%', 100 * iv)
+        }
+    return pd.DataFrame({label: table[label] for label in COLUMNSETS[columns]})
@@ -0,0 +1,235 @@
+"""
+Benchmark suite for the option chain codecs on both sides of storage
+
+Generates synthetic option chains shaped like the tables pandas reads
+off the options pages (object columns of strings with commas, '-'
+placeholders and '%' suffixes, see benchcommon.syntheticChain) and
+times every codec path on them
+
+    encode --> _encodeOptionsTable (collectdatafunc), one table
+    proxy table --> _decodeOptionsTable (lambdaproxyfunc), one table
+    proxy item --> _decodeItem (lambdaproxyfunc), calls and puts of an
+        item into a pandas.DataFrame
+    client --> decodeResponse (clientexample), a /data/encoded response
+        holding the same item
+
+for each PAYLOADFORMAT, column set and row count. Prints time per call,
+rows/sec, bytes per row (of the payload, or of the response for the
+client) and the peak memory allocated during a call (tracemalloc).
+
+Usage:
+    -------------------------------------------------------------------
+    python benchmarks/codecbench.py [--rows 10 100 ...]
+        [--formats zlib lzma json] [--columns full basic]
+        [--save FILE] [--compare FILE] [--tolerance 1.25]
+
+--save writes the results to a JSON file, --compare checks a run
+against a saved one and exits with status 1 if any path got slower by
+more then --tolerance times or its payload grew.
+
+Requires the collectdatafunc layer packages (numpy, pandas, lxml, boto3)
+in the local python environment, the lambdaproxyfunc packages are
+loaded from its function directory. No AWS calls are made.
+"""
+
+import argparse
+import ast
+import importlib.util
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+import pandas as pd
+
+from benchcommon import (
+    COLUMNSETS, ROOT, collectorEnvironment, syntheticChain
+    )
+
+collectorEnvironment()
+# werkzeug and awsgi are packaged with the proxy function
+sys.path.insert(0, os.path.join(ROOT, 'lambdaproxyfunc', 'function'))
+
+ROWS = [10, 100, 1000, 5000]
+FORMATS = ['zlib', 'lzma', 'json']
+REPEATS = 5
+
+
+def _load(name, path):
+    """ Import the index.py of a function directory under name """
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _clientDecoder():
+    """
+    decodeResponse out of clientexample.py, the example makes requests
+    when it runs so only its imports and the function are executed
+    """
+
+    path = os.path.join(ROOT, 'clientexample', 'clientexample.py')
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    body = [
+        node for node in tree.body
+        if (isinstance(node, (ast.Import, ast.ImportFrom)) and
+            'requests' not in [alias.name for alias in node.names]) or
+        (isinstance(node, ast.FunctionDef) and node.name == 'decodeResponse')
+        ]
+    namespace = {}
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, 'exec'),
+         namespace)
+    return namespace['decodeResponse']
+
+
+collector = _load(
+    'collector', os.path.join(ROOT, 'collectdatafunc', 'function', 'index.py')
+    )
+proxy = _load(
+    'proxy', os.path.join(ROOT, 'lambdaproxyfunc', 'function', 'index.py')
+    )
+decodeResponse = _clientDecoder()
+
+
+def _timed(func):
+    """ Best seconds per call over REPEATS rounds of autorange calls """
+
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(REPEATS, number)) / number
+
+
+def _peak(func):
+    """ Peak bytes allocated while func runs """
+
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _item(fmt, calls, puts):
+    """ OptionsHist item holding calls and puts encoded as fmt """
+
+    collector.PAYLOADFORMAT = fmt
+    item = {
+        'Ticker': 'SYN',
+        'TimeCollectedExpirationDate': 2020100915590020201016,
+        'calls': collector._encodeOptionsTable(calls),
+        'puts': collector._encodeOptionsTable(puts)
+        }
+    for side in ('calls', 'puts'):
+        if isinstance(item[side], bytes):
+            # As boto3 hands binary attributes to the proxy
+            item[side] = proxy.Binary(item[side])
+    return item
+
+
+def run(rows, formats, columnsets):
+    """
+    (dict) --> {"rows/columns/format/path": {"seconds", "rows/s",
+        "bytes/row", "peak"}}
+    """
+
+    results = {}
+    for n in rows:
+        for columns in columnsets:
+            calls = syntheticChain(n, columns, call=True)
+            puts = syntheticChain(n, columns, call=False, seed=1)
+            for fmt in formats:
+                item = _item(fmt, calls, puts)
+                payload = item['calls']
+                if isinstance(payload, proxy.Binary):
+                    payload = payload.value
+                response = json.dumps({'Items': [item]}, cls=proxy.MyEncoder)
+
+                # Both readers have to agree before they're timed
+                pd.testing.assert_frame_equal(
+                    proxy._decodeItem(item).reset_index(drop=True),
+                    decodeResponse(response).reset_index(drop=True)
+                    )
+
+                def _encode():
+                    collector.PAYLOADFORMAT = fmt
+                    collector._encodeOptionsTable(calls)
+
+                size = len(
+                    payload if isinstance(payload, bytes) else payload.encode()
+                    )
+                paths = [
+                    ('encode', _encode, n, size),
+                    ('proxy table',
+                        lambda: proxy._decodeOptionsTable(item['calls']),
+                        n, size),
+                    ('proxy item', lambda: proxy._decodeItem(item), 2 * n,
+                        size),
+                    ('client', lambda: decodeResponse(response), 2 * n,
+                        len(response.encode()) / 2)
+                    ]
+                for path, func, count, nbytes in paths:
+                    seconds = _timed(func)
+                    results['/'.join((str(n), columns, fmt, path))] = {
+                        'seconds': seconds,
+                        'rows/s': count / seconds,
+                        'bytes/row': nbytes / n,
+                        'peak': _peak(func)
+                        }
+    return results
+
+
+def report(results, baseline=None, tolerance=1.25):
+    """ Print the results, against baseline when given. Returns the
+    keys that regressed """
+
+    regressed = []
+    print("{:>6} {:>7} {:>6} {:<12} {:>11} {:>12} {:>10} {:>9}{}".format(
+        "rows", "columns", "format", "path", "us/call", "rows/s",
+        "bytes/row", "peak KB", "  vs baseline" if baseline else ""))
+    for key, result in results.items():
+        rows, columns, fmt, path = key.split('/')
+        line = "{:>6} {:>7} {:>6} {:<12} {:>11.1f} {:>12,.0f} {:>10.1f} " \
+            "{:>9.1f}".format(
+                rows, columns, fmt, path, 1e6 * result['seconds'],
+                result['rows/s'], result['bytes/row'],
+                result['peak'] / 1024.)
+        if baseline is not None and key in baseline:
+            ratio = result['seconds'] / baseline[key]['seconds']
+            grew = result['bytes/row'] > baseline[key]['bytes/row']
+            line += "  {:>5.2f}x{}".format(ratio, " bytes" if grew else "")
+            if ratio > tolerance or grew:
+                regressed.append(key)
+                line += "  REGRESSION"
+        print(line)
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, nargs='+', default=ROWS)
+    parser.add_argument(
+        '--formats', nargs='+', default=FORMATS, choices=FORMATS)
+    parser.add_argument(
+        '--columns', nargs='+', default=list(COLUMNSETS),
+        choices=list(COLUMNSETS))
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    args = parser.parse_args()
+
+    results = run(args.rows, args.formats, args.columns)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressed = report(results, baseline, args.tolerance)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if len(regressed) > 0:
+        sys.exit(1)
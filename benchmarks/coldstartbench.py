@@ -0,0 +1,178 @@
+"""
+Cold start benchmark for the collector, per handler state
+
+Runs every handler state in fresh python processes, as a cold Lambda
+container would, against the replay server of replaybench.py and prints
+the cold start record the handler logs: seconds of module init, the
+deferred modules and AWS resources it built, the seconds the invocation
+waited on them and the total against COLDSTARTBUDGETMS. The most
+expensive packages to import are printed after the table.
+
+Usage:
+    -------------------------------------------------------------------
+    python benchmarks/coldstartbench.py FIXTURES [--runs N]
+        [--states initialize continue work] [--latency MS] [--no-preload]
+
+FIXTURES is a directory recorded with replaybench.py record. The boto3
+resources are built for real, only their API calls are answered in
+process (see _api_call) so nothing leaves the machine, the work state
+receives an item per ticker off a stand in work queue. --no-preload
+runs with PRELOAD=FALSE to compare against building everything on
+first use.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchcommon import collectorEnvironment
+
+STATES = ['initialize', 'continue', 'work']
+
+
+def _api_call(tickers, run_timestamp):
+    """ Stand in for BaseClient._make_api_call answering every call the
+    collector makes. The DynamoDB resources (de)serialize from inside
+    it, so items are plain python. The work queue hands out an item
+    per ticker of run_timestamp once """
+
+    messages = [
+        {
+            'MessageId': str(i), 'ReceiptHandle': str(i),
+            'Body': json.dumps({
+                'run_timestamp': run_timestamp, 'Ticker': ticker
+                })
+            }
+        for i, ticker in enumerate(tickers)
+        ]
+
+    def _make_api_call(self, operation, kwargs):
+        if operation == 'Query' and kwargs['TableName'] == \
+                'OptionsHistTickers':
+            return {'Items': [{'Ticker': ticker} for ticker in tickers]}
+        if operation in ('Query', 'Scan'):
+            return {'Items': []}
+        if operation == 'BatchWriteItem':
+            return {'UnprocessedItems': {}}
+        if operation == 'ReceiveMessage':
+            count = kwargs['MaxNumberOfMessages']
+            received = messages[:count]
+            del messages[:count]
+            return {'Messages': received}
+        if operation == 'GetQueueAttributes':
+            return {'Attributes': {
+                'ApproximateNumberOfMessages': str(len(messages)),
+                'ApproximateNumberOfMessagesNotVisible': '0'
+                }}
+        return {}
+
+    return _make_api_call
+
+
+def child(state, fixtures, url):
+    """ One cold invocation, prints its cold start record as JSON """
+
+    os.environ['IMPORTPROFILE'] = 'TRUE'
+    if state == 'work':
+        os.environ['WORKQUEUESQS'] = \
+            'https://sqs.us-east-2.amazonaws.com/000000000000/benchmark'
+    collectorEnvironment(
+        DBWRITECAPACITY='0', HASHWRITECAPACITY='0', HASHREADCAPACITY='0',
+        EMFNAMESPACE=''
+        )
+
+    import index
+    import botocore.client
+
+    tickers = sorted(os.listdir(fixtures))
+    run_timestamp = time.time_ns()
+    botocore.client.BaseClient._make_api_call = _api_call(
+        tickers, run_timestamp
+        )
+    index.OPTIONSURL = url
+    records = []
+    report = index._report_cold_start
+    index._report_cold_start = lambda state: records.append(report(state))
+
+    class Context(object):
+        def get_remaining_time_in_millis(self):
+            return 300000
+
+    event = {'State': state}
+    if state == 'continue':
+        event.update({'Tickers': tickers, 'run_timestamp': run_timestamp})
+    elif state == 'work':
+        event['run_timestamp'] = run_timestamp
+    index.handler(event, Context())
+    print(json.dumps(records[0]))
+
+
+def main(fixtures, runs, states, latency, preload):
+    from replaybench import _serve, _free_port
+
+    port = _free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=_serve, daemon=True,
+        args=(fixtures, port, latency / 1000., 0., 0., 0., ready)
+        )
+    server.start()
+    if not ready.wait(30):
+        raise SystemExit("Replay server didn't start")
+    env = dict(os.environ, PRELOAD='TRUE' if preload else 'FALSE')
+
+    print("{:<11} {:>5} {:>8} {:>8} {:>8} {:>8}  {}".format(
+        "state", "runs", "init", "blocked", "total", "budget", "loads"))
+    try:
+        for state in states:
+            records = [
+                json.loads(subprocess.run(
+                    [sys.executable, '-W', 'ignore', __file__, '--child',
+                     state, fixtures, 'http://127.0.0.1:{}'.format(port)],
+                    env=env, check=True, stdout=subprocess.PIPE,
+                    universal_newlines=True
+                    ).stdout.strip().split('\n')[-1])
+                for _ in range(runs)
+                ]
+            loads = {
+                name: statistics.median(
+                    record['loads'].get(name, 0.) for record in records
+                    )
+                for name in records[0]['loads']
+                }
+            print("{:<11} {:>5} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}  "
+                  "{}".format(
+                      state, runs,
+                      statistics.median(r['init'] for r in records),
+                      statistics.median(r['blocked'] for r in records),
+                      statistics.median(r['total'] for r in records),
+                      records[0]['budget'],
+                      ", ".join("{} {:.3f}".format(name, seconds)
+                                for name, seconds in loads.items())
+                      ))
+        print("Imports (seconds, last run) -- {}".format(
+            json.dumps(records[-1]['imports']['packages'])))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(*sys.argv[2:5])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('fixtures')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--states', nargs='+', default=STATES, choices=STATES)
+    parser.add_argument('--latency', type=float, default=100)
+    parser.add_argument('--no-preload', action='store_true')
+    args = parser.parse_args()
+
+    main(args.fixtures, args.runs, args.states, args.latency,
+         not args.no_preload)
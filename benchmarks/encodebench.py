@@ -0,0 +1,85 @@
+"""
+Micro-benchmark for the numeric conversion in _encodeOptionsTable
+
+Compares _encodeOptionsTable with the old cell by cell conversion (map
+_string2Number over optstab.flatten()) against the vectorized column
+conversion it uses now. Prints numeric cells/sec for chains of 20, 200
+and 2,000 rows and checks both give byte identical items.
+
+Usage:
+    -------------------------------------------------------------------
+    python benchmarks/encodebench.py [rows ...]
+
+Requires the collectdatafunc layer packages (numpy, pandas, lxml, boto3)
+in the local python environment. No AWS calls are made, the environment
+variables the collector reads at import are given dummy values (see
+benchcommon.collectorEnvironment).
+"""
+
+import base64
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from benchcommon import collectorEnvironment, syntheticChain
+
+collectorEnvironment()
+# Compare against the JSON payload the legacy encoder produced
+os.environ['PAYLOADFORMAT'] = 'json'
+
+import index  # noqa: E402
+
+ROWS = [20, 200, 2000]
+REPEATS = 5
+
+
+def legacyEncode(optstab):
+    """ _encodeOptionsTable as it was with the cell by cell conversion """
+
+    record = {}
+    optstab = optstab.drop(['Contract Name'], axis=1)
+    record['Last Trade Date'] = list(optstab['Last Trade Date'])
+    optstab = optstab.drop(['Last Trade Date'], axis=1)
+    record['Column Labels'] = list(optstab.keys())
+    optstab = optstab.to_numpy()
+    record['Shape'] = base64.b64encode(
+        np.array(optstab.shape, dtype=np.int32).tobytes()
+        ).decode('ascii')
+    record['Table'] = base64.b64encode(
+            np.array(
+                list(map(index._string2Number, optstab.flatten())),
+                dtype=np.float16
+                ).tobytes()
+            ).decode('ascii')
+    return json.dumps(record)
+
+
+def _cellsPerSec(func, optstab):
+    cells = len(optstab) * (len(optstab.columns) - 2)
+    best = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func(optstab)
+        best = min(best, time.perf_counter() - start)
+    return cells / best
+
+
+def main(rows):
+    print("{:>8} {:>16} {:>16} {:>8}".format(
+        "rows", "before cells/s", "after cells/s", "speedup"))
+    for n in rows:
+        optstab = syntheticChain(n)
+        if legacyEncode(optstab) != index._encodeOptionsTable(optstab):
+            raise AssertionError(
+                "Encoded tables differ for {} rows".format(n))
+        before = _cellsPerSec(legacyEncode, optstab)
+        after = _cellsPerSec(index._encodeOptionsTable, optstab)
+        print("{:>8} {:>16,.0f} {:>16,.0f} {:>7.1f}x".format(
+            n, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or ROWS)
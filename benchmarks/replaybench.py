@@ -0,0 +1,324 @@
+"""
+Record and replay benchmark for the collector pipeline
+
+record saves every options page a collection run gets from
+finance.yahoo.com to a fixture directory. replay serves those pages from
+a local aiohttp stand-in for the site, with latency, jitter and failure
+injection, and runs the collector handler (all five stages of
+async_handler) against it. Prints tickers/sec, chains/sec, bytes/sec on
+the wire and peak RSS for each run, so concurrency and parser changes
+can be compared on the same pages.
+
+Usage:
+    -------------------------------------------------------------------
+    python benchmarks/replaybench.py record FIXTURES TICKER [TICKER ...]
+    python benchmarks/replaybench.py replay FIXTURES [--runs N]
+        [--latency MS] [--jitter MS] [--fail RATE] [--blocked RATE]
+        [--db-latency MS] [--timeout SECONDS]
+
+Fixtures are a directory per ticker holding one file per page,
+options.html for the base page and DATE.html for each expiration (DATE
+is the date query parameter of the page). --fail answers that share of
+requests with a 503, --blocked with the company not found page yahoo
+sometimes sends.
+
+Requires the collectdatafunc layer packages (numpy, pandas, lxml,
+aiohttp, boto3) in the local python environment. DynamoDB, SQS and
+Lambda are replaced by in memory stubs, only record makes requests off
+the machine. Collector settings are read from the environment as usual,
+DBWRITECAPACITY defaults to 0 here so writes aren't metered, set
+LOGLEVEL=INFO to see the per stage Pipeline counters of each run and
+EMFNAMESPACE=OptionsHistory for the metrics record the collector prints.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import threading
+import time
+import urllib.parse
+
+from benchcommon import collectorEnvironment
+
+# Writes aren't metered and no metrics record is printed unless asked
+collectorEnvironment(
+    DBWRITECAPACITY='0', HASHWRITECAPACITY='0', HASHREADCAPACITY='0',
+    EMFNAMESPACE=''
+    )
+
+import index  # noqa: E402
+
+# The lambda runtime gives the root logger a handler, nothing does here
+logging.basicConfig(format='%(message)s')
+
+BLOCKEDPAGE = (
+    '<html><head><title>Symbol Lookup from Yahoo Finance</title></head>'
+    '<body>No results for the symbol</body></html>'
+    )
+
+
+def fixturePath(fixtures, ticker, date=None):
+    """ File the page for ticker (and expiration date) is kept in """
+
+    return os.path.join(
+        fixtures, ticker, 'options.html' if date is None else date + '.html'
+        )
+
+
+class Context(object):
+    """ Stand in for the lambda context object """
+    def __init__(self, seconds):
+        super(Context, self).__init__()
+        self.end = time.monotonic() + seconds
+
+    def get_remaining_time_in_millis(self):
+        return int(1000 * (self.end - time.monotonic()))
+
+
+class StubTable(object):
+    """ DynamoDB Table without any stored items """
+    def __init__(self, name):
+        super(StubTable, self).__init__()
+        self.name = name
+
+    def query(self, **kwargs):
+        return {'Items': []}
+
+    def scan(self, **kwargs):
+        return {'Items': []}
+
+
+class StubAWS(object):
+    """
+    Takes the place of the batch_write_item and batch_get_item calls,
+    SQS queue and Lambda client of the collector, keeping what was sent
+    to them
+    """
+    def __init__(self, latency):
+        super(StubAWS, self).__init__()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.items = {}
+        self.messages = []
+        self.invocations = []
+
+    def batch_write_item(self, request_items):
+        # Runs on the collectors writer threads
+        time.sleep(self.latency)
+        consumed = []
+        with self.lock:
+            for name, requests in request_items.items():
+                items = [
+                    request['PutRequest']['Item'] for request in requests
+                    ]
+                self.items.setdefault(name, []).extend(items)
+                consumed.append({
+                    'TableName': name,
+                    'CapacityUnits': float(
+                        sum(map(index._writeUnits, items))
+                        )
+                    })
+        return {'UnprocessedItems': {}, 'ConsumedCapacity': consumed}
+
+    def batch_get_item(self, RequestItems):
+        # Chain hashes off what was written to the hash table
+        time.sleep(self.latency)
+        responses = {}
+        with self.lock:
+            for name, request in RequestItems.items():
+                stored = {
+                    (item['Ticker'], item['Expiration']): item
+                    for item in self.items.get(name, [])
+                    }
+                responses[name] = [
+                    stored[(key['Ticker'], key['Expiration'])]
+                    for key in request['Keys']
+                    if (key['Ticker'], key['Expiration']) in stored
+                    ]
+        return {'Responses': responses}
+
+    def send_messages(self, Entries):
+        self.messages.extend(entry['MessageBody'] for entry in Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+
+
+def install_stubs(latency=0.):
+    """ Point the collectors AWS resources at a new StubAWS """
+
+    stub = StubAWS(latency)
+    index.table = StubTable('OptionsHist')
+    index.ticker_table = StubTable('OptionsHistTickers')
+    index.hash_table = StubTable('OptionsHistChainHashes')
+    index._batch_write_item = stub.batch_write_item
+    index._batch_get_item = stub.batch_get_item
+    index.sqsqueue = stub
+    index.lambdaclient = stub
+    return stub
+
+
+def record(fixtures, tickers, timeout):
+    """ Collect tickers from the site saving every page that comes back """
+
+    fetch = index._fetch_html
+
+    async def _fetch_html(HTTPSession, url, limit):
+        html, seconds = await fetch(HTTPSession, url, limit)
+        parsed = urllib.parse.urlparse(url)
+        ticker = parsed.path.split('/')[2]
+        date = urllib.parse.parse_qs(parsed.query).get('date', [None])[0]
+        path = fixturePath(fixtures, ticker, date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(html)
+        return html, seconds
+
+    index._fetch_html = _fetch_html
+    stub = install_stubs()
+    index.handler(
+        {
+            'State': 'continue', 'Tickers': list(tickers),
+            'run_timestamp': time.time_ns()
+            },
+        Context(timeout)
+        )
+    print("Recorded {} tickers to {}, {} tickers handed off".format(
+        len(os.listdir(fixtures)), fixtures,
+        sum(len(json.loads(call['Payload'])['Tickers'])
+            for call in stub.invocations)
+        ))
+
+
+def _serve(fixtures, port, latency, jitter, fail, blocked, ready):
+    """ Replay server, runs in its own process """
+
+    from aiohttp import web
+
+    async def page(request):
+        await asyncio.sleep(max(0., random.gauss(latency, jitter)))
+        if random.random() < fail:
+            return web.Response(status=503, text='Service Unavailable')
+        path = fixturePath(
+            fixtures, request.match_info['ticker'], request.query.get('date')
+            )
+        if random.random() < blocked or not os.path.exists(path):
+            text = BLOCKEDPAGE
+        else:
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+        response = web.Response(text=text, content_type='text/html')
+        # Compressed like the site when the collector asks for it
+        response.enable_compression()
+        return response
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/quote/{ticker}/options', page)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def replay(fixtures, runs, latency, jitter, fail, blocked, db_latency,
+           timeout):
+    """ Run the collector against the replay server runs times """
+
+    tickers = sorted(
+        ticker for ticker in os.listdir(fixtures)
+        if os.path.exists(fixturePath(fixtures, ticker))
+        )
+    if len(tickers) == 0:
+        raise SystemExit("No recorded tickers in {}".format(fixtures))
+
+    port = _free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=_serve, daemon=True,
+        args=(fixtures, port, latency / 1000., jitter / 1000., fail,
+              blocked, ready)
+        )
+    server.start()
+    if not ready.wait(30):
+        raise SystemExit("Replay server didn't start")
+    index.OPTIONSURL = 'http://127.0.0.1:{}'.format(port)
+
+    print("{} tickers, latency {:g}ms jitter {:g}ms fail {:g} "
+          "blocked {:g}".format(len(tickers), latency, jitter, fail, blocked))
+    print("{:>4} {:>8} {:>8} {:>9} {:>10} {:>9} {:>9} {:>9} {:>7}".format(
+        "run", "tickers", "chains", "seconds", "tickers/s", "chains/s",
+        "KB/s", "RSS MB", "handed"))
+    try:
+        for run in range(runs):
+            stub = install_stubs(db_latency / 1000.)
+            start = time.monotonic()
+            index.handler(
+                {
+                    'State': 'continue', 'Tickers': list(tickers),
+                    'run_timestamp': time.time_ns()
+                    },
+                Context(timeout)
+                )
+            seconds = time.monotonic() - start
+            items = stub.items.get('OptionsHist', [])
+            collected = len(set(item['Ticker'] for item in items))
+            handed = sum(
+                len(json.loads(call['Payload'])['Tickers'])
+                for call in stub.invocations
+                )
+            print("{:>4} {:>8} {:>8} {:>9.2f} {:>10.2f} {:>9.1f} {:>9.1f} "
+                  "{:>9.1f} {:>7}".format(
+                      run, collected, len(items), seconds,
+                      collected / seconds, len(items) / seconds,
+                      index.HTTPSTATS.bytes / seconds / 1024.,
+                      # ru_maxrss is in KB on linux, peak of the process
+                      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                      / 1024., handed
+                      ))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    recorder = commands.add_parser('record')
+    recorder.add_argument('fixtures')
+    recorder.add_argument('tickers', nargs='+')
+    recorder.add_argument('--timeout', type=float, default=900)
+    replayer = commands.add_parser('replay')
+    replayer.add_argument('fixtures')
+    replayer.add_argument('--runs', type=int, default=3)
+    replayer.add_argument('--latency', type=float, default=100)
+    replayer.add_argument('--jitter', type=float, default=30)
+    replayer.add_argument('--fail', type=float, default=0.)
+    replayer.add_argument('--blocked', type=float, default=0.)
+    replayer.add_argument('--db-latency', type=float, default=20)
+    replayer.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.fixtures, args.tickers, args.timeout)
+    else:
+        replay(
+            args.fixtures, args.runs, args.latency, args.jitter, args.fail,
+            args.blocked, args.db_latency, args.timeout
+            )
@@ -2,11 +2,18 @@ import requests
 import pandas as pd
 from datetime import datetime
 import json
-import numpy as np
 import base64
+import os
 import sys
 import re
 
+# The stored tables are decoded with the same module the lambda proxy
+#  function uses, see lambdaproxyfunc/function/optionscodec.py
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'lambdaproxyfunc',
+    'function'))
+from optionscodec import decodeOptionsTable  # noqa: E402
+
 if len(sys.argv) > 1:
     if re.match('[A-Z.]+', sys.argv[1]):
         EXAMPLETICKER = sys.argv[1]
@@ -61,7 +68,8 @@ def decodeResponse(responseString):
         Inputs:
         ----------------------------------------------------------------
         record --> json string that is stored in DynamoDB as attributes
-            'calls' or 'puts'
+            'calls' or 'puts', or the base64 encoded binary payload newer
+            items are stored with
 
         Outputs:
         ----------------------------------------------------------------
@@ -76,19 +84,9 @@ def decodeResponse(responseString):
         if record is None:
             # Calls and Puts table didn't have any data
             return None, None
-        record = json.loads(record)
-        frame = {"Last Trade Date": record["Last Trade Date"]}
-        shape = np.frombuffer(
-            base64.b64decode(record['Shape'].encode('ascii')),
-            dtype=np.int32).astype(int)
-
-        table = np.frombuffer(base64.b64decode(
-            record['Table'].encode('ascii')), dtype=np.float16).reshape(shape)
-
-        for label, data in zip(record['Column Labels'], table.T):
-            frame[label] = data
-
-        return frame, len(table)
+        if not record.startswith('{'):
+            record = base64.b64decode(record)
+        return decodeOptionsTable(record)
         # From here you can just pd.DataFrame(frame)
         # Note here for future use when I use this for something else.
 
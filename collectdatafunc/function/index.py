@@ -4,12 +4,23 @@ Name: OptionsHistory-CollectDataFunc
 
 Inputs Events:
     -------------------------------------------------------------------
-    {"State": "initialize"} --> Get the Collection List and start
+    {"State": "initialize"} --> Get the Collection List and start, split
+        over COLLECTSHARDS concurrent invocations when it's set
     {
         "State": "continue",
         "Tickers": ["AAPL",...]
+        "Chains": [["AAPL", "May 15, 2020", attempt],...] optional
+        "Costs": {"AAPL": expirations,...} optional
+        "Seconds": {"AAPL": seconds per chain,...} optional
         "runs_timestamp": UnixTimeStamp from initial call
-    } --> continue will collection run
+    } --> continue will collection run, Chains are the expirations of
+        tickers the last invocation ran out of time on
+    {"State": "work", "run_timestamp": UnixTimeStamp from initial call}
+        --> collect work items of the run off the WORKQUEUESQS queue
+        until it is drained, initialize starts COLLECTSHARDS of these
+        in place of shards when WORKQUEUESQS is set
+    {"Records": [{"body": work event},...]} --> the delayed work event
+        of WORKWAKESQS, the SQS event source of this function
 
     State must be defined or function will fail
     If State is continue and Tickers doesn't exist fail
@@ -27,39 +38,183 @@ File OverView:
         functions that work together to build a 5 stage asyncio pipeline
         to collect, tranform and store options data
 
-    async def async_handler: constructs all async tasks and starts the
-        pipline
+    async def async_handler: constructs the stages and runs them as a
+        Pipeline, which drains and shuts the stages down once Stage 1
+        is done and logs the counters of each stage (items in and out,
+        busy, blocked and idle time, queue high-water marks, latency)
 
     Pipeline functions:
         Stage 1: async def ticker_handler
-            Fills the queue between Stage 1 and 2 then passed remaining
-            tickers to next invocation of the collection function
+            Fills the queue between Stage 1 and 2, most expensive
+            tickers first, for as long as the DeadlineScheduler predicts
+            the work fits in the invocation then passed remaining
+            tickers to next invocation of the collection function.
+            Collectors pulling from a work queue run async def
+            work_handler in its place
         Stage 2: async def get_expiration_dates
             Get the exipration dates for a ticker and stage the values
-            for stage 3
+            for stage 3, the chain for the nearest expiration comes with
+            the same page and is handed straight to stage 4
         Stage 3: async def chain_request
             Makes http requests to get the data for a (ticker, expiration)
+            failed requests are retried by async def retry_chain_request,
+            so are the base pages of Stage 2
         Stage 4: async def encode_db_item
             Transform the data in to a JSON document for insertion in
-            DynamoDB
+            DynamoDB, chains unchanged since the last stored copy become
+            a small item pointing back to it (SameAs)
         Stage 5: async def put_db_item
-            Makes put calls to DynamoDB to store the data
+            Makes batch put calls to DynamoDB to store the data, metered
+            against the tables write capacity (see MeteredWriter). The
+            calls run on DBWRITERS writer threads off the event loop
+
+    The CPU bound work of stage 3 (parsing) and stage 4 (encoding) is
+        handed to a thread or process pool when EXECUTORMODE is set
+
+    The queues into stage 4 and 5 are bounded by the bytes they hold as
+        well as their items, and a MemoryWatchdog cuts the request
+        concurrency when RSS nears the memory of the function
+
+    numpy, pandas, lxml, aiohttp and the AWS resources are Deferred,
+        built on first use or by a preload thread once the handler knows
+        it's collecting. Each invocation logs what it paid for them and
+        the module init against COLDSTARTBUDGETMS, IMPORTPROFILE adds the
+        cost of every module imported
 """
 
 
 import base64
-import boto3
+import hashlib
+import importlib
+import lzma
+import struct
+import sys
+import zlib
 import json
 import os
 import asyncio
-import aiohttp
-import numpy as np
-import pandas as pd
-from datetime import datetime
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+import itertools
+import functools
+import collections
+import contextvars
+import heapq
+import gc
+import math
+import random
 import time
-from boto3.dynamodb.conditions import Key
+import uuid
 import logging
 
+# Module init starts, cold starts are measured from here (see COLDSTART)
+INITSTART = time.perf_counter()
+
+
+class ImportTimer(object):
+    """
+    sys.meta_path finder timing every module imported while it is
+    installed. Defined ahead of the third party imports so they can be
+    timed, see IMPORTPROFILE
+
+    Times are in seconds, inclusive of the modules a module imports and
+    its own (self) time without them
+    """
+    def __init__(self):
+        super(ImportTimer, self).__init__()
+        # {module name: (inclusive, self)}
+        self.times = {}
+        # Child time of the modules being executed, per thread since the
+        #  preload thread imports next to the handler
+        self.local = threading.local()
+
+    def find_spec(self, name, path=None, target=None):
+        # Let the finders behind this one find it, then time its loader
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(self, spec.loader)
+        return spec
+
+    def executed(self, name, seconds, children):
+        """ Record a module that took seconds, children of them in
+        imports """
+
+        stack = self.local.stack
+        if len(stack) > 0:
+            stack[-1] += seconds
+        self.times[name] = (seconds, seconds - children)
+
+    def summary(self, top=10):
+        """
+        (int) --> {"modules": {name: [inclusive, self]} of the top most
+            expensive modules by self time, "packages": {name: self time
+            of all its modules}}
+        """
+
+        packages = collections.Counter()
+        for name, (_, own) in list(self.times.items()):
+            packages[name.split('.')[0]] += own
+        modules = heapq.nlargest(
+            top, list(self.times.items()), key=lambda item: item[1][1]
+            )
+        return {
+            'modules': {
+                name: [round(seconds, 4), round(own, 4)]
+                for name, (seconds, own) in modules
+                },
+            'packages': {
+                name: round(seconds, 4)
+                for name, seconds in packages.most_common(top)
+                }
+            }
+
+
+class _TimedLoader(object):
+    """ Wraps the loader of a module for ImportTimer """
+    def __init__(self, timer, loader):
+        super(_TimedLoader, self).__init__()
+        self.timer = timer
+        self.loader = loader
+
+    def __getattr__(self, attr):
+        return getattr(self.loader, attr)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        local = self.timer.local
+        if not hasattr(local, 'stack'):
+            local.stack = []
+        local.stack.append(0.)
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            children = local.stack.pop()
+            self.timer.executed(
+                module.__name__, time.perf_counter() - start, children
+                )
+
+
+# "TRUE" times the imports of the function from here on and logs the most
+#  expensive modules with the cold start record of the invocation
+IMPORTPROFILE = os.environ.get('IMPORTPROFILE', 'FALSE') == 'TRUE'
+IMPORTTIMER = None
+if IMPORTPROFILE:
+    IMPORTTIMER = ImportTimer()
+    sys.meta_path.insert(0, IMPORTTIMER)
+
+import boto3  # noqa: E402
+from boto3.dynamodb.conditions import Key, Attr  # noqa: E402
 
 if os.environ.get("XRAYACTIVATED") is not None:
     # Xray Has been activated for the stack, patch calls to AWS services
@@ -69,433 +224,3330 @@ if os.environ.get("XRAYACTIVATED") is not None:
     # Patch for X-Ray Tracing to DynamoDB and AWS API calls
     patch_all()
 
-# Initialize logging module for the lambda function
-logger = logging.getLogger()
-logger.setLevel(getattr(logging, os.environ['LOGLEVEL']))
+# Initialize logging module for the lambda function
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ['LOGLEVEL']))
+
+# Cold start record of the container {"init": seconds of module init,
+#  "loads": {global: seconds to build it}, "blocked": seconds the
+#  invocation waited on them}. Reset after each invocation, so warm
+#  invocations only report the deferred loads they paid for
+COLDSTART = {'init': 0., 'loads': {}, 'blocked': 0.}
+# Cold start budget of each handler state in milliseconds, module init
+#  plus waiting on deferred loads. About three times what
+#  benchmarks/coldstartbench.py measures on a workstation (0.7 and 1.5
+#  seconds), the Lambda's share of a CPU is smaller. work measures about
+#  1.2 times initialize, it builds the work queue on top. Any other
+#  state only pays the module init and is held to the initialize budget.
+#  Invocations over it log a warning
+COLDSTARTBUDGETMS = {
+    'initialize': int(os.environ.get('INITIALIZEBUDGETMS', 2000)),
+    'continue': int(os.environ.get('CONTINUEBUDGETMS', 4500)),
+    'work': int(os.environ.get('WORKBUDGETMS', 2500))
+    }
+
+
+class Deferred(object):
+    """
+    Stands in for a module global, a heavy module or an AWS resource,
+    that is only built the first time one of its attributes is used. It
+    then takes its place in the module globals so later lookups go
+    straight to the real object. Thread safe, the preload thread and the
+    handler wait on the same build
+    """
+    def __init__(self, name, load):
+        super(Deferred, self).__init__()
+        # Underscored, attribute lookups fall through to the real object
+        self._name = name
+        self._load = load
+        self._value = None
+        self._lock = threading.Lock()
+
+    # Set while a thread builds a deferred global, the ones it builds on
+    #  the way (a table and its DynamoDB resource) aren't waited on twice
+    _building = threading.local()
+
+    def _resolve(self):
+        if self._value is not None:
+            return self._value
+        nested = getattr(Deferred._building, 'active', False)
+        Deferred._building.active = True
+        start = time.perf_counter()
+        try:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._load()
+                    COLDSTART['loads'][self._name] = (
+                        time.perf_counter() - start
+                        )
+                    if globals().get(self._name) is self:
+                        globals()[self._name] = self._value
+        finally:
+            Deferred._building.active = nested
+        if not nested and threading.current_thread().name != 'preload':
+            COLDSTART['blocked'] += time.perf_counter() - start
+        return self._value
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+
+def _import(module, package=None):
+    """
+    Helper Function
+    Import module, returns it or the package it's a part of
+    """
+
+    importlib.import_module(module)
+    return sys.modules[module if package is None else package]
+
+
+# Heavy modules, only collection runs need them. Imported on first use
+#  or by the preload thread while the handler waits on the network
+np = Deferred('np', functools.partial(_import, 'numpy'))
+pd = Deferred('pd', functools.partial(_import, 'pandas'))
+lxml = Deferred('lxml', functools.partial(_import, 'lxml.etree', 'lxml'))
+aiohttp = Deferred('aiohttp', functools.partial(_import, 'aiohttp'))
+# "FALSE" leaves every deferred global to be built when first used
+PRELOAD = os.environ.get('PRELOAD', 'TRUE') == 'TRUE'
+# Deferred globals the preload thread builds, in order of first use
+PRELOADGLOBALS = ('aiohttp', 'np', 'pd', 'lxml', 'sqsqueue')
+# The preload thread of the container, once started
+PRELOADER = None
+
+# Played around, these seem to work the best to saturate the Lambda's
+# ENI and stays with in current memory setting for this function as well
+# keeps the write capacity units (WRUs) for DynamoDB under 8. Now the
+# starting point for the adaptive concurrency controller below
+TICKERQUEUESIZE = int(os.environ['TICKERQUEUESIZE'])
+MAXCONNECTIONS = int(os.environ['MAXCONNECTIONS'])
+
+# Bounds for the adaptive concurrency controller. The number of
+#  chain_request workers making requests at once moves between
+#  CONCURRENCYMIN and CONCURRENCYMAX starting at MAXCONNECTIONS,
+#  get_expiration_dates workers are kept in the same ratio as
+#  TICKERQUEUESIZE to MAXCONNECTIONS. The limit is adjusted every
+#  CONCURRENCYWINDOW requests
+CONCURRENCYMIN = int(os.environ.get('CONCURRENCYMIN', 2))
+CONCURRENCYMAX = int(os.environ.get('CONCURRENCYMAX', 2 * MAXCONNECTIONS))
+CONCURRENCYWINDOW = int(os.environ.get('CONCURRENCYWINDOW', 20))
+# Adaptive controller for the running invocation
+CONTROLLER = None
+
+# Byte budgets of the queues between Stage 3 and 4 (parsed tables) and
+#  Stage 4 and 5 (encoded items) on top of their item counts. Producers
+#  wait while a queue holds more than its budget of approximate bytes,
+#  see ByteBudgetQueue. A queue always takes one item so a chain bigger
+#  than the budget still gets through. 0 bounds them by count only
+TABLEQUEUEBYTES = int(os.environ.get('TABLEQUEUEBYTES', 32 * 2 ** 20))
+ITEMQUEUEBYTES = int(os.environ.get('ITEMQUEUEBYTES', 16 * 2 ** 20))
+# Bytes counted for each distinct string of a table, on top of its
+#  pointer
+STRINGBYTES = 64
+# Seconds the running Stage handler call has been blocked in Stage.put,
+#  every worker task has its own so it only sees its own puts
+STAGEBLOCKED = contextvars.ContextVar('STAGEBLOCKED', default=0.)
+
+# RSS watchdog, see MemoryWatchdog. Every WATCHDOGINTERVAL seconds the
+#  resident memory of the function is checked against the memory it's
+#  configured with. Past WATCHDOGHIGH of it the request concurrency is
+#  cut, and cut again for every WATCHDOGSTEP it grows after, past
+#  WATCHDOGCRITICAL it drops to CONCURRENCYMIN. The controller doesn't
+#  raise the limit while RSS is past WATCHDOGHIGH
+MEMORYMB = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 384))
+WATCHDOGINTERVAL = float(os.environ.get('WATCHDOGINTERVAL', .25))
+WATCHDOGHIGH = float(os.environ.get('WATCHDOGHIGH', .7))
+WATCHDOGCRITICAL = float(os.environ.get('WATCHDOGCRITICAL', .85))
+WATCHDOGSTEP = float(os.environ.get('WATCHDOGSTEP', .05))
+
+# Site the options pages are requested from, benchmarks/replaybench.py
+#  points it at a local server replaying recorded pages
+OPTIONSURL = os.environ.get('OPTIONSURL', 'https://finance.yahoo.com')
+
+# HTTP layer configuration, timeouts in seconds. HTTPACCEPTENCODING of
+#  "identity" turns compression off. HTTPLIMITPERHOST of 0 is no limit
+HTTPACCEPTENCODING = os.environ.get('HTTPACCEPTENCODING', 'gzip, deflate')
+HTTPCONNECTTIMEOUT = float(os.environ.get('HTTPCONNECTTIMEOUT', 5))
+HTTPREADTIMEOUT = float(os.environ.get('HTTPREADTIMEOUT', 15))
+HTTPTOTALTIMEOUT = float(os.environ.get('HTTPTOTALTIMEOUT', 30))
+HTTPLIMITPERHOST = int(os.environ.get('HTTPLIMITPERHOST', 0))
+HTTPDNSCACHETTL = int(os.environ.get('HTTPDNSCACHETTL', 300))
+HTTPKEEPALIVE = float(os.environ.get('HTTPKEEPALIVE', 30))
+# Per request timings of the running invocation
+HTTPSTATS = None
+
+# CloudWatch namespace of the Embedded Metric Format record every
+#  invocation prints (see EmbeddedMetrics), "" turns the record off
+EMFNAMESPACE = os.environ.get('EMFNAMESPACE', 'OptionsHistory')
+# Throughput counters of the running invocation
+METRICS = None
+
+# Retries of failed chain requests. Each (ticker, expiration) gets up to
+#  RETRYATTEMPTS retries backing off RETRYBASEDELAY * 2 ** attempt
+#  seconds (full jitter, capped at RETRYMAXDELAY). Retries that would
+#  come due past the deadline (see DEADLINEMS) go to the next invocation
+RETRYATTEMPTS = int(os.environ.get('RETRYATTEMPTS', 2))
+RETRYBASEDELAY = float(os.environ.get('RETRYBASEDELAY', 1))
+RETRYMAXDELAY = float(os.environ.get('RETRYMAXDELAY', 8))
+# Tie breaker for retries due at the same time in the PriorityQueue
+RETRYSEQUENCE = itertools.count()
+
+# Stage 1 admits tickers for as long as the chains already admitted are
+#  predicted to be collected DEADLINEMS before the invocation times out
+#  (see DeadlineScheduler). At that deadline requests in flight are
+#  cancelled and the tickers and chains left are handed to the next
+#  invocation, the time after it is for Stage 4 and 5 to drain
+DEADLINEMS = int(os.environ.get('DEADLINEMS', 20000))
+# Seconds a chain takes per connection until the rate has been measured
+DEADLINECHAINSECONDS = float(os.environ.get('DEADLINECHAINSECONDS', 2))
+# Number of the most recently collected chains the rate is measured over
+DEADLINEWINDOW = int(os.environ.get('DEADLINEWINDOW', 50))
+# DeadlineScheduler of the current invocation
+SCHEDULER = None
+
+# Write capacity budgets (WCU per second) the put_db_item stage meters
+#  its batch writes against, the provisioned WriteCapacityUnits of
+#  OptionsHist and OptionsHistChainHashes. 0 turns metering off (on
+#  demand tables). Like DynamoDB up to DBWRITEBURST seconds of unused
+#  capacity can be spent at once, the saved up capacity is dropped the
+#  first time a write is throttled
+DBWRITECAPACITY = float(os.environ.get('DBWRITECAPACITY', 8))
+HASHWRITECAPACITY = float(os.environ.get('HASHWRITECAPACITY', 4))
+DBWRITEBURST = float(os.environ.get('DBWRITEBURST', 300))
+# UnprocessedItems and throttled batches are retried up to
+#  DBWRITEATTEMPTS times backing off DBWRITEBASEDELAY * 2 ** attempt
+#  seconds (full jitter, capped at DBWRITEMAXDELAY)
+DBWRITEATTEMPTS = int(os.environ.get('DBWRITEATTEMPTS', 8))
+DBWRITEBASEDELAY = float(os.environ.get('DBWRITEBASEDELAY', .1))
+DBWRITEMAXDELAY = float(os.environ.get('DBWRITEMAXDELAY', 5))
+# Metered writers of the running invocation
+DBWRITER = None
+HASHWRITER = None
+# Read capacity budget (RCU per second) the chain hashes are read
+#  against, the provisioned ReadCapacityUnits of OptionsHistChainHashes.
+#  Keys known within HASHBATCHSECONDS of each other are read in one
+#  batch_get_item (see ChainHashes)
+HASHREADCAPACITY = float(os.environ.get('HASHREADCAPACITY', 4))
+HASHBATCHSECONDS = float(os.environ.get('HASHBATCHSECONDS', .2))
+# Number of put_db_item workers, each hands its batches to one of as
+#  many writer threads so DynamoDB round trips don't block the event loop
+DBWRITERS = int(os.environ.get('DBWRITERS', 2))
+# Writer threads built on first use and reused by warm invocations
+DBEXECUTOR = None
+# DynamoDB resource of each writer thread, boto3 resources aren't
+#  thread safe
+DBRESOURCES = threading.local()
+
+# On initialize the collection list is split into at most COLLECTSHARDS
+#  shards of about SHARDCHAINS chains each, every shard is collected by
+#  its own concurrent invocation (and its continue invocations) under
+#  the same run_timestamp. 1 keeps a single chain of invocations. With
+#  WORKQUEUESQS set there are no shards, COLLECTSHARDS is the number of
+#  collectors started on the queue and SHARDCHAINS isn't used
+COLLECTSHARDS = int(os.environ.get('COLLECTSHARDS', 1))
+SHARDCHAINS = int(os.environ.get('SHARDCHAINS', 600))
+
+# SQS queue the collection work is distributed over, "" hands the work
+#  down the chains of continue invocations in their event payloads.
+#  With a queue initialize enqueues a work item per ticker and starts
+#  COLLECTSHARDS collectors that pull items (State "work") until the
+#  queue is drained, see WorkQueue. The queues VisibilityTimeout has to
+#  outlast the function timeout, the items of an invocation that dies
+#  become visible again after it
+WORKQUEUESQS = os.environ.get('WORKQUEUESQS', '')
+# Seconds a receive long polls the queue (SQS waits up to 20)
+WORKQUEUEWAIT = int(os.environ.get('WORKQUEUEWAIT', 10))
+# Items per SQS call (SQS takes up to 10) and attempts at each call
+WORKQUEUEBATCH = 10
+WORKQUEUEATTEMPTS = int(os.environ.get('WORKQUEUEATTEMPTS', 4))
+# SQS queue of delayed work events, an event source of this function.
+#  A collector that stops while items are still in flight sends one
+#  WORKWAKESECONDS out (SQS delays up to 900), the work queues
+#  VisibilityTimeout, so the items of a collector that died have a
+#  collector once they're visible again. "" leaves them to collectors
+#  that are still running
+WORKWAKESQS = os.environ.get('WORKWAKESQS', '')
+WORKWAKESECONDS = int(os.environ.get('WORKWAKESECONDS', 360))
+
+# Skip storing chains that haven't changed since the last stored copy,
+#  set to anything but TRUE to store every chain on every run
+DEDUPCHAINS = os.environ.get('DEDUPCHAINS', 'TRUE') == 'TRUE'
+# Days a chain hash is kept past its expiration date. Rows carry the
+#  time to delete them as ExpiresAt (epoch seconds), the time to live
+#  attribute of OptionsHistChainHashes, so the table only holds listed
+#  expirations and the Scan in _load_ticker_costs stays that size
+CHAINHASHDAYS = int(os.environ.get('CHAINHASHDAYS', 2))
+
+# Format of the calls and puts attributes stored in DynamoDB. "json" is
+#  the original base64 in JSON String attribute, "zlib" or "lzma" store
+#  a compressed versioned payload in a Binary attribute (see PAYLOAD*)
+PAYLOADFORMAT = os.environ.get('PAYLOADFORMAT', 'zlib').lower()
+# Binary payload layout:
+#  PAYLOADMAGIC, version (1 byte), compression (1 byte), compressed body
+#  version 2 body: header length (uint32 little endian), JSON header
+#   {"Last Trade Date", "Column Labels", "Shape"}, float16 table bytes
+#  version 3 body: header length (uint32 little endian), JSON header
+#   {"Rows", "Columns", "Dictionaries"}, one block per dtype in
+#   PAYLOADDTYPES + float64 order holding its columns one after the
+#   other, each block padded to 8 bytes. "Columns" lists [label, dtype,
+#   exponent, base] for each column in table order.
+#   Columns listed in "Dictionaries" hold indexes into the list of
+#   their distinct strings with exponent and base 0
+#  version 4: compressed body length (uint32 little endian) between the
+#   compression and the compressed body, the raw byte planes after it.
+#   The body is PAYLOADHEADER, one kind byte per column, the labels
+#   and the Last Trade Date strings joined by "\0" padded to 8 bytes,
+#   the float64 base and divisor of every integer column, the byte
+#   planes of the integer codes padded to 8 bytes, then the float64
+#   columns, see _encodeColumns
+PAYLOADMAGIC = b'OH'
+PAYLOADVERSION = 4
+# Compression byte, 1 is the zlib stream of versions 2 and 3. Version 4
+#  is a raw deflate stream, it has no checksum to compute on every read
+PAYLOADCOMPRESSION = {'zlib': 3, 'lzma': 2}
+# rows, text bytes, columns, integer columns, code width, flags and the
+#  number of raw planes of a version 4 body
+PAYLOADHEADER = struct.Struct('<IIHHBBB')
+# Kinds of column in a version 4 body, scaled integers, float64, one
+#  string per row or a code per row into the distinct strings
+PAYLOADINTEGERS, PAYLOADFLOATS, PAYLOADSTRINGS, PAYLOADDICTIONARY = range(4)
+# Header flag set when an integer code marks NaN
+PAYLOADHASMISSING = 1
+# Bytes per integer code, codes stay below 2 ** 32 so a reader can sum
+#  the byte planes in float64 exactly
+PAYLOADWIDTHS = (1, 2, 4)
+# Low byte planes that compress by less than this fraction are stored
+#  raw after the compressed body, inflating them costs more than the
+#  bytes they save
+PAYLOADRAWSAVING = .3
+# Shorter planes always go in the compressed body, compressed on their
+#  own the block overhead hides what they'd save
+PAYLOADRAWBYTES = 512
+# Unsigned dtypes of the dictionary codes, see _unsignedDtype
+PAYLOADDTYPES = ('<u1', '<u2', '<u4', '<u8')
+# Largest decimal exponent tried when scaling a column to integers,
+#  columns that need more digits are stored as float64
+PAYLOADMAXEXPONENT = 6
+# Most Last Trade Dates of a table distinct (more than this fraction of
+#  its rows) are stored as one string per row, otherwise as codes into
+#  the distinct dates
+PAYLOADDISTINCTDATES = .5
+
+# Columns of the options tables that hold strings, every other column
+#  is converted to a number when the table is extracted. Last Trade
+#  Date is dictionary encoded, the rest aren't stored so they're dropped
+#  (see OptionsTable)
+STRINGCOLUMNS = ('Contract Name', 'Last Trade Date')
+# lxml parsers used to extract the calls and puts tables, one per
+#  thread so executor threads don't serialize on a shared parser
+HTMLPARSERS = threading.local()
+
+# Executor for the CPU bound parse (Stage 3) and encode (Stage 4) work
+#  EXECUTORMODE "thread" or "process" runs them off the event loop so
+#  sockets keep being serviced while a chain parses, anything else runs
+#  them inline on the loop. Sized from the vCPUs available to the function
+EXECUTORMODE = os.environ.get('EXECUTORMODE', '').lower()
+EXECUTORWORKERS = int(os.environ.get(
+    'EXECUTORWORKERS', len(os.sched_getaffinity(0))
+    ))
+# Max parse/encode jobs handed to the executor at once, every job holds
+#  a page or table in memory so this bounds the memory used by the pool
+EXECUTORMAXINFLIGHT = int(os.environ.get(
+    'EXECUTORMAXINFLIGHT', 2 * EXECUTORWORKERS
+    ))
+# Built on first use and reused by warm invocations
+EXECUTOR = None
+# asyncio.Semaphore bounding the in flight executor jobs per invocation
+EXECUTORSLOTS = None
+
+# The default boto3 session can't build clients on two threads at once
+AWSLOCK = threading.Lock()
+
+
+def _aws(build, *args):
+    """
+    Helper Function
+    boto3.resource or boto3.client(*args) under AWSLOCK
+    """
+
+    with AWSLOCK:
+        return build(*args)
+
+
+# AWS service clients and resources, built on first use (see Deferred)
+#  one DynamoDB resource serves all three tables, the lambda client is
+#  only needed by invocations that hand work off
+NOTREACHABLESQS = os.environ['NOTREACHABLESQS']
+dynamodb = Deferred('dynamodb', functools.partial(
+    _aws, boto3.resource, 'dynamodb'
+    ))
+table = Deferred('table', lambda: dynamodb.Table("OptionsHist"))
+ticker_table = Deferred(
+    'ticker_table', lambda: dynamodb.Table("OptionsHistTickers")
+    )
+hash_table = Deferred(
+    'hash_table', lambda: dynamodb.Table("OptionsHistChainHashes")
+    )
+lambdaclient = Deferred('lambdaclient', functools.partial(
+    _aws, boto3.client, 'lambda'
+    ))
+sqsqueue = Deferred('sqsqueue', lambda: _aws(
+    boto3.resource, 'sqs'
+    ).Queue(NOTREACHABLESQS))
+workqueue = Deferred('workqueue', lambda: _aws(
+    boto3.resource, 'sqs'
+    ).Queue(WORKQUEUESQS))
+wakequeue = Deferred('wakequeue', lambda: _aws(
+    boto3.resource, 'sqs'
+    ).Queue(WORKWAKESQS))
+
+# USED to collect all the unreachable messages to be sent to SQS
+#  for update of the OptionsHistTicker Table, see UnreachableMessages
+UNREACHABLEMESSAGES = None
+# The report is streamed to SQS during the run in messages of at most
+#  UNREACHABLEMESSAGEBYTES of JSON, sent UNREACHABLEBATCH at a time with
+#  send_message_batch (SQS takes up to 10 messages and 256KB a call). A
+#  partial message and batch go out once the oldest failure of the
+#  message is UNREACHABLEFLUSHSECONDS old, checked as failures come in
+#  and by a task alongside the pipeline, and at the end of the invocation
+UNREACHABLEMESSAGEBYTES = int(
+    os.environ.get('UNREACHABLEMESSAGEBYTES', 24000)
+    )
+UNREACHABLEBATCH = 10
+UNREACHABLEFLUSHSECONDS = float(
+    os.environ.get('UNREACHABLEFLUSHSECONDS', 10)
+    )
+# Exception text in the report is cut to this many characters
+UNREACHABLEERRORCHARS = int(os.environ.get('UNREACHABLEERRORCHARS', 200))
+# Attempts at sending a batch, messages that still fail are logged in
+#  full so the report isn't lost
+UNREACHABLEATTEMPTS = int(os.environ.get('UNREACHABLEATTEMPTS', 4))
+# Batches queued on the sender thread, while it's behind by this many
+#  the rest of the report stays sealed and goes on a later flush. Only
+#  the flush at the end of the invocation waits on the sender
+UNREACHABLEINFLIGHT = 2
+
+# Last stored chain hashes of the chains collected by the invocation
+#  (ChainHashes)
+CHAINHASHES = None
+# Number of chains that were unchanged and not stored again
+UNCHANGEDCHAINS = None
+# Historical number of chains per ticker and the seconds each of them
+#  took, see _load_ticker_costs
+TICKERCOSTS = None
+TICKERSECONDS = None
+# Seconds the chains collected by this invocation took to request and
+#  parse {(ticker, "YYYYmmdd" expiration): seconds}, stored with the
+#  chain hashes for the runs after
+CHAINSECONDS = None
+
+
+def _preload():
+    """
+    Helper Function
+    Build the PRELOADGLOBALS that are still deferred on a daemon thread,
+    so a cold container imports the heavy modules while the handler is
+    waiting on DynamoDB and the first pages instead of before
+    """
+
+    global PRELOADER
+    pending = [
+        name for name in PRELOADGLOBALS
+        if isinstance(globals().get(name), Deferred)
+        ]
+    if not PRELOAD or len(pending) == 0:
+        return None
+
+    def _build():
+        for name in pending:
+            deferred = globals().get(name)
+            if not isinstance(deferred, Deferred):
+                continue
+            try:
+                deferred._resolve()
+            except Exception as e:
+                # The handler builds it again when it's used
+                logger.warning("Preload {} failed -- {}".format(name, e))
+
+    PRELOADER = threading.Thread(target=_build, name='preload', daemon=True)
+    PRELOADER.start()
+
+
+def _report_cold_start(state):
+    """
+    Helper Function
+    Log the module init and deferred loads the invocation paid for
+    against the cold start budget of its state, then reset COLDSTART
+
+    Output:
+        ----------------------------------------------------------------
+        (dict) --> the logged record, None for warm invocations that
+            loaded nothing
+    """
+
+    global COLDSTART
+    record, COLDSTART = COLDSTART, {'init': 0., 'loads': {}, 'blocked': 0.}
+    if record['init'] == 0 and len(record['loads']) == 0:
+        return None
+
+    total = record['init'] + record['blocked']
+    budget = COLDSTARTBUDGETMS.get(state, COLDSTARTBUDGETMS['initialize'])
+    summary = {
+        'state': state,
+        'init': round(record['init'], 3),
+        'loads': {
+            name: round(seconds, 3)
+            for name, seconds in record['loads'].items()
+            },
+        'blocked': round(record['blocked'], 3),
+        'total': round(total, 3),
+        'budget': budget / 1000.
+        }
+    if IMPORTTIMER is not None:
+        summary['imports'] = IMPORTTIMER.summary()
+        IMPORTTIMER.times = {}
+    logger.info("Cold start -- {}".format(json.dumps(summary)))
+    if 1000 * total > budget:
+        logger.warning("Cold start over budget -- {:.0f}ms > {}ms".format(
+            1000 * total, budget
+            ))
+    return summary
+
+
+class UnreachableMessages(object):
+    """
+    Unreachable report of the invocation, streamed to the NOTREACHABLESQS
+    queue while the run goes on. Failures are grouped by ticker into
+    messages of at most UNREACHABLEMESSAGEBYTES
+
+        {"run_timestamp": ts, "part": "invocation-n",
+         ticker: [[expiration_date, error],...],...}
+
+    and sealed messages are sent UNREACHABLEBATCH at a time on a sender
+    thread. The log processing function merges the parts of a run by
+    run_timestamp, the part id lets it skip redelivered messages
+    """
+    # JSON of run_timestamp and part with room to spare
+    BASESIZE = 100
+
+    def __init__(self, run_timestamp):
+        super(UnreachableMessages, self).__init__()
+        self.run_timestamp = run_timestamp
+        self.invocation = uuid.uuid4().hex[:12]
+        self.sequence = itertools.count()
+        # Message being filled {ticker: [[expiration_date, error],...]}
+        self.tickers = {}
+        self.size = self.BASESIZE
+        # Sealed message bodies not handed to the sender yet
+        self.sealed = []
+        # Monotonic time of the oldest failure in the message being filled
+        self.oldest = None
+        self.inflight = collections.deque()
+        self.executor = None
+        self.stats = {
+            'failures': 0, 'messages': 0, 'batches': 0, 'retries': 0,
+            'logged': 0
+            }
+
+    def add(self, ticker, expiration_date, e):
+        """
+        Report a failure, hands what's due to the sender. Called from
+        the stage coroutines so it never waits on the sender thread
+        """
+        entry = [expiration_date, str(e)[:UNREACHABLEERRORCHARS]]
+        size = len(json.dumps(entry)) + 1
+        # "ticker":[] the first time a message holds ticker
+        key = len(json.dumps(ticker)) + 4
+        if self.size + size + (0 if ticker in self.tickers else key) > \
+                UNREACHABLEMESSAGEBYTES and len(self.tickers) > 0:
+            self._seal()
+        if ticker not in self.tickers:
+            size += key
+        self.tickers.setdefault(ticker, []).append(entry)
+        self.size += size
+        self.stats['failures'] += 1
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if not self.due() and len(self.sealed) >= UNREACHABLEBATCH:
+            self._handoff(wait=False)
+
+    def due(self):
+        """
+        Seal the message being filled once its oldest failure is
+        UNREACHABLEFLUSHSECONDS old and hand off what is sealed, True
+        if the message was due
+        """
+        due = self.oldest is not None and \
+            time.monotonic() - self.oldest >= UNREACHABLEFLUSHSECONDS
+        if due:
+            self._seal()
+        if due or len(self.sealed) > 0:
+            self._handoff(wait=False)
+        return due
+
+    async def run(self):
+        """
+        Sends what is due a quarter of UNREACHABLEFLUSHSECONDS apart
+        until cancelled, so the last failures of a quiet stretch don't
+        wait on the next one or the end of the invocation
+        """
+        while True:
+            await asyncio.sleep(UNREACHABLEFLUSHSECONDS / 4)
+            self.due()
+
+    def _seal(self):
+        body = {
+            'run_timestamp': self.run_timestamp,
+            'part': '{}-{}'.format(self.invocation, next(self.sequence))
+            }
+        body.update(self.tickers)
+        self.sealed.append(json.dumps(body, separators=(',', ':')))
+        self.tickers = {}
+        self.size = self.BASESIZE
+        self.oldest = None
+        self.stats['messages'] += 1
+
+    def flush(self):
+        """ Hand everything reported so far to the sender thread """
+        if len(self.tickers) > 0:
+            self._seal()
+        self._handoff(wait=True)
+
+    def _handoff(self, wait):
+        """
+        Submit the sealed messages UNREACHABLEBATCH at a time. Without
+        wait only as many batches as UNREACHABLEINFLIGHT allows are
+        submitted, the rest stay sealed for a later hand off
+        """
+        if self.executor is None and len(self.sealed) > 0:
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='unreachable'
+                )
+        while len(self.inflight) > 0 and self.inflight[0].done():
+            self.inflight.popleft().result()
+        while len(self.sealed) > 0:
+            if len(self.inflight) >= UNREACHABLEINFLIGHT:
+                if not wait:
+                    break
+                self.inflight.popleft().result()
+            batch = self.sealed[:UNREACHABLEBATCH]
+            self.sealed = self.sealed[UNREACHABLEBATCH:]
+            self.inflight.append(self.executor.submit(self._send, batch))
+
+    def _send(self, bodies):
+        """ send_message_batch with retries, runs on the sender thread """
+        entries = [
+            {'Id': str(i), 'MessageBody': body}
+            for i, body in enumerate(bodies)
+            ]
+        self.stats['batches'] += 1
+        for attempt in range(UNREACHABLEATTEMPTS):
+            if attempt > 0:
+                self.stats['retries'] += 1
+                time.sleep(random.uniform(
+                    0, min(DBWRITEMAXDELAY, DBWRITEBASEDELAY * 2 ** attempt)
+                    ))
+            try:
+                response = sqsqueue.send_messages(Entries=entries)
+            except Exception as e:
+                logger.warning("Unreachable report batch -- {}".format(e))
+                continue
+            failed = set(fail['Id'] for fail in response.get('Failed', []))
+            entries = [entry for entry in entries if entry['Id'] in failed]
+            if len(entries) == 0:
+                return None
+        for entry in entries:
+            self.stats['logged'] += 1
+            logger.error("Unreachable report not sent -- {}".format(
+                entry['MessageBody']
+                ))
+
+    def close(self):
+        """ Send the rest of the report and wait for the sender """
+        self.flush()
+        while len(self.inflight) > 0:
+            self.inflight.popleft().result()
+        if self.executor is not None:
+            self.executor.shutdown()
+        return self.stats
+
+
+def _unreachable_message(ticker, expiration_date, e):
+    """
+    Add to the Invocations Unreachable SQS report
+    """
+    global UNREACHABLEMESSAGES
+    if UNREACHABLEMESSAGES is None:
+        # Debug Error checking
+        raise Exception("UNREACHABLEMESSAGES is None")
+
+    UNREACHABLEMESSAGES.add(ticker, expiration_date, e)
+
+
+class WorkQueue(object):
+    """
+    Collection work of a run on the WORKQUEUESQS queue, an item per
+    ticker
+
+        {"run_timestamp": ts, "Ticker": "AAPL", "Cost": expirations,
+         "Seconds": seconds per chain, "Chains": [[expiration_date,
+         attempt],...]}
+
+    Cost and Seconds go along when they're known, an item with Chains
+    only holds the expirations a collector ran out of time on. Items
+    are received as Stage 1 admits them and deleted (acknowledged) by
+    close once the invocation is done with them, what it couldn't
+    collect is enqueued again before. A collector only receives as
+    many items as the SCHEDULER has room for and stops once none are
+    visible, items other collectors hold are theirs to finish or hand
+    back. Items of a collector that dies are received again after the
+    VisibilityTimeout, the last collector to stop while items are in
+    flight leaves a delayed work event on WORKWAKESQS for them
+    """
+    def __init__(self, run_timestamp):
+        super(WorkQueue, self).__init__()
+        self.run_timestamp = run_timestamp
+        # Messages taken on by this invocation, deleted by close
+        self.taken = []
+        # Nothing left in the queue, or it holds a newer run
+        self.drained = False
+        self.superseded = False
+        # Items in flight (received, not deleted) at the last idle()
+        self.hidden = 0
+        # Work this collector took on and couldn't finish went back to
+        #  the queue, close starts the next collector for it
+        self.unfinished = False
+        self.stats = {
+            'enqueued': 0, 'received': 0, 'released': 0, 'stale': 0,
+            'acknowledged': 0, 'failed': 0
+            }
+
+    def _batch(self, call, entries):
+        """
+        SQS batch call with retries, returns the entries that still
+        failed after WORKQUEUEATTEMPTS calls
+        """
+        for attempt in range(WORKQUEUEATTEMPTS):
+            if attempt > 0:
+                time.sleep(random.uniform(
+                    0, min(DBWRITEMAXDELAY, DBWRITEBASEDELAY * 2 ** attempt)
+                    ))
+            try:
+                response = call(Entries=entries)
+            except Exception as e:
+                logger.warning("Work queue batch -- {}".format(e))
+                continue
+            failed = set(fail['Id'] for fail in response.get('Failed', []))
+            entries = [entry for entry in entries if entry['Id'] in failed]
+            if len(entries) == 0:
+                break
+        self.stats['failed'] += len(entries)
+        return entries
+
+    def _handles(self, messages, **kwargs):
+        return [
+            dict(Id=str(i), ReceiptHandle=message.receipt_handle, **kwargs)
+            for i, message in enumerate(messages)
+            ]
+
+    def enqueue(self, tickers, chains=(), unfinished=False):
+        """
+        Work items for tickers, and [ticker, expiration, attempt] chains
+        grouped by ticker. unfinished is work handed back by this
+        collector
+        """
+        items = []
+        for ticker in tickers:
+            item = {'run_timestamp': self.run_timestamp, 'Ticker': ticker}
+            if ticker in TICKERCOSTS:
+                item['Cost'] = TICKERCOSTS[ticker]
+            if ticker in TICKERSECONDS:
+                item['Seconds'] = TICKERSECONDS[ticker]
+            items.append(item)
+        expirations = collections.OrderedDict()
+        for ticker, expiration_date, attempt in chains:
+            expirations.setdefault(ticker, []).append(
+                [expiration_date, attempt]
+                )
+        for ticker, expiration in expirations.items():
+            items.append({
+                'run_timestamp': self.run_timestamp, 'Ticker': ticker,
+                'Chains': expiration
+                })
+
+        for start in range(0, len(items), WORKQUEUEBATCH):
+            entries = [
+                {'Id': str(i), 'MessageBody': json.dumps(
+                    item, separators=(',', ':')
+                    )}
+                for i, item in enumerate(items[start:start + WORKQUEUEBATCH])
+                ]
+            for entry in self._batch(workqueue.send_messages, entries):
+                logger.error("Work item not enqueued -- {}".format(
+                    entry['MessageBody']
+                    ))
+        self.stats['enqueued'] += len(items)
+        if len(items) > 0:
+            self.drained = False
+            self.unfinished = self.unfinished or unfinished
+
+    def receive(self, wait, count=WORKQUEUEBATCH):
+        """
+        Up to count (at most WORKQUEUEBATCH) items of the run, long
+        polls for up to wait seconds. Items of an earlier run are
+        dropped, items of a newer one are released and supersede this
+        run. Blocks, run it off the event loop
+
+        Output:
+            -----------------------------------------------------------
+            list[(dict, sqs.Message)] --> items and their messages
+        """
+        items = []
+        newer = []
+        for message in workqueue.receive_messages(
+                MaxNumberOfMessages=max(1, min(WORKQUEUEBATCH, count)),
+                WaitTimeSeconds=wait):
+            self.stats['received'] += 1
+            item = json.loads(message.body)
+            if item['run_timestamp'] < self.run_timestamp:
+                self.stats['stale'] += 1
+                self.taken.append(message)
+            elif item['run_timestamp'] > self.run_timestamp:
+                newer.append(message)
+            else:
+                items.append((item, message))
+        if len(newer) > 0:
+            self.superseded = True
+            self.release(newer, unfinished=False)
+        return items
+
+    def release(self, messages, unfinished=True):
+        """
+        Make messages not taken on visible to other collectors, they
+        are unfinished work of this run unless said otherwise
+        """
+        self.stats['released'] += len(messages)
+        self.unfinished = self.unfinished or unfinished
+        for start in range(0, len(messages), WORKQUEUEBATCH):
+            self._batch(
+                workqueue.change_message_visibility_batch,
+                self._handles(
+                    messages[start:start + WORKQUEUEBATCH],
+                    VisibilityTimeout=0
+                    )
+                )
+
+    def idle(self):
+        """
+        True once no items are visible, hidden is left with the number
+        in flight (approximate counts). Blocks
+        """
+        workqueue.load()
+        attributes = workqueue.attributes
+        visible = int(attributes['ApproximateNumberOfMessages'])
+        self.hidden = int(attributes['ApproximateNumberOfMessagesNotVisible'])
+        self.drained = visible == 0
+        return self.drained
+
+    def wake(self):
+        """
+        Send a work event of the run to WORKWAKESQS, delayed for
+        WORKWAKESECONDS. True if it was sent
+        """
+        if WORKWAKESQS == "":
+            return False
+        try:
+            wakequeue.send_message(
+                MessageBody=json.dumps({
+                    'State': 'work', 'run_timestamp': self.run_timestamp
+                    }),
+                DelaySeconds=min(900, WORKWAKESECONDS)
+                )
+        except Exception as e:
+            logger.warning("Work queue wake -- {}".format(e))
+            return False
+        return True
+
+    def close(self):
+        """
+        Acknowledge the items taken on. The next collector is started
+        when this one handed back work it couldn't finish, or stopped
+        taking items while some were still visible. Otherwise items
+        still in flight get a delayed one (see wake), if their
+        collector is still running it finds nothing to do
+        """
+        for start in range(0, len(self.taken), WORKQUEUEBATCH):
+            failed = self._batch(
+                workqueue.delete_messages,
+                self._handles(self.taken[start:start + WORKQUEUEBATCH])
+                )
+            self.stats['acknowledged'] += (
+                len(self.taken[start:start + WORKQUEUEBATCH]) - len(failed)
+                )
+        self.taken = []
+        if not self.superseded and not self.unfinished:
+            try:
+                self.idle()
+            except Exception as e:
+                logger.warning("Work queue attributes -- {}".format(e))
+        handoff = not self.superseded and (
+            self.unfinished or not self.drained
+            )
+        wake = False
+        if handoff:
+            _invoke_worker()
+        elif not self.superseded and self.hidden > 0:
+            wake = self.wake()
+        return dict(
+            self.stats, drained=self.drained, hidden=self.hidden,
+            handoff=handoff, wake=wake
+            )
+
+
+def _build_options_url(ticker, date=None):
+    """
+    Help Function
+    Constructs the URL pointing directly to the options chain for a
+     ticker and optional date
+
+    Inputs:
+        ---------------------------------------------------------------
+        ticker --> (string) i.e. "AAPL"
+        date --> (string) "Month DD, YYYY" i.e. May 15, 2020
+
+    Caveats: Future
+        ---------------------------------------------------------------
+        1.) This is url format that currently works on a majority of
+            tickers for yahoo finance. NOT future proof in way.
+
+    """
+
+    url = OPTIONSURL + "/quote/" + ticker + "/options?p=" + ticker
+    if date is not None:
+        url = url + "&date=" + str(int(pd.Timestamp(date).timestamp()))
+
+    return url
+
+
+def _string2Number(string):
+    """
+    Helper Function
+    Coverts the strings in pandas Dataframe to
+    floats.
+    """
+
+    if isinstance(string, str):
+        # Repalce Commas
+        if ',' in string:
+            # Pull all the commas out if they exist
+            string = string.replace(',', '')
+
+        if len(string) == 0 or string == "-":
+            return np.nan
+        if string[-1] == '%':
+            string = string[:-1]
+
+    return float(string)
+
+
+def _extractTable(fragment):
+    """
+    Helper Function
+    Parse a single html <table> fragment into an OptionsTable, the
+    columns pandas.read_html() would give it less Contract Name
+
+    Inputs:
+        ---------------------------------------------------------------
+        fragment --> (string) html source from "<table" to "</table>"
+
+    Output:
+        ---------------------------------------------------------------
+        (string, OptionsTable) --> the tables class attribute and the
+            table, or (string, None) if the table has no data rows
+
+    Numeric columns are written straight into the rows of one
+    np.float64 buffer using the same conversion as _string2Number,
+    Last Trade Date is interned as it's read. Cells of the other
+    STRINGCOLUMNS are never read.
+    """
+
+    parser = getattr(HTMLPARSERS, 'parser', None)
+    if parser is None:
+        parser = HTMLPARSERS.parser = lxml.etree.HTMLParser()
+
+    element = lxml.etree.fromstring(fragment, parser).find('.//table')
+    labels = [
+        ''.join(th.itertext()).strip()
+        for th in element.iterfind('.//thead//th')
+        ]
+    rows = element.findall('.//tbody/tr')
+    if len(labels) == 0 or len(rows) == 0:
+        return element.get('class', ''), None
+
+    # Allocate typed column buffers for the columns that are kept
+    numeric = [label for label in labels if label not in STRINGCOLUMNS]
+    numbers = np.empty((len(numeric), len(rows)), dtype=np.float64)
+    codes = np.empty(len(rows), dtype=np.intp)
+    dates = {}
+    buffers = iter(numbers)
+    columns, kept = [], []
+    for k, label in enumerate(labels):
+        if label == 'Last Trade Date':
+            columns.append((
+                k, codes, lambda text: dates.setdefault(text, len(dates))
+                ))
+        elif label not in STRINGCOLUMNS:
+            columns.append((k, next(buffers), _string2Number))
+        else:
+            continue
+        kept.append(label)
+
+    for i, row in enumerate(rows):
+        cells = row.findall('td')
+        if len(cells) != len(labels):
+            raise ValueError(
+                "Options table row has {} cells expected {}".format(
+                    len(cells), len(labels))
+                )
+        for k, column, convert in columns:
+            # Most cells are plain text only walk the ones with markup
+            cell = cells[k]
+            if len(cell) == 0:
+                text = cell.text or ''
+            else:
+                text = ''.join(cell.itertext())
+            column[i] = convert(text.strip())
+
+    if 'Last Trade Date' not in kept:
+        return element.get('class', ''), OptionsTable(
+            kept, numbers, None, None
+            )
+    # Renumber the dictionary in sorted order like np.unique
+    values = sorted(dates)
+    order = np.empty(len(values), dtype=np.intp)
+    order[[dates[value] for value in values]] = np.arange(len(values))
+    return element.get('class', ''), OptionsTable(
+        kept, numbers, values,
+        order[codes].astype(_unsignedDtype(len(values)))
+        )
+
+
+def _extractOptionsTables(html):
+    """
+    Helper Function
+    Purpose built replacement for pandas.read_html() on the options page
+
+    Inputs:
+        ---------------------------------------------------------------
+        html --> (string) html source of a finance.yahoo.com options page
+
+    Output:
+        ---------------------------------------------------------------
+        (dict) --> {"calls": OptionsTable|None, "puts": OptionsTable|None}
+
+    Only the <table> elements are cut out of the page and handed to lxml,
+    the rest of the document (mostly script) is never parsed. Tables are
+    matched to calls/puts by their class attribute, if the page doesn't
+    label them falls back on document order like tables[0], tables[1]
+    """
+
+    tables = []
+    start = html.find('<table')
+    while start != -1:
+        end = html.find('</table>', start)
+        if end == -1:
+            break
+        end += len('</table>')
+        tables.append(_extractTable(html[start:end]))
+        start = html.find('<table', end)
+
+    data = {'calls': None, 'puts': None}
+    unlabeled = []
+    for classes, frame in tables:
+        classes = classes.split()
+        if 'calls' in classes:
+            data['calls'] = frame
+        elif 'puts' in classes:
+            data['puts'] = frame
+        else:
+            unlabeled.append(frame)
+
+    if data['calls'] is None and data['puts'] is None:
+        # No tables were labeled use document order
+        unlabeled = [frame for frame in unlabeled if frame is not None]
+        for key, frame in zip(['calls', 'puts'], unlabeled):
+            data[key] = frame
+
+    return data
+
+
+def _column2Numbers(values):
+    """
+    Helper Function
+    Vectorized version of _string2Number for a whole table column
+
+    Inputs:
+        ---------------------------------------------------------------
+        values --> (np.array) a column of the options table, numeric or
+            object dtype holding strings like "1,234", "-", "" or "5.2%"
+
+    Output:
+        ---------------------------------------------------------------
+        (np.array(dtype=np.float64)) --> same values _string2Number
+            gives cell by cell for every cell it accepts
+    """
+
+    if values.dtype.kind in 'biuf':
+        # Column was already converted when the table was extracted
+        return values.astype(np.float64)
+
+    try:
+        # Strip commas and trailing '%' from the whole column in one pass
+        text = '\n'.join(values).replace(',', '').replace('%\n', '\n')
+    except TypeError:
+        # Column mixes strings with numbers, go cell by cell
+        return np.fromiter(
+            map(_string2Number, values), dtype=np.float64, count=len(values)
+            )
+
+    if text.endswith('%'):
+        text = text[:-1]
+    cells = text.split('\n')
+    if len(cells) != len(values):
+        # A cell had a newline in it, go cell by cell
+        return np.fromiter(
+            map(_string2Number, values), dtype=np.float64, count=len(values)
+            )
+
+    return np.fromiter(
+        map(float, [
+            'nan' if cell == '' or cell == '-' else cell for cell in cells
+            ]),
+        dtype=np.float64, count=len(cells)
+        )
+
+
+def _encodeOptionsTable(optstab):
+    """
+    Helper Function
+    Inputs:
+        ---------------------------------------------------------------
+        optstab --> (OptionsTable) Generated from _extractOptionsTables()
+            or a pd.DataFrame of the table
+
+    Output:
+        ---------------------------------------------------------------
+        (JSON) --> PAYLOADFORMAT "json"
+            {
+                "Last Trade Date" --> (list[(strings)])
+                "Column Labels" --> (list[(strings)])
+                "Shape" --> base64 encoded np.array(dtype=np.int32)
+                "Table" --> base64 encoded np.array(dtype=np.float16).flatten()
+            }
+        (bytes) --> PAYLOADFORMAT "zlib" or "lzma", version 4 compressed
+            binary payload see _packPayload. Each numeric column is
+            stored losslessly as scaled integers see _encodeColumns
+
+    Caveats: Future
+        ---------------------------------------------------------------
+        1.) This is also highly coupled to everything else in this file
+            not future proof
+
+    Tansforms the table generated by _extractOptionsTables(html) for
+    storage in DynamoDB.
+
+    The "json" format coverts to half-percision floats and base64
+    encodes the np.array, sacrifices a little percision for reduced
+    storage.
+    """
+
+    # If Options table is None return None
+    if optstab is None:
+        return optstab
+    if isinstance(optstab, pd.DataFrame):
+        optstab = OptionsTable.from_frame(optstab)
+
+    if PAYLOADFORMAT in PAYLOADCOMPRESSION:
+        # Typed columns, the schema goes in the header
+        return _packPayload(*_encodeColumns(optstab))
+
+    # Skip redundent columns and hold on to string type columns, a
+    #  table without Last Trade Date leaves it out like the binary one
+    record = {}
+    if optstab.dates is not None:
+        record['Last Trade Date'] = [
+            optstab.dates[code] for code in optstab.codes.tolist()
+            ]
+
+    record['Column Labels'] = [
+        label for label in optstab.labels if label not in STRINGCOLUMNS
+        ]
+    # One row per column, rows of the table are its columns
+    table = optstab.numbers.T
+
+    # Base64 encode the shape of the array for reconstruction
+    record['Shape'] = base64.b64encode(
+        np.array(table.shape, dtype=np.int32).tobytes()
+        ).decode('ascii')
+
+    # Convert to half percision numbers and base64 incode the array
+    record['Table'] = base64.b64encode(
+            table.astype(np.float16).tobytes()
+            ).decode('ascii')
+
+    return json.dumps(record)
+
+
+def _encodeColumns(optstab):
+    """
+    Helper Function
+    Lossless typed encoding of a table for the version 4 payload
+
+    Inputs:
+        ---------------------------------------------------------------
+        optstab --> (OptionsTable) the table to encode
+
+    Output:
+        ---------------------------------------------------------------
+        (bytes, bytes) --> the body to compress and the byte planes
+            stored raw after it
+
+    Each numeric column is scaled by the smallest power of ten (up to
+    PAYLOADMAXEXPONENT) that makes every value an integer and the column
+    minimum (base, NaN counts as 0) is subtracted. Decoding is
+        (code + base) / divisor
+    with the divisor 10 ** exponent, which reproduces the float64 values
+    exactly. Columns that don't scale to integers, or whose codes don't
+    fit in 4 bytes, are stored as float64.
+
+    Every integer column, and the dictionary codes of Last Trade Date,
+    shares the narrowest width in PAYLOADWIDTHS and its largest code
+    marks NaN. The codes are stored as byte planes, the lowest byte of
+    every code then the next one, so the high bytes compress to almost
+    nothing and a reader rebuilds all the codes with one np.dot().
+    """
+
+    table = optstab.numbers
+    rows = len(optstab)
+    missing = np.isnan(table)
+    filled = np.where(missing, 0., table)
+
+    # Find the exponent of every column at once
+    exponents = np.full(len(table), -1)
+    for exponent in range(PAYLOADMAXEXPONENT + 1):
+        pending = np.flatnonzero(exponents < 0)
+        if len(pending) == 0:
+            break
+        scaled = np.round(filled[pending] * 10. ** exponent)
+        exact = np.all(
+            (np.abs(scaled) < 2 ** 53)
+            & (scaled / 10. ** exponent == filled[pending]),
+            axis=1
+            ) & (np.ptp(scaled, axis=1) < 2 ** 32 - 1)
+        exponents[pending[exact]] = exponent
+
+    integers = exponents >= 0
+    scaled = np.round(filled[integers] * 10. ** exponents[integers, None])
+    bases = scaled.min(axis=1)
+    codes = list(scaled - bases[:, None])
+    bases = list(bases)
+    divisors = list(10. ** exponents[integers])
+    missing = list(missing[integers])
+
+    # Kind of every column in table order, the numbers are in labels
+    #  order without Last Trade Date
+    kinds, strings = [], []
+    numbers = iter(integers.tolist())
+    for label in optstab.labels:
+        if label != 'Last Trade Date':
+            kinds.append(
+                PAYLOADINTEGERS if next(numbers) else PAYLOADFLOATS
+                )
+        elif len(optstab.dates) > PAYLOADDISTINCTDATES * rows:
+            kinds.append(PAYLOADSTRINGS)
+            strings = [optstab.dates[code] for code in optstab.codes.tolist()]
+        else:
+            # The codes go with the integer columns, base 0 divisor 1
+            kinds.append(PAYLOADDICTIONARY)
+            strings = optstab.dates
+            position = sum(kind == PAYLOADINTEGERS for kind in kinds)
+            codes.insert(position, optstab.codes.astype(np.float64))
+            bases.insert(position, 0.)
+            divisors.insert(position, 1.)
+            missing.insert(position, np.zeros(rows, dtype=bool))
+
+    codes = np.array(codes).reshape(-1, rows)
+    missing = np.array(missing, dtype=bool).reshape(codes.shape)
+    top = codes.max(initial=0)
+    width = next(
+        width for width in PAYLOADWIDTHS if top < 2 ** (8 * width) - 1
+        )
+    codes = codes.astype('<u{}'.format(width))
+    codes[missing] = 2 ** (8 * width) - 1
+    flags = PAYLOADHASMISSING if missing.any() else 0
+
+    # Byte planes, lowest byte first. Low planes that hardly compress
+    #  are kept out of the compressed body
+    planes = codes.reshape(-1).view('<u1').reshape(-1, width).T
+    raw = 0
+    while raw < width and planes.shape[1] >= PAYLOADRAWBYTES:
+        deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        size = len(deflate.compress(planes[raw].tobytes()) + deflate.flush())
+        if size < (1 - PAYLOADRAWSAVING) * planes.shape[1]:
+            break
+        raw += 1
+
+    text = '\0'.join(optstab.labels + list(strings)).encode()
+    header = PAYLOADHEADER.pack(
+        rows, len(text), len(kinds), len(codes), width, flags, raw
+        ) + bytes(kinds) + text
+    coded = planes[raw:].tobytes()
+    body = b''.join([
+        header, bytes(-len(header) % 8),
+        np.array([bases, divisors], dtype='<f8').tobytes(),
+        coded, bytes(-len(coded) % 8),
+        table[~integers].astype('<f8').tobytes()
+        ])
+    return body, planes[:raw].tobytes()
+
+
+def _unsignedDtype(count):
+    """
+    Helper Function
+    Narrowest PAYLOADDTYPES unsigned integer that holds count values
+    and keeps its largest value free as the NaN marker
+    """
+
+    for dtype in PAYLOADDTYPES:
+        if count < np.iinfo(dtype).max:
+            return dtype
+    raise ValueError("{} values don't fit in a column".format(count))
+
+
+def _packPayload(body, raw):
+    """
+    Helper Function
+    Build the versioned binary payload stored in a DynamoDB Binary
+    attribute
+
+    Inputs:
+        ---------------------------------------------------------------
+        body --> (bytes) the body of the table see _encodeColumns
+        raw --> (bytes) the byte planes that aren't compressed
+
+    Output:
+        ---------------------------------------------------------------
+        (bytes) --> PAYLOADMAGIC + version + compression + uint32
+            compressed length + compressed body + raw
+    """
+
+    if PAYLOADFORMAT == 'lzma':
+        body = lzma.compress(body)
+    else:
+        deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        body = deflate.compress(body) + deflate.flush()
+    return b''.join([
+        PAYLOADMAGIC,
+        bytes([PAYLOADVERSION, PAYLOADCOMPRESSION[PAYLOADFORMAT]]),
+        struct.pack('<I', len(body)), body, raw
+        ])
+
+
+def _get_executor():
+    """
+    Helper Function
+    Build the parse/encode executor for EXECUTORMODE, None if parsing and
+    encoding should run inline on the event loop
+
+    Caveats:
+        ---------------------------------------------------------------
+        1.) multiprocessing needs /dev/shm for its locks which the Lambda
+            environment doesn't have, if the process pool can't be
+            created fall back to a thread pool
+    """
+    global EXECUTOR
+
+    if EXECUTOR is not None or EXECUTORMODE not in ('thread', 'process'):
+        return EXECUTOR
+
+    if EXECUTORMODE == 'process':
+        # Workers forked while the preload thread holds an import lock
+        #  would wait on it forever
+        if PRELOADER is not None:
+            PRELOADER.join()
+        try:
+            EXECUTOR = ProcessPoolExecutor(max_workers=EXECUTORWORKERS)
+        except OSError as e:
+            logger.warning(
+                "Process pool unavailable using threads -- {}".format(e)
+                )
+    if EXECUTOR is None:
+        EXECUTOR = ThreadPoolExecutor(max_workers=EXECUTORWORKERS)
+
+    logger.info("Executor: {}, Workers: {}, Max in flight: {}".format(
+        type(EXECUTOR).__name__, EXECUTORWORKERS, EXECUTORMAXINFLIGHT)
+        )
+    return EXECUTOR
+
+
+def _cpu_timed(func, *args):
+    """
+    Helper Function
+    (func, *args) --> (func(*args), CPU seconds the thread running it
+        spent), runs wherever _run_cpu_bound sends func
+    """
+
+    start = time.thread_time()
+    result = func(*args)
+    return result, time.thread_time() - start
+
+
+async def _run_cpu_bound(func, *args):
+    """
+    Helper Function
+    Run func(*args) on the executor if one is configured otherwise inline,
+    waits for one of the EXECUTORMAXINFLIGHT slots before submitting. The
+    CPU time of func is added to the invocations METRICS
+    """
+
+    if EXECUTOR is None:
+        result, seconds = _cpu_timed(func, *args)
+    else:
+        async with EXECUTORSLOTS:
+            result, seconds = await asyncio.get_running_loop(
+                ).run_in_executor(EXECUTOR, _cpu_timed, func, *args)
+    if METRICS is not None:
+        METRICS.cpu[func.__name__] += seconds
+    return result
+
+
+def _invoke_collector(tickers, chains=()):
+    """
+    Helper Function
+    Asynchronously invoke another collector for tickers, and chains
+    [ticker, expiration, attempt] of tickers that are partly collected,
+    as part of the current collection run. The costs known for the
+    tickers go along so the next collector doesn't have to load them
+    """
+
+    handed = set(tickers) | set(chain[0] for chain in chains)
+    costs = {
+        ticker: TICKERCOSTS[ticker]
+        for ticker in handed if ticker in TICKERCOSTS
+        }
+    seconds = {
+        ticker: TICKERSECONDS[ticker]
+        for ticker in handed if ticker in TICKERSECONDS
+        }
+    lambdaclient.invoke(
+        FunctionName='OptionsHistory-CollectDataFunc',
+        InvocationType='Event',
+        Payload=json.dumps(
+            {
+                'State': 'continue',
+                'Tickers': tickers,
+                'Chains': list(chains),
+                'Costs': costs,
+                'Seconds': seconds,
+                'run_timestamp': UNREACHABLEMESSAGES.run_timestamp
+            }
+            ).encode()
+        )
+
+
+def _invoke_worker():
+    """
+    Helper Function
+    Asynchronously invoke another collector pulling the work of the
+    current collection run off the WORKQUEUESQS queue
+    """
+
+    lambdaclient.invoke(
+        FunctionName='OptionsHistory-CollectDataFunc',
+        InvocationType='Event',
+        Payload=json.dumps(
+            {
+                'State': 'work',
+                'run_timestamp': UNREACHABLEMESSAGES.run_timestamp
+            }
+            ).encode()
+        )
+
+
+def _load_ticker_costs():
+    """
+    Helper Function
+    Historical cost of each ticker, the number of expirations that
+    haven't expired yet with a chain stored in OptionsHistChainHashes
+    and the seconds their chains took to request and parse when they
+    were stored. The table's time to live (CHAINHASHDAYS) keeps the
+    Scan to about the expirations still listed
+
+    Output:
+        ---------------------------------------------------------------
+        (dict, dict) --> {ticker: number of expirations},
+            {ticker: mean seconds per chain} only for tickers with
+            recorded times
+    """
+
+    costs = {}
+    millis = {}
+    kwargs = {
+        'ProjectionExpression': 'Ticker, Millis',
+        'FilterExpression': Attr('Expiration').gte(
+            datetime.utcnow().strftime('%Y%m%d')
+            )
+        }
+    while True:
+        response = hash_table.scan(**kwargs)
+        for item in response.get('Items', []):
+            ticker = item['Ticker']
+            costs[ticker] = costs.get(ticker, 0) + 1
+            if 'Millis' in item:
+                millis.setdefault(ticker, []).append(int(item['Millis']))
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    seconds = {
+        ticker: sum(values) / len(values) / 1000.
+        for ticker, values in millis.items()
+        }
+    return costs, seconds
+
+
+def _shard_tickers(tickers, costs):
+    """
+    Helper Function
+    Split the collection list into shards of about equal cost
+
+    Inputs:
+        ---------------------------------------------------------------
+        tickers --> list[strings] collection list
+        costs --> (dict) from _load_ticker_costs, tickers without any
+            history cost the average of the others
+
+    Output:
+        ---------------------------------------------------------------
+        list[list[strings]] --> one to COLLECTSHARDS shards, enough to
+            keep them near SHARDCHAINS chains each. Tickers keep the
+            order of the collection list within a shard
+
+    Tickers are handed out largest cost first, each to the shard with
+    the least cost so far
+    """
+
+    known = [costs[ticker] for ticker in tickers if ticker in costs]
+    default = sum(known) / len(known) if len(known) > 0 else 1
+    cost = {ticker: costs.get(ticker, default) for ticker in tickers}
+    count = max(1, min(
+        COLLECTSHARDS, len(tickers),
+        math.ceil(sum(cost.values()) / SHARDCHAINS)
+        ))
+
+    # Heap of (cost, shard number, tickers)
+    shards = [(0, i, []) for i in range(count)]
+    for ticker in sorted(tickers, key=cost.get, reverse=True):
+        load, i, shard = heapq.heappop(shards)
+        shard.append(ticker)
+        heapq.heappush(shards, (load + cost[ticker], i, shard))
+
+    order = {ticker: i for i, ticker in enumerate(tickers)}
+    return [
+        sorted(shard, key=order.get)
+        for _, _, shard in sorted(shards, key=lambda shard: shard[1])
+        ]
+
+
+def _order_tickers(tickers, costs, seconds):
+    """
+    Helper Function
+    Order tickers longest processing time first. A ticker costs its
+    number of expirations times the seconds its chains took, tickers
+    without history cost the average of the others
+
+    Output:
+        ---------------------------------------------------------------
+        list[strings] --> the tickers in the order to collect them
+
+    Every large ticker is followed by the smallest one left. A large
+    ticker gives Stage 3 enough chains to keep it busy while Stage 2
+    gets through a small one, so the run doesn't end on a string of
+    small tickers Stage 2 can't fill the Stage 3 workers with. Standard
+    SQS queues don't keep the order items are sent in, with WORKQUEUESQS
+    it is best effort
+    """
+
+    def _average(values, default):
+        values = list(values)
+        return sum(values) / len(values) if len(values) > 0 else default
+
+    expirations = _average(
+        costs.values(), DeadlineScheduler.DEFAULTCHAINS
+        )
+    per_chain = _average(seconds.values(), DEADLINECHAINSECONDS)
+    ranked = collections.deque(sorted(
+        tickers,
+        key=lambda ticker: (
+            costs.get(ticker, expirations) *
+            seconds.get(ticker, per_chain)
+            ),
+        reverse=True
+        ))
+
+    order = []
+    while len(ranked) > 0:
+        order.append(ranked.popleft())
+        if len(ranked) > 0:
+            order.append(ranked.pop())
+    return order
+
+
+def _is_throttle(e):
+    """
+    Helper Function
+    True if the exception is DynamoDB (or any AWS API) throttling
+    """
+
+    code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+    return code in (
+        'ProvisionedThroughputExceededException', 'ThrottlingException',
+        'RequestLimitExceeded'
+        )
+
+
+def _get_db_executor():
+    """
+    Helper Function
+    Build the DBWRITERS writer threads on first use
+    """
+
+    global DBEXECUTOR
+    if DBEXECUTOR is None:
+        DBEXECUTOR = ThreadPoolExecutor(
+            max_workers=DBWRITERS, thread_name_prefix='dbwriter'
+            )
+    return DBEXECUTOR
+
+
+def _batch_write_item(request_items):
+    """
+    Helper Function
+    batch_write_item on the calling threads own DynamoDB resource, runs
+    in the DBEXECUTOR writer threads
+    """
+
+    resource = getattr(DBRESOURCES, 'resource', None)
+    if resource is None:
+        resource = DBRESOURCES.resource = boto3.session.Session().resource(
+            'dynamodb'
+            )
+    return resource.batch_write_item(
+        RequestItems=request_items, ReturnConsumedCapacity='TOTAL'
+        )
+
+
+def _batch_get_item(request_items):
+    """
+    Helper Function
+    batch_get_item on the calling threads own DynamoDB resource, runs
+    in the DBEXECUTOR writer threads
+    """
+
+    resource = getattr(DBRESOURCES, 'resource', None)
+    if resource is None:
+        resource = DBRESOURCES.resource = boto3.session.Session().resource(
+            'dynamodb'
+            )
+    return resource.batch_get_item(
+        RequestItems=request_items, ReturnConsumedCapacity='TOTAL'
+        )
+
+
+def _itemBytes(item):
+    """
+    Helper Function
+    Bytes of the attribute names and values of a DynamoDB item
+    """
+
+    size = 0
+    for name, value in item.items():
+        if isinstance(value, str):
+            value = value.encode()
+        if isinstance(value, (bytes, bytearray)):
+            size += len(name) + len(value)
+        else:
+            # Numbers take at most 21 bytes
+            size += len(name) + 21
+    return size
+
+
+def _writeUnits(item):
+    """
+    Helper Function
+    Estimate of the write capacity units a put of item consumes, one
+    unit per started KB of attribute names and values
+    """
+
+    return max(1, -(-_itemBytes(item) // 1024))
+
+
+def _chainBytes(chain):
+    """
+    Helper Function
+    Approximate bytes of a (ticker, expiration date, data) chain passed
+    from Stage 3 to 4
+    """
+
+    return sum(
+        table.nbytes for table in (chain[2]['calls'], chain[2]['puts'])
+        if table is not None
+        )
+
+
+class OptionsTable(object):
+    """
+    Compact columnar options table, what Stage 3 passes to Stage 4 in
+    place of a pandas.DataFrame
+
+        labels --> (list[string]) labels of the columns kept in table
+            order, Contract Name isn't stored so it's dropped
+        numbers --> (np.array(dtype=np.float64)) one row per numeric
+            column in labels order, Last Trade Date left out
+        dates --> (list[string]) the distinct Last Trade Dates sorted,
+            None when the table has no such column
+        codes --> (np.array) unsigned index into dates for every row
+
+    A row of the table costs 8 bytes per number and at most 2 for its
+    Last Trade Date, against an object column of strings (and their
+    Python objects) for every column of a DataFrame straight off the
+    page
+    """
+    def __init__(self, labels, numbers, dates, codes):
+        super(OptionsTable, self).__init__()
+        self.labels = labels
+        self.numbers = numbers
+        self.dates = dates
+        self.codes = codes
+
+    @classmethod
+    def from_frame(cls, frame):
+        """ (pd.DataFrame) as pandas.read_html() gives it --> OptionsTable """
+        labels, numbers, dates, codes = [], [], None, None
+        for label, column in frame.items():
+            if label == 'Last Trade Date':
+                dates, codes = np.unique(
+                    column.to_numpy().astype(str), return_inverse=True
+                    )
+                dates = dates.tolist()
+                codes = codes.astype(_unsignedDtype(len(dates)))
+            elif label in STRINGCOLUMNS:
+                continue
+            else:
+                numbers.append(_column2Numbers(column.to_numpy()))
+            labels.append(label)
+        numbers = np.stack(numbers) if len(numbers) > 0 else np.empty(
+            (0, len(frame)), dtype=np.float64
+            )
+        return cls(labels, numbers, dates, codes)
+
+    def __len__(self):
+        return self.numbers.shape[1]
+
+    @property
+    def nbytes(self):
+        """ Approximate bytes held, STRINGBYTES per distinct date """
+        if self.dates is None:
+            return self.numbers.nbytes
+        return (
+            self.numbers.nbytes + self.codes.nbytes +
+            STRINGBYTES * len(self.dates)
+            )
+
+
+class AdaptiveLimit(object):
+    """
+    Semaphore whose limit can be changed while tasks are waiting on it.
+    Used as an async context manager around the requests of a stage
+    """
+    def __init__(self, limit):
+        super(AdaptiveLimit, self).__init__()
+        self.limit = limit
+        self.active = 0
+        self._condition = asyncio.Condition()
+
+    async def set_limit(self, limit):
+        async with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class ConcurrencyController(object):
+    """
+    Additive increase multiplicative decrease (AIMD) controller for the
+    number of Stage 2 and Stage 3 workers making requests at once
+
+    Every CONCURRENCYWINDOW requests the controller looks at what it saw
+    over the window. Any DynamoDB throttling, more then ERRORRATE of the
+    requests failing or being soft blocked (company not found pages), or
+    the median latency growing past LATENCYRATIO times the best median
+    seen so far cuts the limit by DECREASE. Otherwise the limit grows by
+    one, unless the MemoryWatchdog has it constrained. The limit always
+    stays with in [CONCURRENCYMIN, CONCURRENCYMAX]
+    """
+    ERRORRATE = .1
+    LATENCYRATIO = 2.
+    DECREASE = .7
+
+    def __init__(self, minimum, maximum, start, window):
+        super(ConcurrencyController, self).__init__()
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.limit = max(minimum, min(maximum, start))
+        self.chains = AdaptiveLimit(self.limit)
+        self.expirations = AdaptiveLimit(self.expirations_limit(self.limit))
+        self._latencies = []
+        self._errors = 0
+        self._blocked = 0
+        self._throttled = 0
+        self._pressure = 0
+        self._best_latency = None
+        # Set by the MemoryWatchdog while RSS is high
+        self.constrained = False
+
+    def expirations_limit(self, limit):
+        """ Stage 2 limit that goes with a Stage 3 limit """
+        return max(1, round(limit * TICKERQUEUESIZE / MAXCONNECTIONS))
+
+    async def record(self, latency, error=False, blocked=False):
+        """
+        Record the outcome of a request, latency in seconds. error for
+        failed requests, blocked for pages that came back with no data
+        """
+        self._latencies.append(latency)
+        self._errors += bool(error)
+        self._blocked += bool(blocked)
+        if len(self._latencies) >= self.window:
+            await self._adjust()
+
+    async def throttled(self):
+        """ Record DynamoDB throttling, backs off right away """
+        self._throttled += 1
+        await self._adjust()
+
+    async def pressure(self, critical=False):
+        """
+        Memory is running out, backs off right away. critical drops the
+        limit to the minimum
+        """
+        self._pressure += 1
+        await self._adjust(critical)
+
+    async def _adjust(self, critical=False):
+        samples = len(self._latencies)
+        median = None
+        if samples > 0:
+            median = sorted(self._latencies)[samples // 2]
+
+        if critical:
+            limit = self.minimum
+        elif (self._throttled > 0 or self._pressure > 0 or
+                self._errors > self.ERRORRATE * samples or
+                self._blocked > self.ERRORRATE * samples or
+                (median is not None and self._best_latency is not None and
+                    median > self.LATENCYRATIO * self._best_latency)):
+            limit = max(self.minimum, int(self.limit * self.DECREASE))
+        elif self.constrained:
+            limit = self.limit
+        else:
+            limit = min(self.maximum, self.limit + 1)
+
+        if median is not None and (
+                self._best_latency is None or median < self._best_latency):
+            self._best_latency = median
+
+        logger.info(
+            "Concurrency: {} -> {}, requests: {}, errors: {}, blocked: {},"
+            " throttled: {}, memory pressure: {}, median latency: {}".format(
+                self.limit, limit, samples, self._errors, self._blocked,
+                self._throttled, self._pressure, median)
+            )
+        self._latencies = []
+        self._errors = self._blocked = self._throttled = self._pressure = 0
+        if limit != self.limit:
+            self.limit = limit
+            await self.chains.set_limit(limit)
+            await self.expirations.set_limit(self.expirations_limit(limit))
+
+
+class MemoryWatchdog(object):
+    """
+    Watches the resident memory (RSS) of the function while the Pipeline
+    runs and lowers the request concurrency before the MEMORYMB it is
+    configured with runs out and Lambda kills it, fewer requests at once
+    hold fewer pages and tables at once. Memory python frees is seldom
+    handed back to the OS, so RSS that stays high only cuts the limit
+    again once it has grown WATCHDOGSTEP further. RSS is read from /proc,
+    where there is none the watchdog does nothing
+    """
+    def __init__(self, controller, memory):
+        super(MemoryWatchdog, self).__init__()
+        self.controller = controller
+        self.memory = memory * 2 ** 20
+        self.peak = 0
+        self.cuts = 0
+        self.critical = 0
+        # RSS when the limit was last cut
+        self._cut = None
+
+    def rss(self):
+        """ Resident bytes of the function and its executor processes,
+        pages shared with forked workers are counted by both """
+        pids = ['self']
+        if isinstance(EXECUTOR, ProcessPoolExecutor):
+            pids.extend(str(pid) for pid in list(EXECUTOR._processes))
+        rss = 0
+        for pid in pids:
+            try:
+                with open('/proc/{}/statm'.format(pid)) as f:
+                    rss += int(f.read().split()[1]) * os.sysconf(
+                        'SC_PAGE_SIZE'
+                        )
+            except (OSError, ValueError, IndexError):
+                continue
+        return rss
+
+    async def check(self):
+        rss = self.rss()
+        self.peak = max(self.peak, rss)
+        self.controller.constrained = rss > WATCHDOGHIGH * self.memory
+        if not self.controller.constrained:
+            self._cut = None
+        elif (rss > WATCHDOGCRITICAL * self.memory and
+                self.controller.limit > self.controller.minimum):
+            logger.warning("RSS {:.0f}MB of {:.0f}MB, concurrency to the "
+                           "minimum".format(rss / 2 ** 20, MEMORYMB))
+            self.critical += 1
+            self._cut = rss
+            await self.controller.pressure(critical=True)
+            gc.collect()
+        elif (self._cut is None or
+                rss > self._cut + WATCHDOGSTEP * self.memory):
+            logger.warning("RSS {:.0f}MB of {:.0f}MB, cutting "
+                           "concurrency".format(rss / 2 ** 20, MEMORYMB))
+            self.cuts += 1
+            self._cut = rss
+            await self.controller.pressure()
+
+    async def run(self):
+        """ Checks every WATCHDOGINTERVAL until cancelled """
+        while True:
+            await self.check()
+            await asyncio.sleep(WATCHDOGINTERVAL)
+
+    def summary(self):
+        """ (dict) --> peak RSS in MB and the number of cuts """
+        return {
+            'peak_mb': round(self.peak / 2 ** 20, 1), 'memory_mb': MEMORYMB,
+            'cuts': self.cuts, 'critical': self.critical
+            }
+
+
+def _percentiles(values):
+    """
+    Helper Function
+    (list[float]) --> {"p50", "p90", "max"} of values, not empty
+    """
+
+    values = sorted(values)
+    return {
+        'p50': round(values[len(values) // 2], 4),
+        'p90': round(values[int(len(values) * .9)], 4),
+        'max': round(values[-1], 4)
+        }
+
+
+class HTTPTimings(object):
+    """
+    Collects per request timings for the aiohttp.ClientSession through
+    an aiohttp.TraceConfig, all times in seconds
+
+        dns --> resolving the host (cache misses only)
+        connect --> opening a new connection (not on keep-alive reuse)
+        headers --> request start until the response headers are in
+        total --> request start until the body is read
+        bytes --> bytes on the wire (Content-Length, or the body size
+            if the response didn't send one)
+    """
+    def __init__(self):
+        super(HTTPTimings, self).__init__()
+        self.timings = {
+            'dns': [], 'connect': [], 'headers': [], 'total': []
+            }
+        self.requests = 0
+        self.bytes = 0
+
+    def trace_config(self):
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(self._on_request_start)
+        config.on_dns_resolvehost_start.append(self._on_dns_start)
+        config.on_dns_resolvehost_end.append(self._on_dns_end)
+        config.on_connection_create_start.append(self._on_connect_start)
+        config.on_connection_create_end.append(self._on_connect_end)
+        config.on_request_end.append(self._on_request_end)
+        return config
+
+    async def _on_request_start(self, session, ctx, params):
+        ctx.start = time.monotonic()
+
+    async def _on_dns_start(self, session, ctx, params):
+        ctx.dns = time.monotonic()
+
+    async def _on_dns_end(self, session, ctx, params):
+        self.timings['dns'].append(time.monotonic() - ctx.dns)
+
+    async def _on_connect_start(self, session, ctx, params):
+        ctx.connect = time.monotonic()
+
+    async def _on_connect_end(self, session, ctx, params):
+        self.timings['connect'].append(time.monotonic() - ctx.connect)
+
+    async def _on_request_end(self, session, ctx, params):
+        self.timings['headers'].append(time.monotonic() - ctx.start)
+
+    def record(self, seconds, nbytes):
+        """ Record a finished request, called once the body is read """
+        self.requests += 1
+        self.bytes += nbytes
+        self.timings['total'].append(seconds)
+
+    def summary(self):
+        """
+        (dict) --> request count, bytes and p50/p90/max for each timing
+        """
+        summary = {'requests': self.requests, 'bytes': self.bytes}
+        for name, values in self.timings.items():
+            if len(values) == 0:
+                continue
+            summary[name] = dict(count=len(values), **_percentiles(values))
+        return summary
+
+
+class DeadlineScheduler(object):
+    """
+    Decides how much of the collection list an invocation takes on
+
+    Each admitted ticker adds its cost in chains (the historical number
+    of expirations, see _load_ticker_costs) to the pending chains until
+    Stage 2 finds the real number, every chain collected, reported or
+    handed off takes one back off. Pending chains drain at the rate the
+    last DEADLINEWINDOW chains were collected at, Stage 1 only admits a
+    ticker if all of it is predicted to drain before the deadline,
+    DEADLINEMS before the invocation times out. Past the deadline no
+    requests are made, what is left is handed to the next invocation
+    """
+    DEFAULTCHAINS = 10
+
+    def __init__(self, context, costs, deadline):
+        super(DeadlineScheduler, self).__init__()
+        self.context = context
+        self.costs = costs
+        self.deadline = deadline
+        # Tickers without history cost the average of the others
+        self.default = (
+            sum(costs.values()) / len(costs) if len(costs) > 0
+            else self.DEFAULTCHAINS
+            )
+        self.pending = 0
+        self.admitted = 0
+        # (list) of tickers and [ticker, expiration, attempt] chains left
+        #  for the next invocation
+        self.tickers = []
+        self.chains = []
+        self._estimates = {}
+        self._collected = collections.deque(maxlen=DEADLINEWINDOW)
+
+    def cost(self, ticker):
+        return self.costs.get(ticker, self.default)
+
+    def remaining(self):
+        """ Seconds left until the deadline """
+        return (
+            self.context.get_remaining_time_in_millis() - self.deadline
+            ) / 1000.
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def rate(self):
+        """ Chains collected per second """
+        if len(self._collected) > 1:
+            elapsed = self._collected[-1] - self._collected[0]
+            if elapsed > 0:
+                return (len(self._collected) - 1) / elapsed
+        return CONTROLLER.limit / DEADLINECHAINSECONDS
+
+    def admit(self, ticker):
+        """
+        True if ticker is predicted to be collected before the deadline,
+        the first ticker is always admitted
+        """
+        cost = self.cost(ticker)
+        if (self.admitted > 0 and
+                (self.pending + cost) / self.rate() > self.remaining()):
+            return False
+        self._estimates[ticker] = cost
+        self.pending += cost
+        self.admitted += 1
+        return True
+
+    def room(self):
+        """
+        Number of tickers of the average cost predicted to be collected
+        before the deadline on top of the pending chains, at least 1
+        until a ticker is admitted
+        """
+        room = int(
+            (self.remaining() * self.rate() - self.pending) / self.default
+            )
+        return max(1 if self.admitted == 0 else 0, room)
+
+    def resume(self, chains):
+        """ Chains handed over by the last invocation """
+        self.pending += len(chains)
+
+    def expand(self, ticker, chains):
+        """ Stage 2 found the number of chains of an admitted ticker """
+        if chains > 0:
+            self.costs[ticker] = chains
+        self.pending += chains - self._estimates.pop(ticker, 0)
+
+    def finished(self, collected=True):
+        """ A chain was collected, or given up on """
+        self.pending -= 1
+        if collected:
+            self._collected.append(time.monotonic())
+
+    def handoff(self, ticker, expiration_date=None, attempt=0):
+        """ Leave a ticker, or one of its chains, to the next invocation """
+        if expiration_date is None:
+            self.pending -= self._estimates.pop(ticker, 0)
+            self.tickers.append(ticker)
+        else:
+            self.pending -= 1
+            self.chains.append([ticker, expiration_date, attempt])
+
+    def summary(self):
+        """
+        (dict) --> admitted tickers, what is handed off and the rate
+        """
+        return {
+            'admitted': self.admitted,
+            'tickers': len(self.tickers),
+            'chains': len(self.chains),
+            'chains/s': round(self.rate(), 2)
+            }
+
+
+class MeteredTable(object):
+    """
+    Requests to a DynamoDB table metered against a capacity budget of
+    capacity units per second with a token bucket holding up to burst
+    seconds of capacity. The estimated units of a request are taken
+    before it is made and settled against the ConsumedCapacity DynamoDB
+    returns, a throttle empties the bucket so the requests fall back to
+    the sustained budget
+    """
+    def __init__(self, table, capacity, burst):
+        super(MeteredTable, self).__init__()
+        self.table = table
+        self.capacity = capacity
+        self.burst = capacity * burst
+        self.tokens = self.burst
+        self.stamp = self.started = time.monotonic()
+        self.stats = {
+            'items': 0, 'units': 0., 'batches': 0, 'unprocessed': 0,
+            'throttles': 0, 'waited': 0.
+            }
+        # Seconds of each round trip
+        self.latencies = []
+        # The workers take their turn at the bucket, one refills, waits
+        #  and takes its units while the others queue
+        self.lock = asyncio.Lock()
+
+    async def _acquire(self, units):
+        """ Wait until the bucket can cover units then take them """
+        if self.capacity <= 0:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.stamp) * self.capacity
+                )
+            self.stamp = now
+            # A batch bigger then the bucket goes once the bucket is full
+            needed = min(units, self.burst)
+            if self.tokens < needed:
+                wait = (needed - self.tokens) / self.capacity
+                self.stats['waited'] += wait
+                await asyncio.sleep(wait)
+                self.tokens += wait * self.capacity
+                self.stamp += wait
+            self.tokens -= units
+
+    async def _throttled(self):
+        self.stats['throttles'] += 1
+        self.tokens = min(self.tokens, 0.)
+        await CONTROLLER.throttled()
+
+    async def _backoff(self, attempt):
+        """ Full jitter before retry attempt + 1 """
+        if attempt < DBWRITEATTEMPTS:
+            await asyncio.sleep(random.uniform(
+                0, min(DBWRITEMAXDELAY, DBWRITEBASEDELAY * 2 ** attempt)
+                ))
+
+    def summary(self):
+        """
+        (dict) --> items and units, units per second over the tables
+            lifetime, retried items, throttles and seconds spent waiting
+            on the budget
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        summary = dict(self.stats)
+        summary['units'] = round(summary['units'], 1)
+        summary['waited'] = round(summary['waited'], 2)
+        summary['units/s'] = round(self.stats['units'] / elapsed, 2)
+        if len(self.latencies) > 0:
+            summary['latency'] = _percentiles(self.latencies)
+        return summary
+
+
+class MeteredWriter(MeteredTable):
+    """
+    Batch writes to a DynamoDB table metered against a write capacity
+    budget of capacity WCU per second (see MeteredTable).
+    UnprocessedItems and throttled batches are retried with backoff
+    """
+
+    async def write(self, items):
+        """
+        Put items 25 at a time (the batch_write_item limit). Returns the
+        items that were still unprocessed after DBWRITEATTEMPTS retries,
+        exceptions other then throttling are raised
+        """
+
+        failed = []
+        for i in range(0, len(items), 25):
+            failed += await self._write_batch(items[i:i + 25])
+        return failed
+
+    async def _write_batch(self, items):
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        for attempt in range(DBWRITEATTEMPTS + 1):
+            estimate = sum(
+                _writeUnits(request['PutRequest']['Item'])
+                for request in requests
+                )
+            await self._acquire(estimate)
+            start = time.monotonic()
+            try:
+                # Round trip on a writer thread, the loop keeps serving
+                #  the HTTP stages meanwhile
+                response = await asyncio.get_running_loop().run_in_executor(
+                    _get_db_executor(), _batch_write_item,
+                    {self.table.name: requests}
+                    )
+            except Exception as e:
+                self.latencies.append(time.monotonic() - start)
+                if not _is_throttle(e):
+                    raise
+                # Nothing in the batch was written
+                self.tokens += estimate
+                self.stats['unprocessed'] += len(requests)
+                await self._throttled()
+            else:
+                self.latencies.append(time.monotonic() - start)
+                consumed = sum(
+                    capacity.get('CapacityUnits', 0)
+                    for capacity in response.get('ConsumedCapacity', [])
+                    )
+                self.tokens += estimate - consumed
+                unprocessed = response.get(
+                    'UnprocessedItems', {}
+                    ).get(self.table.name, [])
+                self.stats['items'] += len(requests) - len(unprocessed)
+                self.stats['units'] += consumed
+                self.stats['batches'] += 1
+                if len(unprocessed) == 0:
+                    return []
+                self.stats['unprocessed'] += len(unprocessed)
+                requests = unprocessed
+                await self._throttled()
+
+            await self._backoff(attempt)
+
+        return [request['PutRequest']['Item'] for request in requests]
+
+
+class ChainHashes(MeteredTable):
+    """
+    Last stored hash of the chains the invocation collects, read from
+    OptionsHistChainHashes with batch_get_item metered against a read
+    capacity budget of capacity RCU per second (see MeteredTable).
+    prefetch starts reading the keys (ticker, "YYYYmmdd" expiration) as
+    soon as they are known, keys prefetched within HASHBATCHSECONDS of
+    each other share a batch of up to 100 (the batch_get_item limit).
+    get waits on the read of a key, reading it right away if it was
+    never prefetched. UnprocessedKeys and throttled batches are retried
+    with backoff, a key that can't be read counts as never stored so its
+    chain is stored in full
+    """
+    def __init__(self, table, capacity, burst):
+        super(ChainHashes, self).__init__(table, capacity, burst)
+        # {(ticker, "YYYYmmdd"): future of (hash, SameAs) or None}
+        self.hashes = {}
+        # Keys waiting on the next batch and the timer that sends it
+        self.pending = []
+        self.timer = None
+        self.reads = set()
+
+    def prefetch(self, ticker, expirations):
+        """ Read the hashes of ticker's "YYYYmmdd" expirations """
+        loop = asyncio.get_running_loop()
+        for expiration in expirations:
+            key = (ticker, expiration)
+            if key not in self.hashes:
+                self.hashes[key] = loop.create_future()
+                self.pending.append(key)
+        if len(self.pending) >= 100:
+            self.flush()
+        elif len(self.pending) > 0 and self.timer is None:
+            self.timer = loop.call_later(HASHBATCHSECONDS, self.flush)
+
+    def flush(self):
+        """ Send the keys waiting on a batch """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for i in range(0, len(self.pending), 100):
+            read = asyncio.ensure_future(
+                self._read_batch(self.pending[i:i + 100])
+                )
+            self.reads.add(read)
+            read.add_done_callback(self.reads.discard)
+        self.pending = []
+
+    async def get(self, ticker, expiration):
+        """
+        (hash, TimeCollectedExpirationDate) of the last stored copy of
+            the chain or None
+        """
+        key = (ticker, expiration)
+        if key not in self.hashes:
+            self.prefetch(ticker, [expiration])
+            self.flush()
+        return await self.hashes[key]
+
+    async def _read_batch(self, keys):
+        found = {}
+        requests = [
+            {'Ticker': ticker, 'Expiration': expiration}
+            for ticker, expiration in keys
+            ]
+        try:
+            for attempt in range(DBWRITEATTEMPTS + 1):
+                # Eventually consistent reads of items under 4KB
+                estimate = .5 * len(requests)
+                await self._acquire(estimate)
+                start = time.monotonic()
+                try:
+                    response = await asyncio.get_running_loop(
+                        ).run_in_executor(
+                            _get_db_executor(), _batch_get_item,
+                            {self.table.name: {
+                                'Keys': requests,
+                                'ProjectionExpression':
+                                    'Ticker, Expiration, #hash, SameAs',
+                                'ExpressionAttributeNames': {
+                                    '#hash': 'Hash'
+                                    }
+                                }}
+                            )
+                except Exception as e:
+                    self.latencies.append(time.monotonic() - start)
+                    if not _is_throttle(e):
+                        raise
+                    self.tokens += estimate
+                    self.stats['unprocessed'] += len(requests)
+                    await self._throttled()
+                else:
+                    self.latencies.append(time.monotonic() - start)
+                    consumed = sum(
+                        capacity.get('CapacityUnits', 0)
+                        for capacity in response.get('ConsumedCapacity', [])
+                        )
+                    self.tokens += estimate - consumed
+                    for item in response.get(
+                            'Responses', {}).get(self.table.name, []):
+                        found[(item['Ticker'], item['Expiration'])] = (
+                            item['Hash'], int(item['SameAs'])
+                            )
+                    unprocessed = response.get(
+                        'UnprocessedKeys', {}
+                        ).get(self.table.name, {}).get('Keys', [])
+                    self.stats['items'] += len(requests) - len(unprocessed)
+                    self.stats['units'] += consumed
+                    self.stats['batches'] += 1
+                    if len(unprocessed) == 0:
+                        break
+                    self.stats['unprocessed'] += len(unprocessed)
+                    requests = unprocessed
+                    await self._throttled()
+
+                await self._backoff(attempt)
+            else:
+                logger.warning("Chain hashes not read -- {}".format(
+                    len(requests)
+                    ))
+        except Exception as e:
+            logger.warning("Unable to load chain hashes -- {}".format(e))
+        finally:
+            for key in keys:
+                if not self.hashes[key].done():
+                    self.hashes[key].set_result(found.get(key))
+
+
+class StageQueue(asyncio.Queue):
+    """
+    asyncio.Queue between two stages of the Pipeline that counts the
+    items put on it and keeps the most it ever held (high-water mark)
+    """
+    def _init(self, maxsize):
+        super(StageQueue, self)._init(maxsize)
+        self.puts = 0
+        self.high_water = 0
 
-# Played around, these seem to work the best to saturate the Lambda's
-# ENI and stays with in current memory setting for this function as well
-# keeps the write capacity units (WRUs) for DynamoDB under 8
-TICKERQUEUESIZE = int(os.environ['TICKERQUEUESIZE'])
-MAXCONNECTIONS = int(os.environ['MAXCONNECTIONS'])
+    def _put(self, item):
+        super(StageQueue, self)._put(item)
+        self.puts += 1
+        self.high_water = max(self.high_water, self.qsize())
 
-# Initialize AWS service clients and resources
-table = boto3.resource('dynamodb').Table("OptionsHist")
-ticker_table = boto3.resource('dynamodb').Table("OptionsHistTickers")
-lambdaclient = boto3.client('lambda')
-sqsqueue = boto3.resource('sqs').Queue(os.environ['NOTREACHABLESQS'])
 
-# USED to collect all the unreachable messages to be sent to SQS
-#  for update of the OptionsHistTicker Table
-UNREACHABLEMESSAGES = None
+class StagePriorityQueue(StageQueue, asyncio.PriorityQueue):
+    """ StageQueue that hands out the lowest item first """
 
-# Stage shutdown globals these should all be wrapped in a class I think
-#  this will work for now give more freedom on picking stage concurrency
-stage1shutdown = None
-stage2shutdown = None
-stage3shutdown = None
-stage4shutdown = None
-stage5shutdown = None
 
+class ByteBudgetQueue(StageQueue):
+    """
+    StageQueue bounded by the approximate bytes of the items it holds as
+    well as their count. put waits while budget bytes are held, unless
+    the queue is empty, sizeof(item) gives the bytes of an item. Keeps
+    the most bytes it ever held (bytes_high_water)
+    """
+    def __init__(self, maxsize=0, budget=0, sizeof=None):
+        self.budget = budget
+        self.sizeof = sizeof
+        super(ByteBudgetQueue, self).__init__(maxsize)
+
+    def _init(self, maxsize):
+        super(ByteBudgetQueue, self)._init(maxsize)
+        self.nbytes = 0
+        self.bytes_high_water = 0
+        # Bytes of each item in the queue, in order
+        self._sizes = collections.deque()
+        self._size = None
+        # Futures of the puts waiting for room
+        self._room = []
+
+    def _over(self, size):
+        return (self.budget > 0 and self.nbytes > 0 and
+                self.nbytes + size > self.budget)
+
+    async def put(self, item):
+        size = self.sizeof(item)
+        while self.full() or self._over(size):
+            room = asyncio.get_running_loop().create_future()
+            self._room.append(room)
+            await room
+        self._size = size
+        self.put_nowait(item)
+
+    def _put(self, item):
+        size = self._size if self._size is not None else self.sizeof(item)
+        self._size = None
+        self._sizes.append(size)
+        self.nbytes += size
+        self.bytes_high_water = max(self.bytes_high_water, self.nbytes)
+        super(ByteBudgetQueue, self)._put(item)
+
+    def _get(self):
+        item = super(ByteBudgetQueue, self)._get()
+        self.nbytes -= self._sizes.popleft()
+        # Every waiting put looks at the room left again
+        room, self._room = self._room, []
+        for waiter in room:
+            if not waiter.done():
+                waiter.set_result(None)
+        return item
+
+
+class Stage(object):
+    """
+    A stage of the collection Pipeline, workers coroutines each taking
+    the next item off queue and awaiting handler(stage, item). batch
+    stages get every item that is waiting as a list instead. A stage
+    without a queue is the source, its workers run handler(stage) once
+
+    Handlers pass items on to the next stage with Stage.put. Per stage
+    counters, all times in seconds
+        items in/out --> items taken off queue, items put downstream
+        busy --> time spent in handler, less the time blocked
+        blocked --> time waiting for room on a downstream queue
+        idle --> time the workers were waiting for items
+        latency --> time handler took for each item (batch)
+    """
+    def __init__(self, name, queue, handler, workers=1, batch=False):
+        super(Stage, self).__init__()
+        self.name = name
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.batch = batch
+        self.items_in = 0
+        self.items_out = 0
+        self.busy = 0.
+        self.blocked = 0.
+        self.latencies = []
+
+    async def put(self, queue, item):
+        """ Put item on the queue of the next stage """
+        start = time.monotonic()
+        await queue.put(item)
+        blocked = time.monotonic() - start
+        self.blocked += blocked
+        STAGEBLOCKED.set(STAGEBLOCKED.get() + blocked)
+        self.items_out += 1
+
+    async def _run(self, items):
+        token = STAGEBLOCKED.set(0.)
+        start = time.monotonic()
+        try:
+            if self.queue is None:
+                await self.handler(self)
+            else:
+                await self.handler(self, items if self.batch else items[0])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The stage handlers report their own errors, this keeps one
+            #  that got away from taking a worker down with it
+            logger.error("Stage {} -- {}".format(self.name, e))
+        elapsed = time.monotonic() - start
+        self.busy += elapsed - STAGEBLOCKED.get()
+        STAGEBLOCKED.reset(token)
+        self.latencies.append(elapsed)
+
+    async def work(self):
+        """ Worker coroutine, runs until cancelled by the Pipeline """
+        if self.queue is None:
+            await self._run(None)
+            return None
+
+        while True:
+            items = [await self.queue.get()]
+            if self.batch:
+                try:
+                    while True:
+                        items.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    pass
+            self.items_in += len(items)
+            try:
+                await self._run(items)
+            finally:
+                for item in items:
+                    self.queue.task_done()
 
-def _unreachable_message(ticker, expiration_date, e):
+    def summary(self, elapsed):
+        """
+        (dict) --> the stages counters over elapsed seconds of the
+            Pipeline running, latency p50/p90/max
+        """
+        summary = {
+            'workers': self.workers,
+            'in': self.items_in,
+            'out': self.items_out,
+            'busy': round(self.busy, 2),
+            'blocked': round(self.blocked, 2),
+            'idle': round(max(
+                0., self.workers * elapsed - self.busy - self.blocked
+                ), 2),
+            'utilization': round(
+                self.busy / max(self.workers * elapsed, 1e-9), 3
+                )
+            }
+        if self.queue is not None:
+            summary['queue'] = {
+                'maxsize': self.queue.maxsize,
+                'high_water': self.queue.high_water
+                }
+            if isinstance(self.queue, ByteBudgetQueue):
+                summary['queue'].update({
+                    'budget': self.queue.budget,
+                    'bytes_high_water': self.queue.bytes_high_water
+                    })
+        if len(self.latencies) > 0:
+            summary['latency'] = _percentiles(self.latencies)
+        return summary
+
+
+class Pipeline(object):
     """
-    Construct Invocations Unreachable SQS Message
+    Runs the collection stages, the first is the source. Once all the
+    source workers return the pipeline drains, it joins the queue of
+    every stage in order until a full round of joins sees nothing new
+    put on any of them. Only then are the stages, idle waiting on their
+    queues, cancelled. Stages can feed items back to earlier ones (the
+    retries of Stage 3) since all of the queues have to settle together
     """
-    global UNREACHABLEMESSAGES
-    if UNREACHABLEMESSAGES is None:
-        # Debug Error checking
-        raise Exception("UNREACHABLEMESSAGES is None")
+    def __init__(self, stages):
+        super(Pipeline, self).__init__()
+        self.stages = stages
+        self.elapsed = 0.
+
+    def _puts(self):
+        return sum(stage.queue.puts for stage in self.stages[1:])
+
+    async def run(self):
+        start = time.monotonic()
+        source = [
+            asyncio.ensure_future(self.stages[0].work())
+            for i in range(self.stages[0].workers)
+            ]
+        workers = [
+            asyncio.ensure_future(stage.work())
+            for stage in self.stages[1:] for i in range(stage.workers)
+            ]
+        try:
+            await asyncio.gather(*source)
+            while True:
+                puts = self._puts()
+                for stage in self.stages[1:]:
+                    await stage.queue.join()
+                if self._puts() == puts:
+                    break
+        finally:
+            for task in source + workers:
+                task.cancel()
+            await asyncio.gather(*source, *workers, return_exceptions=True)
+            self.elapsed = time.monotonic() - start
+
+    def summary(self):
+        """ (dict) --> {stage name: Stage.summary()} and the seconds run """
+        summary = {'seconds': round(self.elapsed, 2)}
+        for stage in self.stages:
+            summary[stage.name] = stage.summary(self.elapsed)
+        return summary
+
+
+class EmbeddedMetrics(object):
+    """
+    Throughput telemetry of an invocation as a CloudWatch Embedded Metric
+    Format record. Counts what the other summaries don't keep (tickers
+    and rows collected, the largest chain in flight, CPU seconds of
+    parsing and encoding), record() adds the Pipeline, HTTPTimings,
+    DeadlineScheduler, MeteredWriter and MemoryWatchdog numbers and
+    emit() prints it to stdout, where CloudWatch Logs turns it in to
+    metrics of the EMFNAMESPACE namespace with a FunctionName
+    dimension. No PutMetricData calls or log scraping needed
+    """
+    def __init__(self):
+        super(EmbeddedMetrics, self).__init__()
+        self.tickers = set()
+        self.rows = 0
+        # Largest chain passed from Stage 3 to 4, see _chainBytes
+        self.chainbytes = 0
+        # {function name: CPU seconds} see _run_cpu_bound
+        self.cpu = collections.Counter()
+
+    def collected(self, ticker, data):
+        """ A chain of ticker was encoded, data as Stage 3 passed it """
+        self.tickers.add(ticker)
+        self.rows += sum(
+            len(table) for table in (data['calls'], data['puts'])
+            if table is not None
+            )
+        self.chainbytes = max(
+            self.chainbytes, _chainBytes((ticker, None, data))
+            )
 
-    try:
-        UNREACHABLEMESSAGES[ticker].append((expiration_date, str(e)))
-    except KeyError:
-        UNREACHABLEMESSAGES[ticker] = [[expiration_date, str(e)]]
+    def record(self, pipeline, scheduler, httpstats, writers, watchdog):
+        """
+        (Pipeline.summary(), DeadlineScheduler, HTTPTimings,
+            list[MeteredWriter], MemoryWatchdog) --> (dict) the EMF record
+        """
+
+        seconds = max(pipeline['seconds'], 1e-9)
+        handed = scheduler.summary()
+        chains = writers[0].stats['items']
+        metrics = [
+            ('Tickers', len(self.tickers), 'Count'),
+            ('Chains', chains, 'Count'),
+            ('UnchangedChains', UNCHANGEDCHAINS, 'Count'),
+            ('Rows', self.rows, 'Count'),
+            ('Seconds', round(seconds, 3), 'Seconds'),
+            ('ChainsPerSecond', round(chains / seconds, 3), 'Count/Second'),
+            ('RowsPerSecond', round(self.rows / seconds, 1), 'Count/Second'),
+            ('HandedOffTickers', handed['tickers'], 'Count'),
+            ('HandedOffChains', handed['chains'], 'Count'),
+            ('HTTPRequests', httpstats.requests, 'Count'),
+            ('HTTPBytes', httpstats.bytes, 'Bytes'),
+            ('HTTPBytesPerSecond', round(httpstats.bytes / seconds, 1),
+                'Bytes/Second'),
+            ('ParseCPUSeconds', round(
+                self.cpu['_extractOptionsTables'], 3), 'Seconds'),
+            ('EncodeCPUSeconds', round(
+                self.cpu['_encodeOptionsTable'], 3), 'Seconds'),
+            ('DBWriteUnits', round(sum(
+                writer.stats['units'] for writer in writers), 1), 'Count'),
+            ('DBWriteThrottles', sum(
+                writer.stats['throttles'] for writer in writers), 'Count'),
+            ('DBWriteWaited', round(sum(
+                writer.stats['waited'] for writer in writers), 3),
+                'Seconds'),
+            ('PeakRSS', round(watchdog.peak / 2 ** 20, 1), 'Megabytes'),
+            ('PeakChainBytes', self.chainbytes, 'Bytes'),
+            ('MemoryPressureCuts', watchdog.cuts + watchdog.critical,
+                'Count')
+            ]
+        latencies = [
+            ('HTTPLatency', httpstats.timings['total']),
+            ('DBWriteLatency', [
+                latency for writer in writers for latency in writer.latencies
+                ])
+            ]
+        for name, values in latencies:
+            if len(values) > 0:
+                for stat, value in _percentiles(values).items():
+                    metrics.append((
+                        name + stat.capitalize(), round(1000 * value, 1),
+                        'Milliseconds'
+                        ))
+        for name, stage in pipeline.items():
+            if isinstance(stage, dict) and 'queue' in stage:
+                metrics.append((
+                    name.capitalize() + 'QueueHighWater',
+                    stage['queue']['high_water'], 'Count'
+                    ))
+                if 'bytes_high_water' in stage['queue']:
+                    metrics.append((
+                        name.capitalize() + 'QueueBytesHighWater',
+                        stage['queue']['bytes_high_water'], 'Bytes'
+                        ))
+
+        record = {
+            '_aws': {
+                'Timestamp': int(1000 * time.time()),
+                'CloudWatchMetrics': [{
+                    'Namespace': EMFNAMESPACE,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [
+                        {'Name': name, 'Unit': unit}
+                        for name, _, unit in metrics
+                        ]
+                    }]
+                },
+            'FunctionName': os.environ.get(
+                'AWS_LAMBDA_FUNCTION_NAME', 'OptionsHistory-CollectDataFunc'
+                ),
+            'run_timestamp': UNREACHABLEMESSAGES.run_timestamp
+            }
+        record.update((name, value) for name, value, _ in metrics)
+        return record
 
+    def emit(self, *args):
+        """ Print record(*args) as a single line for CloudWatch Logs """
+        print(json.dumps(self.record(*args)), flush=True)
 
-def _build_options_url(ticker, date=None):
+
+def _build_http_session():
+    """
+    Helper Function
+    Build the aiohttp.ClientSession shared across all stages. Masqurade
+    as a firefox client, ask for compressed pages, cache DNS lookups,
+    keep connections alive between requests and never let a single
+    request hang past the HTTP timeouts
     """
-    Help Function
-    Constructs the URL pointing directly to the options chain for a
-     ticker and optional date
 
-    Inputs:
-        ---------------------------------------------------------------
-        ticker --> (string) i.e. "AAPL"
-        date --> (string) "Month DD, YYYY" i.e. May 15, 2020
+    connector = aiohttp.TCPConnector(
+        limit=CONCURRENCYMAX + CONTROLLER.expirations_limit(CONCURRENCYMAX),
+        limit_per_host=HTTPLIMITPERHOST,
+        use_dns_cache=True,
+        ttl_dns_cache=HTTPDNSCACHETTL,
+        keepalive_timeout=HTTPKEEPALIVE,
+        enable_cleanup_closed=True
+        )
+    timeout = aiohttp.ClientTimeout(
+        total=HTTPTOTALTIMEOUT,
+        sock_connect=HTTPCONNECTTIMEOUT,
+        sock_read=HTTPREADTIMEOUT
+        )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        trace_configs=[HTTPSTATS.trace_config()],
+        headers={
+            "user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:75.0)"
+            + " Gecko/20100101 Firefox/75.0",
+            "Accept": "text/html",
+            "Accept-Encoding": HTTPACCEPTENCODING
+            }
+        )
 
-    Caveats: Future
-        ---------------------------------------------------------------
-        1.) This is url format that currently works on a majority of
-            tickers for yahoo finance. NOT future proof in way.
 
+async def _fetch_html(HTTPSession, url, limit):
     """
+    Helper Function
+    GET url while holding a slot of limit (AdaptiveLimit)
 
-    url = "https://finance.yahoo.com/quote/" + ticker + "/options?p=" + ticker
-    if date is not None:
-        url = url + "&date=" + str(int(pd.Timestamp(date).timestamp()))
+    Output:
+        ---------------------------------------------------------------
+        (string, float) --> the page and the seconds the request took
 
-    return url
+    Failed requests are recorded with the CONTROLLER and re-raised,
+    requests still waiting or in flight at the deadline are cancelled
+    """
 
+    async def _get():
+        async with limit:
+            async with HTTPSession.get(url) as response:
+                response.raise_for_status()
+                return await response.text(), response.content_length
 
-def _encodeOptionsTable(optstab):
+    start = time.monotonic()
+    try:
+        html, nbytes = await asyncio.wait_for(_get(), SCHEDULER.remaining())
+    except asyncio.TimeoutError:
+        if SCHEDULER.expired():
+            raise Exception("Deadline Reached") from None
+        await CONTROLLER.record(time.monotonic() - start, error=True)
+        raise Exception("HTTP Request Timed Out") from None
+    except Exception:
+        await CONTROLLER.record(time.monotonic() - start, error=True)
+        raise
+
+    seconds = time.monotonic() - start
+    HTTPSTATS.record(seconds, nbytes if nbytes is not None else len(html))
+    return html, seconds
+
+
+async def _retry_or_report(stage, retry_queue, ticker, expiration_date,
+                           attempt, errors):
     """
     Helper Function
-    Inputs:
-        ---------------------------------------------------------------
-        optstab --> (pd.DataFrame) Generated from pandas.read_html()
+    Schedule a failed (ticker, expiration) on the retry stage with full
+    jitter exponential backoff, expiration_date None is the base page of
+    the ticker (Stage 2). Once it has used its RETRYATTEMPTS report the
+    errors as unreachable instead, retries that would come due past the
+    deadline are handed to the next invocation
+    """
 
-    Output:
-        ---------------------------------------------------------------
-        (JSON) -->
-            {
-                "Last Trade Date" --> (list[(strings)])
-                "Column Labels" --> (list[(strings)])
-                "Shape" --> base64 encoded np.array(dtype=np.int32)
-                "Table" --> base64 encoded np.array(dtype=np.float16).flatten()
-            }
+    if attempt >= RETRYATTEMPTS:
+        for e in errors:
+            _unreachable_message(ticker, expiration_date or "NONE", e)
+        if expiration_date is None:
+            SCHEDULER.expand(ticker, 0)
+        else:
+            SCHEDULER.finished(collected=False)
+        return None
 
-    Caveats: Future
-        ---------------------------------------------------------------
-        1.) This is also highly coupled to everything else in this file
-            not future proof
+    delay = random.uniform(
+        0, min(RETRYMAXDELAY, RETRYBASEDELAY * 2 ** attempt)
+        )
+    if delay >= SCHEDULER.remaining():
+        SCHEDULER.handoff(ticker, expiration_date, attempt + 1)
+        return None
 
-    Tansforms the pandas.DataFrame generated by pandas.read_html(htmlsource)
-    for storage in DynamoDB.
+    await stage.put(retry_queue, (
+        time.monotonic() + delay, next(RETRYSEQUENCE),
+        (ticker, expiration_date, attempt + 1)
+        ))
 
-    Coverts to half-percision floats and base64 encodes the np.array,
-    sacrifices a little percision for reduced storage.
+
+def _expirationKey(expiration_date):
+    """
+    Helper Function
+    "Month DD, YYYY" expiration date as it is stored, "YYYYmmdd"
     """
 
-    def _string2Number(string):
-        """
-        Helper Function
-        Coverts the strings in pandas Dataframe to
-        floats.
-        """
+    return datetime.strptime(expiration_date, "%B %d, %Y").strftime('%Y%m%d')
 
-        if isinstance(string, str):
-            # Repalce Commas
-            if ',' in string:
-                # Pull all the commas out if they exist
-                string = string.replace(',', '')
 
-            if len(string) == 0 or string == "-":
-                return np.nan
-            if string[-1] == '%':
-                string = string[:-1]
+def _expiresAt(expiration):
+    """
+    Helper Function
+    Epoch seconds CHAINHASHDAYS after a "YYYYmmdd" expiration, when its
+    chain hash can be deleted
+    """
 
-        return float(string)
+    return int(datetime.strptime(expiration, '%Y%m%d').replace(
+        tzinfo=timezone.utc
+        ).timestamp()) + CHAINHASHDAYS * 86400
 
-    # If Options table is None return None
-    if optstab is None:
-        return optstab
 
-    # Drop redundent columns and hold on to string type columns
-    record = {}
-    optstab = optstab.drop(['Contract Name'], axis=1)
-    record['Last Trade Date'] = list(optstab['Last Trade Date'])
-    optstab = optstab.drop(['Last Trade Date'], axis=1)
-    record['Column Labels'] = list(optstab.keys())
-    optstab = optstab.to_numpy()
+def _chainHash(calls, puts):
+    """
+    Helper Function
+    Content hash of an items encoded calls and puts payloads
+    """
 
-    # Base64 encode the shape of the array for reconstruction
-    record['Shape'] = base64.b64encode(
-        np.array(optstab.shape, dtype=np.int32).tobytes()
-        ).decode('ascii')
+    digest = hashlib.sha1()
+    for payload in (calls, puts):
+        if payload is None:
+            digest.update(b'\x00')
+            continue
+        if isinstance(payload, str):
+            payload = payload.encode()
+        digest.update(b'\x01' + len(payload).to_bytes(8, 'big'))
+        digest.update(payload)
+    return digest.hexdigest()
 
-    # Map sting values to numbers, convert to half percision numbers
-    #  and base64 incode the array
-    record['Table'] = base64.b64encode(
-            np.array(
-                list(map(_string2Number, optstab.flatten())),
-                dtype=np.float16
-                ).tobytes()
-            ).decode('ascii')
 
-    return json.dumps(record)
+def _listedExpirations(html):
+    """
+    Helper Function
+    Expiration dates "Month DD, YYYY" of the drop down menu every
+    options page has, empty if the page has none
+    """
+
+    # Find the option elements for the drop down menu
+    # parse into a list of dates
+    splits = html.split("</option>")
+    dates = [elt[elt.rfind(">"):].strip(">") for elt in splits]
+    return [elt for elt in dates if elt != '']
+
 
 #######################################################################
 # Main Async functions that implements the stages of the collection
 # pipeline
 
 
-async def ticker_handler(tickers, context, queue_out, HTTPSession):
+async def ticker_handler(stage, tickers, context, queue_out):
     """
     STAGE 1
     Inputs:
         ----------------------------------------------------------------
+        stage --> (Stage) this stage of the Pipeline
         tickers --> (list) tickers that still need to be collected
         context --> (lambda context) the context object passed to the
             handler
-        queue_out --> (asynio.Queue) Queue that stages
-            (ticker, expiration dates) for the next stage in the pipeline
-        HTTPSession --> (aiohttp.ClientSession) shared object for making
-            http request across all stages
+        queue_out --> (StageQueue) Queue that stages tickers for the
+            next stage in the pipeline
 
     Reminders:
         ----------------------------------------------------------------
-        STAGE 1: of the async pipline called as a coroutine from
-            async_handler. Single instance of this function stages
-            (ticker, expiration date) for chain_request(Stage 2).
+        STAGE 1: the source of the Pipeline. Single instance of this
+            function stages tickers for get_expiration_dates(Stage 2).
+            Tickers are staged for as long as the SCHEDULER predicts
+            they can be collected before the deadline, the Pipeline
+            drains and shuts down the other stages once it returns
     """
-    global stage1shutdown
 
     # Process the tickers and stage them for stage 2
     while len(tickers) > 0:
 
-        if (context.get_remaining_time_in_millis() < 260000 and
-                len(tickers) > 0):
-            # running out of time and there are still tickers
-            #  invoke another lambda function and initiate shutdown of
-            #  the other stages
+        if not SCHEDULER.admit(tickers[-1]):
+            # No time for the next ticker in this invocation invoke
+            #  another lambda function for the tickers left
             logger.info(
-                "Time remaining: {}, Number of Tickers Left: {}".format(
-                    context.get_remaining_time_in_millis(), len(tickers))
-                )
-            lambdaclient.invoke(
-                FunctionName='OptionsHistory-CollectDataFunc',
-                InvocationType='Event',
-                Payload=json.dumps(
-                    {
-                        'State': 'continue',
-                        'Tickers': tickers,
-                        'run_timestamp': UNREACHABLEMESSAGES['run_timestamp']
-                    }
-                    ).encode()
+                "Time remaining: {}, Number of Tickers Left: {}, "
+                "Pending chains: {}".format(
+                    context.get_remaining_time_in_millis(), len(tickers),
+                    SCHEDULER.pending)
                 )
-
-            break
-        elif len(tickers) == 0:
+            _invoke_collector(tickers)
             break
         else:
-            ticker = tickers.pop()
-            await queue_out.put(ticker)
-            logger.debug(
-                        "QSIZE STAGE1 -> STAGE2 -- {}".format(
-                            queue_out.qsize()
-                            )
-                        )
+            await stage.put(queue_out, (tickers.pop(), 0))
 
-    # Signal stage 2 that no more values are coming finish up and shutdown
-    stage1shutdown = True
-    await queue_out.put(None)
     logger.debug("STAGE1 RETURNING")
     return None
 
 
-async def get_expiration_dates(queue_in, queue_out, HTTPSession):
+async def work_handler(stage, work, queue_out, retry_queue):
+    """
+    STAGE 1 (work queue)
+    Inputs:
+        ----------------------------------------------------------------
+        stage --> (Stage) this stage of the Pipeline
+        work --> (WorkQueue) work items of the collection run
+        queue_out --> (StageQueue) Queue that stages tickers for the
+            next stage in the pipeline
+        retry_queue --> (StagePriorityQueue) Queue between Stage 3 and
+            its retry stage, the chains of items that only hold
+            expirations start out there
+
+    Reminders:
+        ----------------------------------------------------------------
+        STAGE 1 of collectors pulling from WORKQUEUESQS, in place of
+            ticker_handler. Only as many items are received as the
+            SCHEDULER has room for and they're staged for as long as it
+            admits their tickers, the first item that doesn't fit and
+            the rest of its batch are released for other collectors.
+            Returns once no items are visible or there is no room left
+    """
+
+    loop = asyncio.get_running_loop()
+    while not SCHEDULER.expired() and not work.superseded:
+        room = SCHEDULER.room()
+        if room < 1:
+            # No time for another ticker, the rest is left to the other
+            #  collectors (or the next one, see WorkQueue.close)
+            break
+        items = await loop.run_in_executor(None, functools.partial(
+            work.receive, max(
+                1, min(WORKQUEUEWAIT, int(SCHEDULER.remaining()))
+                ), room
+            ))
+        if len(items) == 0:
+            # Items other collectors hold are theirs to finish
+            if await loop.run_in_executor(None, work.idle):
+                break
+            continue
+
+        for i, (item, message) in enumerate(items):
+            ticker = item['Ticker']
+            if 'Cost' in item:
+                TICKERCOSTS[ticker] = item['Cost']
+            if 'Seconds' in item:
+                TICKERSECONDS[ticker] = item['Seconds']
+            if 'Chains' in item:
+                chains = [
+                    (ticker, expiration_date, attempt)
+                    for expiration_date, attempt in item['Chains']
+                    ]
+                SCHEDULER.resume(chains)
+                if DEDUPCHAINS:
+                    CHAINHASHES.prefetch(ticker, [
+                        _expirationKey(expiration_date)
+                        for _, expiration_date, _ in chains
+                        ])
+                work.taken.append(message)
+                for chain in chains:
+                    await stage.put(retry_queue, (
+                        0, next(RETRYSEQUENCE), chain
+                        ))
+            elif SCHEDULER.admit(ticker):
+                work.taken.append(message)
+                await stage.put(queue_out, (ticker, 0))
+            else:
+                # No time for the ticker, leave it to another collector
+                logger.info(
+                    "Time remaining: {}, Pending chains: {}".format(
+                        SCHEDULER.context.get_remaining_time_in_millis(),
+                        SCHEDULER.pending)
+                    )
+                await loop.run_in_executor(
+                    None, work.release, [m for _, m in items[i:]]
+                    )
+                return None
+
+    logger.debug("STAGE1 RETURNING")
+    return None
+
+
+async def get_expiration_dates(stage, request, queue_out, chains_out,
+                               retry_queue, HTTPSession):
     """
     Stage 2
     Input:
         -----------------------------------------------------------
-        ticker --> (String) i.e. "AAPL"
+        request --> (ticker, attempt) i.e. ("AAPL", 0)
 
     Output:
         -----------------------------------------------------------
-        (list) of expiration dates for options contracts in format
-            "Month DD, YYYY" i.e. May 15, 2020
+        queue_out --> (StageQueue) (ticker, expiration date, attempt)
+            for Stage 3, expiration dates in format "Month DD, YYYY"
+            i.e. May 15, 2020
+        chains_out --> (StageQueue) Queue between Stage 3 and 4, the
+            base options page already holds the chain for the nearest
+            expiration so its tables skip Stage 3 and go straight here
+        retry_queue --> (StagePriorityQueue) Queue between Stage 3 and
+            its retry stage, a base page that failed or listed no
+            expirations is retried from there as (ticker, None, attempt)
     """
-    global stage2shutdown
 
-    while True:
+    ticker, attempt = request
+    if SCHEDULER.expired():
+        SCHEDULER.handoff(ticker)
+        return None
 
-        ticker = await queue_in.get()
-        logger.debug(
-                    "QSIZE STAGE1 -> STAGE2 -- {}".format(
-                        queue_in.qsize()
-                        )
-                    )
-        if ticker is None:
-            # Run the concurrent task shutdown process
-            queue_in.task_done()
-            await queue_in.join()
-            if stage2shutdown is False:
-                await queue_out.put((None, None))
-                stage2shutdown = True
-            await queue_in.put(None)
-            logger.debug("STAGE2 RETURNING")
-            return None
+    # Get base URL for the ticker
+    url = _build_options_url(ticker)
+    try:
+        html, latency = await _fetch_html(
+            HTTPSession, url, CONTROLLER.expirations
+            )
+    except Exception as e:
+        if SCHEDULER.expired():
+            SCHEDULER.handoff(ticker)
+        else:
+            await _retry_or_report(
+                stage, retry_queue, ticker, None, attempt, [e]
+                )
+        return None
+
+    dates = _listedExpirations(html)
+    await CONTROLLER.record(latency, blocked=len(dates) == 0)
+
+    if len(dates) == 0:
+        # Blocked or company not found page, retried like a failed
+        #  request
+        await _retry_or_report(
+            stage, retry_queue, ticker, None, attempt,
+            [Exception("No Expiration Dates")]
+            )
+        return None
+    SCHEDULER.expand(ticker, len(dates))
 
-        # Get base URL for the ticker
-        url = _build_options_url(ticker)
-        async with HTTPSession.get(url) as response:
-            html = await response.text()
+    if DEDUPCHAINS:
+        # Last stored hashes so Stage 4 can skip unchanged chains
+        CHAINHASHES.prefetch(ticker, [_expirationKey(d) for d in dates])
 
-        # Find the option elements for the drop down menu
-        # parse into a list of dates
-        splits = html.split("</option>")
-        dates = [elt[elt.rfind(">"):].strip(">") for elt in splits]
-        dates = [elt for elt in dates if elt != '']
+    # Reuse the base page as the chain for the nearest expiration
+    #  if it has no tables let Stage 3 request it like the rest
+    start = time.monotonic()
+    data = {'calls': None, 'puts': None}
+    try:
+        data = await _run_cpu_bound(_extractOptionsTables, html)
+    except Exception as e:
+        # Stage 3 requests the nearest chain like the rest
+        logger.warning(
+            "Base page tables {} not parsed -- {}".format(ticker, e)
+            )
+    # Release the page before waiting on the next stage
+    html = None
 
-        if len(dates) == 0:
-            # If no expiration dates can be found log, and continue
+    if data['calls'] is None and data['puts'] is None:
+        first = 0
+    else:
+        if data['calls'] is None:
             _unreachable_message(
-                ticker, "NONE", Exception("No Expiration Dates")
+                ticker, dates[0], Exception("No Calls Data")
                 )
-            queue_in.task_done()
-            continue
+        if data['puts'] is None:
+            _unreachable_message(
+                ticker, dates[0], Exception("No Puts Data")
+                )
+        CHAINSECONDS[(ticker, _expirationKey(dates[0]))] = (
+            latency + time.monotonic() - start
+            )
+        await stage.put(chains_out, (ticker, dates[0], data))
+        SCHEDULER.finished()
+        first = 1
 
-        else:
-            for expire in dates:
-                await queue_out.put((ticker, expire))
-                logger.debug(
-                    "QSIZE STAGE2 -> STAGE3 -- {}".format(
-                        queue_out.qsize()
-                        )
-                    )
-            queue_in.task_done()
+    for expire in dates[first:]:
+        await stage.put(queue_out, (ticker, expire, 0))
 
 
-async def chain_request(queue_in, queue_out, HTTPSession):
+async def chain_request(stage, chain, queue_out, retry_queue, HTTPSession):
     """
     STAGE 3
     Inputs:
         ----------------------------------------------------------------
-        queue_in --> (asyncio.Queue) Queue between Stage 1 and this
-        queue_out --> (asyncio.Queue) Queue between this and Stage 3
+        chain --> (ticker, expiration date, attempt)
+        queue_out --> (StageQueue) Queue between this and Stage 4
+        retry_queue --> (StagePriorityQueue) Queue between this and
+            retry_chain_request, failed (ticker, expiration) are sent
+            there and come back to this stage
         HTTPSession --> (aiohttp.ClientSession) shared object for making
             http request across all stages
 
     Reminders:
         ----------------------------------------------------------------
-        Stage 2: of the aync pipeline. Called as coroutine from
-            asnyc_handler. Multiple instances of this function run
-            simultaneously
+        Stage 3: of the aync pipeline. Multiple workers of this stage
+            run simultaneously
     """
-    global stage3shutdown
-
-    while True:
-        # Block until the next (ticker, expiration_date) is queued
-        ticker, expiration_date = await queue_in.get()
-        logger.debug(
-                    "QSIZE STAGE2 -> STAGE3 -- {}".format(
-                        queue_in.qsize()
-                        )
-                    )
-        if ticker is None:
-            # Wait to make sure curcurrent tasks finish before signaling
-            #  stage 3 and other concurrent tasks to shutdown
-            queue_in.task_done()
-            await queue_in.join()
-            if stage3shutdown is False:
-                await queue_out.put((None, None, None))
-                logger.debug("PUT2STAGE4")
-                stage3shutdown = True
-            await queue_in.put((None, None))
-            logger.debug("STAGE3 RETURNING")
-            return None
 
-        else:
-            # try rap to collect and log errors with out failure
-            try:
-                # Make the intial HTTP request more elegent solution
-                #  is need here
-                url = _build_options_url(ticker, expiration_date)
-                async with HTTPSession.get(url) as response:
-                    html = await response.text()
+    ticker, expiration_date, attempt = chain
+    if SCHEDULER.expired():
+        # No new requests past the deadline
+        SCHEDULER.handoff(ticker, expiration_date, attempt)
+        return None
 
-                tables = pd.read_html(html)
-                data = {}
+    errors = []
+    # try rap to collect and log errors with out failure
+    try:
+        # Make the intial HTTP request more elegent solution
+        #  is need here
+        url = _build_options_url(ticker, expiration_date)
+        html, latency = await _fetch_html(
+            HTTPSession, url, CONTROLLER.chains
+            )
 
-                try:
-                    data['calls'] = tables[0]
-                except IndexError:
-                    _unreachable_message(
-                        ticker, expiration_date, Exception("No Calls Data")
-                        )
-                    data['calls'] = None
+        start = time.monotonic()
+        data = await _run_cpu_bound(_extractOptionsTables, html)
+        seconds = latency + time.monotonic() - start
+        # Only the compact tables wait on the next stage, not the page
+        html = None
+        await CONTROLLER.record(
+            latency,
+            blocked=data['puts'] is None and data['calls'] is None
+            )
 
-                try:
-                    data['puts'] = tables[1]
-                except IndexError:
-                    _unreachable_message(
-                        ticker, expiration_date, Exception("No Puts Data")
-                        )
-                    data['puts'] = None
-
-                if not (data['puts'] is None and data['calls'] is None):
-                    # If there is data push to encode_db_item stage
-                    await queue_out.put((ticker, expiration_date, data))
-                    logger.debug(
-                        "QSIZE STAGE3 -> STAGE4 -- {}".format(
-                            queue_out.qsize())
-                        )
-                else:
-                    # If no data was found log event and move to next item
-                    _unreachable_message(
-                        ticker, expiration_date, Exception("No Data")
-                        )
+        if data['puts'] is None and data['calls'] is None:
+            # If no data was found the request gets retried
+            errors = [
+                Exception("No Calls Data"),
+                Exception("No Puts Data"),
+                Exception("No Data")
+                ]
+        else:
+            if data['calls'] is None:
+                _unreachable_message(
+                    ticker, expiration_date, Exception("No Calls Data")
+                    )
 
-            except Exception as e:
-                _unreachable_message(ticker, expiration_date, e)
+            if data['puts'] is None:
+                _unreachable_message(
+                    ticker, expiration_date, Exception("No Puts Data")
+                    )
 
-            # Signal the queue task is complete for this (ticker, expiration)
-            queue_in.task_done()
+            # If there is data push to encode_db_item stage
+            CHAINSECONDS[(ticker, _expirationKey(expiration_date))] = (
+                seconds
+                )
+            await stage.put(queue_out, (ticker, expiration_date, data))
+            SCHEDULER.finished()
+
+    except Exception as e:
+        errors = [e]
+
+    if len(errors) > 0 and SCHEDULER.expired():
+        # Cancelled at the deadline, or it would be retried past it
+        SCHEDULER.handoff(ticker, expiration_date, attempt)
+    elif len(errors) > 0:
+        await _retry_or_report(
+            stage, retry_queue, ticker, expiration_date, attempt, errors
+            )
 
 
-async def encode_db_item(queue_in, queue_out):
+async def retry_chain_request(stage, retry, queue_out, tickers_out):
     """
-    STAGE 4
+    STAGE 3 (retries)
     Inputs:
         ----------------------------------------------------------------
-        queue_in --> (asyncio.Queue) Queue between Stage 2 and this
-        queue_out --> (asyncio.Queue) Queue between this and Stage 4
+        retry --> (due, sequence, (ticker, expiration date, attempt))
+            off the StagePriorityQueue between Stage 3 and this ordered
+            by when the retry is due, expiration date None retries the
+            base page of the ticker
+        queue_out --> (StageQueue) Queue between Stage 2 and 3, the
+            retry goes back in here
+        tickers_out --> (StageQueue) Queue between Stage 1 and 2, base
+            page retries go back in here
 
     Reminders:
         ----------------------------------------------------------------
-        Stage 4: of the aync pipeline. There is really no need for more
-        then one of this task to run. no blocking IO done here and I
-        beleive at the moment the lambda enviroment is a single core
+        Single worker of this stage waits out the backoff of each
+        failed (ticker, expiration) and hands it back to chain_request.
+        Retries are held back while first attempts are queued up for
+        every active chain_request worker, and are handed to the next
+        invocation once the deadline is reached
     """
 
-    global stage4shutdown
+    due, _, (ticker, expiration_date, attempt) = retry
+    delay = due - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
 
-    while True:
-        # Block until the next options_chain is available
-        ticker, expiration_date, data = await queue_in.get()
-        logger.debug(
-            "QSIZE STAGE3 -> STAGE4 -- {}".format(queue_in.qsize())
-            )
+    # Don't starve first attempt work of workers
+    if expiration_date is None:
+        while tickers_out.full() and not SCHEDULER.expired():
+            await asyncio.sleep(RETRYBASEDELAY)
+    else:
+        while (queue_out.qsize() >= CONTROLLER.limit and
+                not SCHEDULER.expired()):
+            await asyncio.sleep(RETRYBASEDELAY)
+
+    if SCHEDULER.expired():
+        SCHEDULER.handoff(ticker, expiration_date, attempt)
+        return None
+    logger.debug("RETRY {} {} attempt {}".format(
+        ticker, expiration_date, attempt)
+        )
+    if expiration_date is None:
+        await stage.put(tickers_out, (ticker, attempt))
+    else:
+        await stage.put(queue_out, (ticker, expiration_date, attempt))
 
-        if ticker is None:
-            # If (None, None, None) comes through the queue exit function
-            queue_in.task_done()
-            await queue_in.join()
-            if stage4shutdown is False:
-                await queue_out.put(None)
-                stage4shutdown = True
-            await queue_in.put((None, None, None))
-            logger.debug("STAGE4 RETURNING")
-            return None
 
-        else:
-            item = {}
-            # Get current collection time
-            _time = datetime.now().strftime('%Y%m%d%H%M%S')
-            # Set field for DynamoDB Partion Key
-            item['Ticker'] = ticker
-            # Set field for DynamoDB Sort Key
-            item['TimeCollectedExpirationDate'] = int(
-                _time + datetime.strptime(
-                    expiration_date, "%B %d, %Y"
-                    ).strftime('%Y%m%d')
-                )
-            try:
-                item['calls'] = _encodeOptionsTable(data['calls'])
-                item['puts'] = _encodeOptionsTable(data['puts'])
-                await queue_out.put(item)
-                logger.debug(
-                    "QSIZE STAGE4 -> STAGE5 -- {}".format(queue_out.qsize())
-                    )
-            except Exception as e:
-                # if any thing goes wrong with encoding the items
-                #  log the error
-                _unreachable_message(ticker, expiration_date, e)
-            queue_in.task_done()
+async def encode_db_item(stage, chain, queue_out):
+    """
+    STAGE 4
+    Inputs:
+        ----------------------------------------------------------------
+        chain --> (ticker, expiration date, data) off the StageQueue
+            between Stage 2/3 and this
+        queue_out --> (StageQueue) Queue between this and Stage 5
 
+    Reminders:
+        ----------------------------------------------------------------
+        Stage 4: of the aync pipeline. No blocking IO done here, with
+        out an executor a single worker of this stage runs, with one
+        a worker runs for each executor worker
+    """
 
-async def put_db_item(queue_in):
+    global UNCHANGEDCHAINS
+
+    ticker, expiration_date, data = chain
+    item = {}
+    # Get current collection time
+    _time = datetime.now().strftime('%Y%m%d%H%M%S')
+    expiration = _expirationKey(expiration_date)
+    # Set field for DynamoDB Partion Key
+    item['Ticker'] = ticker
+    # Set field for DynamoDB Sort Key
+    item['TimeCollectedExpirationDate'] = int(_time + expiration)
+    try:
+        calls = await _run_cpu_bound(_encodeOptionsTable, data['calls'])
+        puts = await _run_cpu_bound(_encodeOptionsTable, data['puts'])
+        METRICS.collected(ticker, data)
+        chainhash = _chainHash(calls, puts)
+        stored = None
+        if DEDUPCHAINS:
+            stored = await CHAINHASHES.get(ticker, expiration)
+        if stored is not None and stored[0] == chainhash:
+            # Chain is byte identical to the last stored copy only
+            #  record which item holds the data for this snapshot
+            item['SameAs'] = stored[1]
+            UNCHANGEDCHAINS += 1
+        else:
+            item['calls'] = calls
+            item['puts'] = puts
+            if DEDUPCHAINS:
+                item['ChainHash'] = chainhash
+        await stage.put(queue_out, item)
+    except Exception as e:
+        # if any thing goes wrong with encoding the items
+        #  log the error
+        _unreachable_message(ticker, expiration_date, e)
+
+
+async def put_db_item(stage, items):
     """
     STAGE 5
     Async function to put the items into the Dynamdb Table collections
@@ -503,54 +3555,47 @@ async def put_db_item(queue_in):
 
     Inputs:
         ----------------------------------------------------------------
-        queue_in --> (asyncio.Queue) Queue between Stage 3 and this
-            queue.pop() --> (JSON) item to put to dynamodb
+        items --> list[(JSON)] every item to put to dynamodb that was
+            waiting on the StageQueue between Stage 4 and this
 
+    Writes go through DBWRITER, items that can't be written are reported
+    as DYNAMODB unreachable messages
     """
 
-    global stage5shutdown
-
-    while True:
-
-        if stage5shutdown is True:
-            await queue_in.join()
-            await queue_in.put(None)
-            logger.debug("STAGE5 RETURNING")
-            return None
-        else:
-            items = []
-
-        try:
-            # Get All Items that are ready to put to dynamodb
-            while True:
-                items.append(queue_in.get_nowait())
-                logger.debug(
-                    "QSIZE STAGE4 -> STAGE5 -- {}".format(queue_in.qsize())
-                    )
-        except asyncio.QueueEmpty:
-            if len(items) == 0:
-                # Block until an item is available
-                items.append(await queue_in.get())
-                logger.debug(
-                    "QSIZE STAGE4 -> STAGE5 -- {}".format(queue_in.qsize())
-                    )
-        if items[-1] is None:
-            stage5shutdown = True
-            # Pop the none off the list of items
-            items.pop()
-            queue_in.task_done()
-
-        if len(items) > 0:
-            try:
-                with table.batch_writer() as batch:
-                    for item in items:
-                        batch.put_item(Item=item)
-                        queue_in.task_done()
-            except Exception as e:
-                _unreachable_message("DYNAMODB", "NONE", e)
-
-
-async def async_handler(tickers, context):
+    try:
+        failed = await DBWRITER.write(items)
+        if len(failed) > 0:
+            _unreachable_message("DYNAMODB", "NONE", Exception(
+                "{} items still unprocessed after {} retries".format(
+                    len(failed), DBWRITEATTEMPTS)
+                ))
+        # Once the chains are stored they are the copy the next
+        #  runs unchanged chains point back to
+        failed = set(map(id, failed))
+        hashes = []
+        for item in items:
+            if 'ChainHash' not in item or id(item) in failed:
+                continue
+            row = {
+                'Ticker': item['Ticker'],
+                'Expiration': str(item['TimeCollectedExpirationDate'])[-8:],
+                'Hash': item['ChainHash'],
+                'SameAs': item['TimeCollectedExpirationDate']
+                }
+            row['ExpiresAt'] = _expiresAt(row['Expiration'])
+            # The time it took goes along for ordering later runs
+            seconds = CHAINSECONDS.get((row['Ticker'], row['Expiration']))
+            if seconds is not None:
+                row['Millis'] = int(1000 * seconds)
+            hashes.append(row)
+        if len(hashes) > 0 and len(await HASHWRITER.write(hashes)):
+            # Only costs storing those chains again next run
+            logger.warning("Chain hashes not stored")
+    except Exception as e:
+        _unreachable_message("DYNAMODB", "NONE", e)
+
+
+async def async_handler(tickers, context, chains=(), work=None):
     """
     Entry point into the async event loop
 
@@ -558,53 +3603,149 @@ async def async_handler(tickers, context):
         ----------------------------------------------------------------
         tickers --> list[strings]
         context --> Lambda invokation context object
+        chains --> list[[ticker, expiration, attempt]] handed over by the
+            last invocation
+        work --> (WorkQueue) pull the work off WORKQUEUESQS instead of
+            tickers and chains, what is left at the deadline goes back
+            to the queue
     Reminders:
         ----------------------------------------------------------------
-        Be careful with the max queue sizes the shutdown process has to
-        be accounted for.
+        The stages run as a Pipeline, it logs the counters of every
+        stage once the invocations work is done. The throughput of the
+        invocation is printed as an EMF record (see EmbeddedMetrics)
 
     """
 
+    # Bound the parse/encode jobs in the executor for this event loop
+    global EXECUTORSLOTS, CONTROLLER, HTTPSTATS, DBWRITER, HASHWRITER
+    global SCHEDULER, METRICS, CHAINHASHES
+    EXECUTORSLOTS = asyncio.Semaphore(EXECUTORMAXINFLIGHT)
+    # Throughput telemetry printed as an EMF record at the end
+    METRICS = EmbeddedMetrics()
+    # Adaptive limit on the workers of Stage 2 and 3 making requests
+    CONTROLLER = ConcurrencyController(
+        CONCURRENCYMIN, CONCURRENCYMAX, MAXCONNECTIONS, CONCURRENCYWINDOW
+        )
+    # Admits the work that fits in the invocation
+    SCHEDULER = DeadlineScheduler(context, TICKERCOSTS, DEADLINEMS)
+
+    # Stage 5 meters its writes against the tables write capacity
+    DBWRITER = MeteredWriter(table, DBWRITECAPACITY, DBWRITEBURST)
+    HASHWRITER = MeteredWriter(hash_table, HASHWRITECAPACITY, DBWRITEBURST)
+    # Stage 4 compares the chains with the last stored hashes
+    CHAINHASHES = ChainHashes(hash_table, HASHREADCAPACITY, DBWRITEBURST)
+
+    # Most expensive tickers first, ticker_handler takes them off the end
+    tickers = _order_tickers(tickers, TICKERCOSTS, TICKERSECONDS)[::-1]
+
     # Initialize Queue between a ticker_handler and get_expiration_dates
-    th2ge = asyncio.Queue(maxsize=TICKERQUEUESIZE)
+    th2ge = StageQueue(maxsize=TICKERQUEUESIZE)
     # Initiailize Queue betweem get_expiration_dates and chain_request
-    ge2cr = asyncio.Queue(maxsize=TICKERQUEUESIZE + MAXCONNECTIONS)
-    # Initialize the queue between chain_request and encode_db_item
-    cr2edi = asyncio.Queue(maxsize=TICKERQUEUESIZE + MAXCONNECTIONS)
+    ge2cr = StageQueue(maxsize=TICKERQUEUESIZE + MAXCONNECTIONS)
+    # Initialize the queue between chain_request and its retry stage,
+    #  chains handed over by the last invocation start out there
+    cr2rt = StagePriorityQueue()
+    for ticker, expiration_date, attempt in chains:
+        cr2rt.put_nowait((
+            0, next(RETRYSEQUENCE), (ticker, expiration_date, attempt)
+            ))
+    SCHEDULER.resume(chains)
+    if DEDUPCHAINS:
+        for ticker, expiration_date, _ in chains:
+            CHAINHASHES.prefetch(ticker, [_expirationKey(expiration_date)])
+    # Initialize the queue between chain_request and encode_db_item, the
+    #  tables it holds vary in size by orders of magnitude between
+    #  tickers so it is bounded by bytes too
+    cr2edi = ByteBudgetQueue(
+        maxsize=TICKERQUEUESIZE + MAXCONNECTIONS, budget=TABLEQUEUEBYTES,
+        sizeof=_chainBytes
+        )
     # Initiaize Queue between encode_db_item and put_db_item
-    edi2pdi = asyncio.Queue(maxsize=TICKERQUEUESIZE + MAXCONNECTIONS)
-
-    # initalize an aiohttp Client Session and masqurade as a
-    #  firefox client
-    HTTPSession = aiohttp.ClientSession(headers={
-        "user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:75.0)"
-        + " Gecko/20100101 Firefox/75.0",
-        "Accept": "text/html",
-        "Accept-Encoding": "identity"
-        })
-
-    # Create a List of Coroutines to run concurrently as tasks
-    # Stage 1: ticker_handler.
-    tasks = [ticker_handler(tickers, context, th2ge, HTTPSession)]
-
-    for i in range(TICKERQUEUESIZE):
-        tasks.append(get_expiration_dates(th2ge, ge2cr, HTTPSession))
-
-    # Stage 2: Many Stage. chain_requests to run concurrently
-    for i in range(MAXCONNECTIONS):
-        tasks.append(chain_request(ge2cr, cr2edi, HTTPSession))
-
-    # Stage 3: encode_db_item, No blocking io so single coroutine
-    tasks.append(encode_db_item(cr2edi, edi2pdi))
-
-    # Stage 4: Many stage. Put items to the DynamoDB as block io
-    for i in range(2):
-        tasks.append(put_db_item(edi2pdi))
-
-    # Launch all the coroutines as tasks and wait for them to complete
-    await asyncio.gather(*tasks)
-    # Close HTTPSession
-    await HTTPSession.close()
+    edi2pdi = ByteBudgetQueue(
+        maxsize=TICKERQUEUESIZE + MAXCONNECTIONS, budget=ITEMQUEUEBYTES,
+        sizeof=_itemBytes
+        )
+
+    # initalize an aiohttp Client Session with per request timings
+    HTTPSTATS = HTTPTimings()
+    HTTPSession = _build_http_session()
+
+    if work is None:
+        source = functools.partial(
+            ticker_handler, tickers=tickers, context=context,
+            queue_out=th2ge
+            )
+    else:
+        source = functools.partial(
+            work_handler, work=work, queue_out=th2ge, retry_queue=cr2rt
+            )
+
+    pipeline = Pipeline([
+        # Stage 1: ticker_handler or work_handler, the source
+        Stage('tickers', None, source),
+        # Stage 2 and 3 have workers for the most the controller allows
+        Stage('expirations', th2ge, functools.partial(
+            get_expiration_dates, queue_out=ge2cr, chains_out=cr2edi,
+            retry_queue=cr2rt, HTTPSession=HTTPSession
+            ), workers=CONTROLLER.expirations_limit(CONCURRENCYMAX)),
+        Stage('chains', ge2cr, functools.partial(
+            chain_request, queue_out=cr2edi, retry_queue=cr2rt,
+            HTTPSession=HTTPSession
+            ), workers=CONCURRENCYMAX),
+        # Single retry worker feeding failed requests back into Stage 2
+        #  (base pages) and Stage 3
+        Stage('retries', cr2rt, functools.partial(
+            retry_chain_request, queue_out=ge2cr, tickers_out=th2ge
+            )),
+        # Stage 4: encode_db_item, No blocking io so single worker unless
+        #  the encoding is offloaded to the executor
+        Stage('encode', cr2edi, functools.partial(
+            encode_db_item, queue_out=edi2pdi
+            ), workers=1 if _get_executor() is None else EXECUTORWORKERS),
+        # Stage 5: Put every waiting item to DynamoDB from writer threads
+        Stage('store', edi2pdi, put_db_item, workers=DBWRITERS, batch=True)
+        ])
+
+    # Cuts the concurrency before the function runs out of memory
+    watchdog = MemoryWatchdog(CONTROLLER, MEMORYMB)
+    watching = asyncio.ensure_future(watchdog.run())
+    # Sends the unreachable report as it falls due
+    reporting = asyncio.ensure_future(UNREACHABLEMESSAGES.run())
+    try:
+        await pipeline.run()
+    finally:
+        watching.cancel()
+        reporting.cancel()
+        # Close HTTPSession
+        await HTTPSession.close()
+    if len(SCHEDULER.tickers) > 0 or len(SCHEDULER.chains) > 0:
+        # Stragglers cut off by the deadline
+        if work is None:
+            _invoke_collector(SCHEDULER.tickers, SCHEDULER.chains)
+        else:
+            work.enqueue(
+                SCHEDULER.tickers, SCHEDULER.chains, unfinished=True
+                )
+    if work is not None:
+        logger.info("Work queue -- {}".format(json.dumps(work.close())))
+    summary = pipeline.summary()
+    logger.info("Pipeline -- {}".format(json.dumps(summary)))
+    logger.info("Deadline -- {}".format(json.dumps(SCHEDULER.summary())))
+    logger.info("HTTP timings -- {}".format(json.dumps(HTTPSTATS.summary())))
+    logger.info("Memory -- {}".format(json.dumps(dict(
+        watchdog.summary(), peak_chain_bytes=METRICS.chainbytes
+        ))))
+    logger.info("Unchanged chains not stored -- {}".format(UNCHANGEDCHAINS))
+    logger.info("DynamoDB writes -- {} -- chain hashes {}".format(
+        json.dumps(DBWRITER.summary()), json.dumps(HASHWRITER.summary())
+        ))
+    logger.info("Chain hash reads -- {}".format(
+        json.dumps(CHAINHASHES.summary())
+        ))
+    if EMFNAMESPACE != "":
+        METRICS.emit(
+            summary, SCHEDULER, HTTPSTATS, [DBWRITER, HASHWRITER], watchdog
+            )
     # End async loop and Give control back to the lambda handler
     return None
 
@@ -616,25 +3757,26 @@ def handler(event, context):
     """
 
     # Initilaize invocations UNREACHABLE data mapping and
-    #  stage shutdown globals
-    global UNREACHABLEMESSAGES
-    global stage1shutdown, stage2shutdown, stage3shutdown
-    global stage4shutdown, stage5shutdown
-    UNREACHABLEMESSAGES = {"run_timestamp": time.time_ns()}
-    stage1shutdown = False
-    stage2shutdown = False
-    stage3shutdown = False
-    stage4shutdown = False
-    stage5shutdown = False
+    #  chain bookkeeping globals
+    global UNREACHABLEMESSAGES, UNCHANGEDCHAINS, TICKERCOSTS
+    global TICKERSECONDS, CHAINSECONDS
+    UNREACHABLEMESSAGES = UnreachableMessages(time.time_ns())
+    if 'Records' in event:
+        # Delayed work event off WORKWAKESQS (see WorkQueue.wake)
+        event = json.loads(event['Records'][0]['body'])
+    CHAINSECONDS = {}
+    UNCHANGEDCHAINS = 0
 
     state = event['State']
     # Determine what to do based on event state
     if state == "initialize":
+        # Start on the heavy modules while the tickers are queried
+        _preload()
         # Logging the initalization of collection process
         #  log processing function needs this log event
         #  so it knows how far back in to process the logs
         logger.info("State: initialize, run_timestamp: {}".format(
-            UNREACHABLEMESSAGES['run_timestamp'])
+            UNREACHABLEMESSAGES.run_timestamp)
             )
 
         tickers = ticker_table.query(
@@ -658,19 +3800,67 @@ def handler(event, context):
             logger.info(
                 "Initialize Number of Tickers: {}".format(len(tickers))
                 )
-            asyncio.run(async_handler(tickers, context))
+            try:
+                TICKERCOSTS, TICKERSECONDS = _load_ticker_costs()
+            except Exception as e:
+                logger.warning("No ticker costs -- {}".format(e))
+                TICKERCOSTS, TICKERSECONDS = {}, {}
+            work = None
+            if WORKQUEUESQS != "":
+                # Queue the run for COLLECTSHARDS collectors, this
+                #  invocation is the first of them. The queue receives
+                #  the items about, not exactly, in this order
+                work = WorkQueue(UNREACHABLEMESSAGES.run_timestamp)
+                work.enqueue(
+                    _order_tickers(tickers, TICKERCOSTS, TICKERSECONDS)
+                    )
+                for _ in range(COLLECTSHARDS - 1):
+                    _invoke_worker()
+                logger.info("Work items: {}, Collectors: {}".format(
+                    len(tickers), COLLECTSHARDS)
+                    )
+                tickers = []
+            elif COLLECTSHARDS > 1:
+                # No work queue, fan the run out over fixed shards of
+                #  concurrent collectors, this invocation collects the
+                #  first shard
+                shards = _shard_tickers(tickers, TICKERCOSTS)
+                for shard in shards[1:]:
+                    _invoke_collector(shard)
+                tickers = shards[0]
+                logger.info("Shards: {}, Tickers per shard: {}".format(
+                    len(shards), [len(shard) for shard in shards])
+                    )
+            asyncio.run(async_handler(tickers, context, work=work))
 
     elif state == "continue":
         # Continue Collection with the tickers left in the list
+        _preload()
 
         tickers = event['Tickers']
-        UNREACHABLEMESSAGES["run_timestamp"] = event["run_timestamp"]
+        chains = event.get('Chains', [])
+        TICKERCOSTS = event.get('Costs', {})
+        TICKERSECONDS = event.get('Seconds', {})
+        UNREACHABLEMESSAGES.run_timestamp = event["run_timestamp"]
         logger.info(
-            "State: continue, Number of remaining tickers: {}".format(
-                len(tickers))
+            "State: continue, Number of remaining tickers: {}, "
+            "chains: {}".format(len(tickers), len(chains))
             )
         # Initilize the async event loop and launch the aysnc_handler
-        asyncio.run(async_handler(tickers, context))
+        asyncio.run(async_handler(tickers, context, chains))
+
+    elif state == "work":
+        # Pull the work of the run off the work queue
+        _preload()
+
+        TICKERCOSTS, TICKERSECONDS = {}, {}
+        UNREACHABLEMESSAGES.run_timestamp = event["run_timestamp"]
+        logger.info("State: work, run_timestamp: {}".format(
+            UNREACHABLEMESSAGES.run_timestamp)
+            )
+        asyncio.run(async_handler(
+            [], context, work=WorkQueue(UNREACHABLEMESSAGES.run_timestamp)
+            ))
 
     else:
         # Invalid state event invoked the function log and return
@@ -680,13 +3870,17 @@ def handler(event, context):
 
     logger.info("Exiting Invocation, Runs total time mins. -- {}".format(
         1e-9 * (
-            time.time_ns() - UNREACHABLEMESSAGES['run_timestamp']
+            time.time_ns() - UNREACHABLEMESSAGES.run_timestamp
             ) / 60.)
         )
-    # Send the unreachable data to the SQS
-    sqsqueue.send_message(
-            MessageBody=json.dumps(UNREACHABLEMESSAGES)
-        )
-    logger.info("Send sqs message")
+    # Send the rest of the unreachable data to the SQS
+    logger.info("Unreachable reports -- {}".format(
+        json.dumps(UNREACHABLEMESSAGES.close())
+        ))
+    _report_cold_start(state)
 
     return 0
+
+
+# End of the module init
+COLDSTART['init'] = time.perf_counter() - INITSTART
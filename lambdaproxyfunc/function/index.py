@@ -46,19 +46,22 @@ from werkzeug.exceptions import NotFound --> Exception thats used for
 
 import boto3
 from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import Binary
 from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
 import awsgi
+from optionscodec import decodeOptionsTable
 import json
 import os
 import base64
 import pandas as pd
-import numpy as np
 from datetime import datetime
 from decimal import Decimal
 import re
 import uuid
 import logging
+import random
+import time
 
 if not os.environ.get("XRAYACTIVATED") is None:
     # Xray Has been activated for the stack, patch calls to AWS services
@@ -72,15 +75,21 @@ if not os.environ.get("XRAYACTIVATED") is None:
 logger = logging.getLogger()
 logger.setLevel(getattr(logging, os.environ['LOGLEVEL']))
 
+# Stored copies of unchanged chains still unprocessed by batch_get_item
+#  are retried up to BATCHGETATTEMPTS times backing off
+#  BATCHGETBASEDELAY * 2 ** attempt seconds (full jitter)
+BATCHGETATTEMPTS = int(os.environ.get('BATCHGETATTEMPTS', 6))
+BATCHGETBASEDELAY = float(os.environ.get('BATCHGETBASEDELAY', .05))
+
 
 def _decodeOptionsTable(record):
     """
-    Helper Function. Transform the Base64 encoded table into Json object
-    that can be loaded through pandas.read_json()
+    Helper Function. Transform the stored table into Json object that
+    can be loaded through pandas.read_json(), see optionscodec
     Inputs:
     --------------------------------------------------------------------
-    record --> json string that is stored in DynamoDB as attributes
-        'calls' or 'puts'
+    record --> json string or binary payload that is stored in DynamoDB
+        as attributes 'calls' or 'puts'
 
     Outputs:
     --------------------------------------------------------------------
@@ -99,19 +108,68 @@ def _decodeOptionsTable(record):
     if record is None:
         # Calls and Puts table didn't have any data
         return None, None
-    record = json.loads(record)
-    frame = {"Last Trade Date": record["Last Trade Date"]}
-    shape = np.frombuffer(
-        base64.b64decode(record['Shape'].encode('ascii')),
-        dtype=np.int32).astype(int)
+    if isinstance(record, Binary):
+        record = record.value
+    return decodeOptionsTable(record)
+
+
+def _resolveUnchanged(items):
+    """
+    Helper Function. The collector doesn't store chains that haven't
+    changed since the last stored copy, it puts an item with SameAs set
+    to the TimeCollectedExpirationDate of the item holding the data.
+    Fill in calls and puts of those items from the stored copy so they
+    decode like any other item. Stored copies collected on an earlier
+    day are read with batch_get_item, 100 keys at a time
+    """
+
+    stored = {
+        item['TimeCollectedExpirationDate']: item
+        for item in items if item.get('SameAs') is None
+        }
+    missing = {
+        item['SameAs']: item['Ticker'] for item in items
+        if item.get('SameAs') is not None and item['SameAs'] not in stored
+        }
+    keys = [
+        {'Ticker': ticker, 'TimeCollectedExpirationDate': sameas}
+        for sameas, ticker in missing.items()
+        ]
+    for i in range(0, len(keys), 100):
+        stored.update(
+            (item['TimeCollectedExpirationDate'], item)
+            for item in _batchGetItems(keys[i:i + 100])
+            )
+    for item in items:
+        sameas = item.get('SameAs')
+        if sameas is None:
+            continue
+        item['calls'] = stored.get(sameas, {}).get('calls')
+        item['puts'] = stored.get(sameas, {}).get('puts')
+
+    return items
 
-    table = np.frombuffer(base64.b64decode(
-        record['Table'].encode('ascii')), dtype=np.float16).reshape(shape)
 
-    for label, data in zip(record['Column Labels'], table.T):
-        frame[label] = data
+def _batchGetItems(keys):
+    """
+    Helper Function. Items of up to 100 keys of OptionsHist, the
+    UnprocessedKeys are retried backing off BATCHGETBASEDELAY * 2 **
+    attempt seconds
+    """
 
-    return frame, len(table)
+    found = []
+    for attempt in range(BATCHGETATTEMPTS):
+        response = dynamodb.batch_get_item(RequestItems={
+            dbtable.name: {'Keys': keys}
+            })
+        found += response.get('Responses', {}).get(dbtable.name, [])
+        keys = response.get('UnprocessedKeys', {}).get(
+            dbtable.name, {}).get('Keys', [])
+        if len(keys) == 0:
+            return found
+        time.sleep(random.uniform(0, BATCHGETBASEDELAY * 2 ** attempt))
+    logger.warning("Stored copies not read -- {}".format(len(keys)))
+    return found
 
 
 def _decodeItem(item):
@@ -153,12 +211,14 @@ def _decodeItem(item):
 
 class MyEncoder(json.JSONEncoder):
     """
-    Simple JSONEncoder Extenstion to handle Decimal Types
-    from DynamoDB
+    Simple JSONEncoder Extenstion to handle Decimal and Binary Types
+    from DynamoDB, Binary payloads are sent as base64 strings
     """
     def default(self, obj):
         if isinstance(obj, Decimal):
             return int(obj)
+        if isinstance(obj, Binary):
+            return base64.b64encode(obj.value).decode('ascii')
         return super(MyEncoder, self).default(obj)
 
 
@@ -214,7 +274,7 @@ class WSGIApp(object):
              KeyConditionExpression=Key("Ticker").eq(ticker) &
              Key("TimeCollectedExpirationDate").between(begin, end)
             )
-        return dat.get("Items")
+        return _resolveUnchanged(dat.get("Items"))
 
     def getticker(self, environ, start_response):
         """
@@ -501,8 +561,9 @@ class WSGIApp(object):
 
 
 # Get DyanamoDB Table s3 client objects
-dbtable = boto3.resource('dynamodb').Table("OptionsHist")
-tracked_tickers = boto3.resource('dynamodb').Table("OptionsHistTickers")
+dynamodb = boto3.resource('dynamodb')
+dbtable = dynamodb.Table("OptionsHist")
+tracked_tickers = dynamodb.Table("OptionsHistTickers")
 lambdaclient = boto3.client('lambda')
 
 
@@ -0,0 +1,214 @@
+"""
+Decoder for the options tables the collector stores in the calls and
+puts attributes of OptionsHist items (see collectdatafunc PAYLOAD*)
+
+Shared by the lambda proxy and clientexample/clientexample.py so there
+is one reader of every payload version. Only needs numpy.
+
+    decodeOptionsTable(record) --> (dict, int) the columns of the table
+        and its number of rows, record is the JSON string or the bytes
+        of a binary payload
+"""
+
+import base64
+import json
+import lzma
+import struct
+import zlib
+
+import numpy as np
+
+# Binary payload written by the collector (see collectdatafunc PAYLOAD*)
+#  magic, version, compression then the compressed body
+PAYLOADMAGIC = b'OH'
+PAYLOADVERSIONS = (2, 3, 4)
+PAYLOADDECOMPRESS = {
+    1: zlib.decompress,
+    2: lzma.decompress,
+    3: lambda data: zlib.decompress(data, -zlib.MAX_WBITS)
+    }
+# Dtypes of the version 3 blocks
+PAYLOADDTYPES = ('<u1', '<u2', '<u4', '<u8', '<f8')
+# Largest value of each unsigned dtype, marks NaN in a scaled column
+PAYLOADMISSING = {
+    dtype: np.iinfo(dtype).max for dtype in PAYLOADDTYPES[:-1]
+    }
+# 10 ** exponent of the scaled columns (collectdatafunc PAYLOADMAXEXPONENT)
+PAYLOADSCALES = 10. ** np.arange(16)
+# Version 4 body header and column kinds (collectdatafunc PAYLOADHEADER)
+PAYLOADHEADER = struct.Struct('<IIHHBBB')
+PAYLOADINTEGERS, PAYLOADFLOATS, PAYLOADSTRINGS, PAYLOADDICTIONARY = range(4)
+PAYLOADHASMISSING = 1
+# Weight of each byte plane of a version 4 integer code
+PAYLOADPLANES = 256. ** np.arange(4)
+
+
+def decodeOptionsTable(record):
+    """
+    Helper Function. Transform a stored table into columns that can be
+    loaded into a pandas.DataFrame
+    Inputs:
+    --------------------------------------------------------------------
+    record --> json string or binary payload that is stored in DynamoDB
+        as attributes 'calls' or 'puts'
+
+    Outputs:
+    --------------------------------------------------------------------
+    dict, int --> python dictionary with keys for the columns of the
+        table value sequence of values, and the number of rows
+    """
+
+    if isinstance(record, bytes):
+        return decodeBinaryTable(record)
+    record = json.loads(record)
+    frame = {}
+    if "Last Trade Date" in record:
+        frame["Last Trade Date"] = record["Last Trade Date"]
+    shape = np.frombuffer(
+        base64.b64decode(record['Shape'].encode('ascii')),
+        dtype=np.int32).astype(int)
+
+    table = np.frombuffer(base64.b64decode(
+        record['Table'].encode('ascii')), dtype=np.float16).reshape(shape)
+
+    for label, data in zip(record['Column Labels'], table.T):
+        frame[label] = data
+
+    return frame, len(table)
+
+
+def decodeBinaryTable(payload):
+    """
+    Helper Function. Same as decodeOptionsTable for the compressed
+    binary payload
+        PAYLOADMAGIC + version + compression + compressed body
+    version 4 has the compressed length before the body and the raw
+    byte planes after it
+    """
+
+    if payload[:2] != PAYLOADMAGIC or payload[2] not in PAYLOADVERSIONS:
+        raise ValueError("Unknown options table payload version")
+
+    if payload[2] == 4:
+        return _decodePlanes(payload)
+
+    body = PAYLOADDECOMPRESS[payload[3]](payload[4:])
+    length, = struct.unpack_from('<I', body)
+    header = json.loads(body[4:4 + length].decode())
+    if payload[2] == 3:
+        return _decodeColumns(header, body, 4 + length)
+
+    table = np.frombuffer(
+        body, dtype=np.float16, offset=4 + length
+        ).reshape(header['Shape'])
+
+    frame = {"Last Trade Date": header["Last Trade Date"]}
+    for label, data in zip(header['Column Labels'], table.T):
+        frame[label] = data
+
+    return frame, len(table)
+
+
+def _decodeColumns(header, body, offset):
+    """
+    Helper Function. Decode the typed columns of a version 3 payload,
+    each column is [label, dtype, exponent, base] in the header. There
+    is one block per dtype in PAYLOADDTYPES order, each starting on an
+    8 byte boundary and holding its columns one after the other, so
+    every block is read as a np.frombuffer() view of the body and its
+    scaled integer columns are converted back together
+    """
+
+    rows = header['Rows']
+    groups = {}
+    for column in header['Columns']:
+        groups.setdefault(column[1], []).append(column)
+
+    columns = {}
+    for dtype in PAYLOADDTYPES:
+        group = groups.get(dtype)
+        if group is None:
+            continue
+        block = np.frombuffer(
+            body, dtype=dtype, count=len(group) * rows, offset=offset
+            ).reshape(-1, rows)
+        offset += -(-block.nbytes // 8) * 8
+        if dtype not in PAYLOADMISSING:
+            columns.update(zip([column[0] for column in group], block))
+            continue
+        values = block + np.array(
+            [column[3] for column in group], dtype=float)[:, None]
+        values /= PAYLOADSCALES[[column[2] for column in group], None]
+        values[block == PAYLOADMISSING[dtype]] = np.nan
+        for codes, data, column in zip(block, values, group):
+            if column[0] in header['Dictionaries']:
+                data = np.array(
+                    header['Dictionaries'][column[0]], dtype=object
+                    )[codes + column[3]]
+            columns[column[0]] = data
+
+    frame = {}
+    for label, _, _, _ in header['Columns']:
+        frame[label] = columns[label]
+
+    return frame, rows
+
+
+def _decodePlanes(payload):
+    """
+    Helper Function. Decode a version 4 payload, see collectdatafunc
+    _encodeColumns. The byte planes of the integer codes, raw ones
+    first, are summed into float64 codes with one np.dot() and every
+    integer column is converted back at once as
+        (code + base) / divisor
+    """
+
+    length, = struct.unpack_from('<I', payload, 4)
+    body = PAYLOADDECOMPRESS[payload[3]](payload[8:8 + length])
+    rows, text, count, integers, width, flags, raw = \
+        PAYLOADHEADER.unpack_from(body)
+    offset = PAYLOADHEADER.size
+    kinds = body[offset:offset + count]
+    offset += count
+    strings = body[offset:offset + text].decode().split('\0')
+    offset += text + -(offset + text) % 8
+
+    params = np.ndarray((2, integers, 1), '<f8', body, offset)
+    offset += params.nbytes
+    end = offset + (width - raw) * integers * rows
+    planes = np.ndarray(
+        (width, integers * rows), '<u1',
+        payload[8 + length:] + body[offset:end]
+        )
+    # Dictionary codes have base 0 and divisor 1, they stay in values
+    values = np.dot(PAYLOADPLANES[:width], planes).reshape(integers, rows)
+    if flags & PAYLOADHASMISSING:
+        missing = values == 2. ** (8 * width) - 1
+    values += params[0]
+    values /= params[1]
+    if flags & PAYLOADHASMISSING:
+        values[missing] = np.nan
+
+    floats = ()
+    if PAYLOADFLOATS in kinds:
+        floats = np.frombuffer(
+            body, dtype='<f8', offset=end + -end % 8
+            ).reshape(-1, rows)
+
+    frame, integer, number = {}, 0, 0
+    for label, kind in zip(strings, kinds):
+        if kind == PAYLOADINTEGERS:
+            frame[label] = values[integer]
+            integer += 1
+        elif kind == PAYLOADFLOATS:
+            frame[label] = floats[number]
+            number += 1
+        elif kind == PAYLOADSTRINGS:
+            frame[label] = strings[count:]
+        else:
+            frame[label] = np.array(strings[count:], dtype=object)[
+                values[integer].astype(np.intp)
+                ]
+            integer += 1
+
+    return frame, rows
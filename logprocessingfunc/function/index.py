@@ -13,6 +13,11 @@ The function Processes through the logs and updates collection
 Error statistics on in the "OptionsHistTickers" Table. Then publishes
 information to a SNS Topic
 
+The logs come in as SQS messages, collectdatafunc streams the errors of
+a run in many parts while it collects. The messages of an event are
+merged by run_timestamp (see merge_reports) and each part is counted
+once towards the run (see is_flagged).
+
 Any CRITIAL ERRORs are always published to SNS.
 
 The Function "is_flagged" below is where the logic for determining what
@@ -116,11 +121,44 @@ class UnreachableReport:
 """
 
 
-def is_flagged(errors, item, run_timestamp):
+def merge_reports(records):
     """
     Inputs:------------------------------------------------------------
-    errors --> is a list of log events (expiration_date, exception string)
-        associated with item['Ticker']
+    records --> SQS records, each the body of an unreachable report
+        message from collectdatafunc
+        {"run_timestamp": ts, "part": id, ticker: [[expiration, error]]}
+
+    OutPuts:-----------------------------------------------------------
+    {run_timestamp: {ticker: [(part, errors),...]}}
+
+    REMINDERS:
+    A collection run reports its errors in many parts, every invocation
+    of the run streams its own. Messages from before parts were sent have
+    no "part", they're merged the same way but can't be told apart when
+    SQS delivers them twice
+    """
+
+    runs, parts = {}, set()
+    for record in records:
+        report = json.loads(record['body'])
+        run_timestamp = report.pop('run_timestamp')
+        part = report.pop('part', None)
+        if part is not None and (run_timestamp, part) in parts:
+            # Sent twice and both copies came in together
+            continue
+        parts.add((run_timestamp, part))
+        tickers = runs.setdefault(run_timestamp, {})
+        for ticker, errors in report.items():
+            tickers.setdefault(ticker, []).append((part, errors))
+    return runs
+
+
+def is_flagged(reports, item, run_timestamp):
+    """
+    Inputs:------------------------------------------------------------
+    reports --> is a list of (part, errors) of the parts of the run
+        that reported item['Ticker'], errors is a list of log events
+        (expiration_date, exception string)
 
     item --> is the whole item that was returned from the ticker_table
 
@@ -137,20 +175,45 @@ def is_flagged(errors, item, run_timestamp):
     This function is responsible for the processing of the last
     collect runs errors and for the update of the item, which will
     be updated in dynamodb after the handler function passes item
-    into this function
+    into this function. The parts of a run can come in over many
+    invocations, the item keeps the parts already counted (run_parts),
+    the errors of the run so far (run_errors) and the average the run
+    started from (prev_emavg) so every part is merged in to the same
+    run
     """
 
-    # Check time stamp of last log processed timestamp to prevent
-    #  double collection of data in testing and or set timestamp
-    #  for initial collection of data
+    # Check time stamp of last log processed timestamp, a report of an
+    #  earlier run came in late
     ts = item.get("last_timestamp")
-    if ts is None:
-        item['last_timestamp'] = run_timestamp
-    elif ts == run_timestamp:
-        # this item was already updated with last run information
+    if ts is not None and run_timestamp < ts:
         return item.get("flag_state"), item.get("flag_reason"), item
-    else:
+    if ts != run_timestamp:
+        # First part of the run for this ticker
         item['last_timestamp'] = run_timestamp
+        item['run_parts'] = []
+        item['run_errors'] = 0
+        item['prev_emavg'] = item.get('err_emavg')
+        item['flag_state'] = False
+        item['flag_reason'] = None
+    item.setdefault('run_parts', [])
+    item.setdefault('run_errors', 0)
+    item.setdefault('prev_emavg', item.get('err_emavg'))
+
+    # Skip parts that were already counted, SQS delivers at least once
+    reports = [
+        (part, errors) for part, errors in reports
+        if part is None or part not in item['run_parts']
+        ]
+    if len(reports) == 0:
+        return item.get("flag_state"), item.get("flag_reason"), item
+    errors = [error for _, events in reports for error in events]
+    item['run_parts'] += [part for part, _ in reports if part is not None]
+    item['run_errors'] += len(errors)
+    item['errors'] = (item.get('errors') or []) + errors
+
+    if item.get('flag_state'):
+        # An earlier part of the run already flagged the ticker
+        return True, item['flag_reason'], item
 
     # Check for "No Expiration Dates error always flag these errors"
     for expiration, event in errors:
@@ -160,27 +223,21 @@ def is_flagged(errors, item, run_timestamp):
             return True, event, item
 
     # Adjust values for error collection
-    errorlog = item.get("errors")
-    if errorlog is None:
-        item['errors'] = errors
-        item['err_emavg'] = Decimal('{:.6f}'.format(len(errors) + 1e-5))
-        item['flag_state'] = False
-        item['flag_reason'] = None
+    emavg = item['prev_emavg']
+    if emavg is None:
+        item['err_emavg'] = Decimal(
+            '{:.6f}'.format(float(item['run_errors']) + 1e-5)
+            )
         return False, None, item
 
     else:
-        num_errors = len(errors)
-        emavg = item['err_emavg']
-        new_emavg = .25 * num_errors + .75 * float(emavg)
-        item['errors'] += errors
+        new_emavg = .25 * float(item['run_errors']) + .75 * float(emavg)
         item['err_emavg'] = Decimal('{:.6f}'.format(new_emavg))
         if new_emavg / float(emavg) > EMAVGPUBLISHTHRESHOLDRATIO:
             item['flag_state'] = True
             item['flag_reason'] = "EMAVG THRESHOLD EXCEEDED"
             return True, "EMAVG THRESHOLD EXCEEDED", item
         else:
-            item['flag_state'] = False
-            item['flag_reason'] = None
             return False, None, item
 
 
@@ -198,48 +255,52 @@ def handler(event, context):
             report.publish_sns()
         return {"html": report.get_html()}
 
-    logger.info("SQS Invoked -- ")
-    parsedlogs = json.loads(parsedlogs[0]['body'])  # SQS BatchSize=1
-    run_timestamp = parsedlogs['run_timestamp']
-    parsedlogs.pop('run_timestamp')
+    logger.info("SQS Invoked -- {} messages".format(len(parsedlogs)))
+    runs = merge_reports(parsedlogs)
 
     # Loop over the collection table and check current Errors
     #  from baseline errors
-    for ticker, errors in parsedlogs.items():
-        # Get the tickers item from ticker_collection table
-        item = ticker_table.get_item(
-                Key={'Ticker': ticker, 'Collecting': 'TRUE'}
-            ).get('Item')
-
-        if item is None:
-            # The item was removed from collection in the iterim
-            #  continue on
-            continue
-
-        # Process the log events and up
-        flag, reason, item = is_flagged(errors, item, run_timestamp)
-        logger.info('{} -- flagged for -- {}'.format(ticker, reason))
-        flatItem = json.dumps(item, cls=MyEncoder)
-        while len(flatItem.encode()) > 4000:
-            # Pop off error events try to keeping the items below
-            # the 4KB mark
-            item['errors'].pop(0)
+    for run_timestamp in sorted(runs):
+        for ticker, reports in runs[run_timestamp].items():
+            # Get the tickers item from ticker_collection table
+            item = ticker_table.get_item(
+                    Key={'Ticker': ticker, 'Collecting': 'TRUE'}
+                ).get('Item')
+
+            if item is None:
+                # The item was removed from collection in the iterim
+                #  continue on
+                continue
+
+            # Process the log events and up
+            flag, reason, item = is_flagged(reports, item, run_timestamp)
+            logger.info('{} -- flagged for -- {}'.format(ticker, reason))
             flatItem = json.dumps(item, cls=MyEncoder)
-        # Update the item logs in the dynamoDB table.
-        #  with current error logging metadata
-        ticker_table.update_item(
-            Key={"Ticker": ticker, "Collecting": "TRUE"},
-            UpdateExpression='SET errors = :errors, last_timestamp = :ts, '
-            + 'flag_reason = :reason, flag_state = :state, '
-            + 'err_emavg = :eavg',
-            ExpressionAttributeValues={
-                ":errors": item.get('errors'),
-                ":ts": item.get('last_timestamp'),
-                ":reason": item.get('flag_reason'),
-                ":state": item.get('flag_state'),
-                ":eavg": item.get('err_emavg')
-                },
-            ConditionExpression='attribute_exists(Collecting)'
-            )
+            while len(flatItem.encode()) > 4000 and len(item['errors']) > 0:
+                # Pop off error events try to keeping the items below
+                # the 4KB mark
+                item['errors'].pop(0)
+                flatItem = json.dumps(item, cls=MyEncoder)
+            # Update the item logs in the dynamoDB table.
+            #  with current error logging metadata
+            ticker_table.update_item(
+                Key={"Ticker": ticker, "Collecting": "TRUE"},
+                UpdateExpression='SET errors = :errors, '
+                + 'last_timestamp = :ts, flag_reason = :reason, '
+                + 'flag_state = :state, err_emavg = :eavg, '
+                + 'run_parts = :parts, run_errors = :runerrors, '
+                + 'prev_emavg = :prev',
+                ExpressionAttributeValues={
+                    ":errors": item.get('errors'),
+                    ":ts": item.get('last_timestamp'),
+                    ":reason": item.get('flag_reason'),
+                    ":state": item.get('flag_state'),
+                    ":eavg": item.get('err_emavg'),
+                    ":parts": item.get('run_parts'),
+                    ":runerrors": item.get('run_errors'),
+                    ":prev": item.get('prev_emavg')
+                    },
+                ConditionExpression='attribute_exists(Collecting)'
+                )
 
     return 0